@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""Flag turnaround regressions between Runpod benchmark runs.
+
+The first file is the baseline; every further file is a candidate compared
+against it cohort by cohort. Each metric (total turnaround and, when
+recorded, queue / execution / transfer stages) gets its ratio of medians and
+a one-sided Mann–Whitney U test. Only total turnaround and execution gate
+the result, and only they get a bootstrap confidence interval for the ratio;
+queue and transfer are reported for information. A cohort regresses when a gated metric's
+candidate median is slower by more than `--threshold` *and* the slowdown is
+significant (CI lower bound above 1.0 and Holm-adjusted p < `--alpha`, the
+correction running over all gated metric x cohort tests of a candidate).
+Exit status is 1 when any cohort regresses.
+
+Everything runs on local summary.json / results.jsonl files.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+
+from plot_perf import ResultArrays, load_data  # noqa: E402
+
+METRICS = (
+    ("total", "Total turnaround"),
+    ("queue", "Queue"),
+    ("exec", "Execution"),
+    ("transfer", "Transfer"),
+)
+# Metrics that decide PASS/FAIL; queue and transfer depend on load and network, not the worker.
+GATED_METRICS = ("total", "exec")
+DEFAULT_THRESHOLD = 0.10
+DEFAULT_ALPHA = 0.05
+DEFAULT_RESAMPLES = 2000
+MIN_SAMPLES = 3
+# Upper bound on resample matrix cells held at once (~16 MB of float64).
+BOOTSTRAP_CHUNK_CELLS = 2_000_000
+
+
+def metric_samples(data: ResultArrays, rows: np.ndarray, metric: str) -> np.ndarray:
+  if metric == "total":
+    values = data.total_ms[rows]
+  elif metric == "queue":
+    values = data.queue_ms[rows]
+  elif metric == "exec":
+    values = data.exec_ms[rows]
+  else:
+    staged = ~np.isnan(data.queue_ms[rows]) & ~np.isnan(data.exec_ms[rows])
+    values = data.transfer_ms()[rows][staged]
+  return values[~np.isnan(values)]
+
+
+def bootstrap_medians(values: np.ndarray, resamples: int, rng: np.random.Generator) -> np.ndarray:
+  chunk = max(1, BOOTSTRAP_CHUNK_CELLS // max(values.size, 1))
+  medians = np.empty(resamples)
+  for start in range(0, resamples, chunk):
+    stop = min(start + chunk, resamples)
+    picks = rng.integers(0, values.size, size=(stop - start, values.size))
+    medians[start:stop] = np.median(values[picks], axis=1)
+  return medians
+
+
+def bootstrap_ratio_ci(
+    baseline: np.ndarray,
+    candidate: np.ndarray,
+    *,
+    resamples: int,
+    confidence: float,
+    rng: np.random.Generator,
+) -> tuple[float, float]:
+  ratios = bootstrap_medians(candidate, resamples, rng) / np.maximum(
+      bootstrap_medians(baseline, resamples, rng), 1e-9
+  )
+  tail = (1.0 - confidence) / 2 * 100
+  low, high = np.percentile(ratios, (tail, 100 - tail))
+  return float(low), float(high)
+
+
+def mann_whitney_greater(baseline: np.ndarray, candidate: np.ndarray) -> float:
+  """One-sided p-value that `candidate` tends to be larger than `baseline`.
+
+  Normal approximation with tie correction and continuity correction, which is
+  accurate for the sample sizes these benchmarks produce.
+  """
+  n1, n2 = candidate.size, baseline.size
+  combined = np.concatenate([candidate, baseline])
+  _, inverse, counts = np.unique(combined, return_inverse=True, return_counts=True)
+  # Average rank of each distinct value, then look it up per sample.
+  upper = np.cumsum(counts)
+  avg_rank = upper - (counts - 1) / 2.0
+  ranks = avg_rank[inverse]
+  u_stat = ranks[:n1].sum() - n1 * (n1 + 1) / 2.0
+  n = n1 + n2
+  tie_term = float(np.sum(counts.astype(np.float64) ** 3 - counts)) / (n * (n - 1))
+  variance = n1 * n2 / 12.0 * ((n + 1) - tie_term)
+  if variance <= 0:
+    return 1.0
+  z = (u_stat - n1 * n2 / 2.0 - 0.5) / math.sqrt(variance)
+  return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def holm_adjust(p_values: List[float]) -> List[float]:
+  """Holm step-down adjusted p-values (family-wise error rate control)."""
+  order = sorted(range(len(p_values)), key=lambda idx: p_values[idx])
+  adjusted = [1.0] * len(p_values)
+  running = 0.0
+  for rank, idx in enumerate(order):
+    running = max(running, min(1.0, (len(p_values) - rank) * p_values[idx]))
+    adjusted[idx] = running
+  return adjusted
+
+
+def compare_runs(
+    baseline: ResultArrays,
+    candidate: ResultArrays,
+    *,
+    threshold: float,
+    alpha: float,
+    resamples: int,
+    confidence: float,
+    seed: int,
+) -> List[dict]:
+  rng = np.random.default_rng(seed)
+  baseline_groups = dict(zip(baseline.cohort_order, baseline.groups()))
+  candidate_groups = dict(zip(candidate.cohort_order, candidate.groups()))
+  rows: List[dict] = []
+  for key in baseline.cohort_order:
+    if key not in candidate_groups:
+      continue
+    for metric, _ in METRICS:
+      base_values = metric_samples(baseline, baseline_groups[key], metric)
+      cand_values = metric_samples(candidate, candidate_groups[key], metric)
+      if base_values.size < MIN_SAMPLES or cand_values.size < MIN_SAMPLES:
+        continue
+      base_median = float(np.median(base_values))
+      cand_median = float(np.median(cand_values))
+      ratio = cand_median / base_median if base_median > 0 else float("nan")
+      ci_low = ci_high = None
+      if metric in GATED_METRICS:
+        # The bootstrap dominates the run time; informational metrics never use the interval.
+        ci_low, ci_high = bootstrap_ratio_ci(
+            base_values, cand_values, resamples=resamples, confidence=confidence, rng=rng
+        )
+      p_value = mann_whitney_greater(base_values, cand_values)
+      rows.append(
+          {
+              "cohortKey": key,
+              "cohortLabel": baseline.label(key),
+              "metric": metric,
+              "baseline_runs": int(base_values.size),
+              "candidate_runs": int(cand_values.size),
+              "baseline_p50_ms": base_median,
+              "candidate_p50_ms": cand_median,
+              "ratio": ratio,
+              "ci_low": ci_low,
+              "ci_high": ci_high,
+              "p_value": p_value,
+              "p_adjusted": None,
+              "status": "INFO",
+          }
+      )
+  gated = [row for row in rows if row["metric"] in GATED_METRICS]
+  for row, adjusted in zip(gated, holm_adjust([row["p_value"] for row in gated])):
+    regressed = row["ratio"] > 1.0 + threshold and row["ci_low"] > 1.0 and adjusted < alpha
+    row["p_adjusted"] = adjusted
+    row["status"] = "FAIL" if regressed else "PASS"
+  return rows
+
+
+def print_report(candidate_name: str, rows: List[dict]) -> None:
+  print(f"\n=== {candidate_name} vs baseline ===")
+  if not rows:
+    print("No overlapping cohorts with enough samples.")
+    return
+  header = (
+      f"{'cohort':<24} {'metric':<9} {'base_p50_s':>10} {'cand_p50_s':>10} {'ratio':>7} {'ci':>15} {'p':>8} {'p_holm':>8}  status"
+  )
+  print(header)
+  print("-" * len(header))
+  for row in rows:
+    ci = "-" if row["ci_low"] is None else f"[{row['ci_low']:.3f},{row['ci_high']:.3f}]"
+    p_holm = "-" if row["p_adjusted"] is None else f"{row['p_adjusted']:.4f}"
+    print(
+        f"{row['cohortLabel'][:24]:<24} {row['metric']:<9} "
+        f"{row['baseline_p50_ms'] / 1000:>10.2f} {row['candidate_p50_ms'] / 1000:>10.2f} "
+        f"{row['ratio']:>7.3f} {ci:>15} {row['p_value']:>8.4f} {p_holm:>8}  {row['status']}"
+    )
+
+
+def build_comparison_chart(
+    baseline: ResultArrays,
+    comparisons: Dict[str, List[dict]],
+    output_path: Path,
+    *,
+    threshold: float,
+) -> None:
+  cohorts = baseline.cohort_order
+  positions = {key: idx for idx, key in enumerate(cohorts)}
+  metrics_present = [
+      (metric, label)
+      for metric, label in METRICS
+      if any(row["metric"] == metric for rows in comparisons.values() for row in rows)
+  ]
+  fig, axes = plt.subplots(
+      len(metrics_present), 1, figsize=(14, 3.2 * len(metrics_present)), sharex=True, squeeze=False
+  )
+  width = 0.8 / max(len(comparisons), 1)
+  for ax, (metric, label) in zip(axes[:, 0], metrics_present):
+    for offset, (name, rows) in enumerate(comparisons.items()):
+      selected = [row for row in rows if row["metric"] == metric]
+      if not selected:
+        continue
+      xs = np.array([positions[row["cohortKey"]] for row in selected]) + (offset - (len(comparisons) - 1) / 2) * width
+      ratios = np.array([row["ratio"] for row in selected])
+      colors = [{"FAIL": "#ef4444", "INFO": "#94a3b8"}.get(row["status"], "#0ea5e9") for row in selected]
+      ax.bar(xs, ratios - 1.0, bottom=1.0, width=width * 0.9, color=colors, alpha=0.75, label=name)
+      with_ci = [idx for idx, row in enumerate(selected) if row["ci_low"] is not None]
+      if with_ci:
+        errors = np.array(
+            [
+                [selected[idx]["ratio"] - selected[idx]["ci_low"] for idx in with_ci],
+                [selected[idx]["ci_high"] - selected[idx]["ratio"] for idx in with_ci],
+            ]
+        )
+        ax.errorbar(
+            xs[with_ci], ratios[with_ci], yerr=np.clip(errors, 0, None), fmt="none", ecolor="#0f172a", capsize=3, linewidth=1
+        )
+    ax.axhline(1.0, color="#0f172a", linewidth=1)
+    ax.axhline(1.0 + threshold, color="#ef4444", linewidth=1, linestyle="--")
+    ax.set_ylabel(f"{label}{'' if metric in GATED_METRICS else ' (info)'}\nmedian ratio")
+    ax.grid(axis="y", linestyle="--", alpha=0.25)
+  axes[-1, 0].set_xticks(range(len(cohorts)), [baseline.label(key) for key in cohorts], rotation=20, ha="right")
+  axes[0, 0].set_title(
+      f"Candidate / baseline median turnaround (dashed: +{threshold:.0%} regression threshold, red: FAIL)",
+      loc="left",
+      fontsize=13,
+  )
+  if len(comparisons) > 1:
+    axes[0, 0].legend(loc="upper left")
+
+  fig.tight_layout()
+  output_path.parent.mkdir(parents=True, exist_ok=True)
+  fig.savefig(output_path, dpi=150, bbox_inches="tight")
+  plt.close(fig)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("baseline", help="baseline summary.json or results .jsonl")
+  parser.add_argument("candidates", nargs="+", help="one or more candidate runs to compare against the baseline")
+  parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="tolerated median slowdown (default 0.10)")
+  parser.add_argument(
+      "--alpha", type=float, default=DEFAULT_ALPHA, help="family-wise significance level, Holm-corrected (default 0.05)"
+  )
+  parser.add_argument("--confidence", type=float, default=0.95, help="bootstrap CI level (default 0.95)")
+  parser.add_argument("--resamples", type=int, default=DEFAULT_RESAMPLES, help="bootstrap resamples (default 2000)")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--chart", metavar="PATH", help="comparison chart PNG (default: comparison.png next to the first candidate)")
+  parser.add_argument("--report-json", metavar="PATH", help="also write the full comparison as JSON")
+  return parser.parse_args(argv)
+
+
+def main() -> None:
+  args = parse_args()
+  paths = [Path(item).expanduser().resolve() for item in [args.baseline, *args.candidates]]
+  for path in paths:
+    if not path.exists():
+      print(f"Summary file not found: {path}")
+      raise SystemExit(2)
+
+  baseline, _ = load_data([paths[0]])
+  if not len(baseline):
+    print(f"No completed results found in {paths[0]}")
+    raise SystemExit(2)
+
+  comparisons: Dict[str, List[dict]] = {}
+  for path in paths[1:]:
+    candidate, _ = load_data([path])
+    name = path.parent.name if path.name in {"summary.json", "results.jsonl"} else path.stem
+    if name in comparisons:
+      name = str(path)
+    comparisons[name] = compare_runs(
+        baseline,
+        candidate,
+        threshold=args.threshold,
+        alpha=args.alpha,
+        resamples=max(100, args.resamples),
+        confidence=args.confidence,
+        seed=args.seed,
+    )
+    print_report(name, comparisons[name])
+
+  failures = [row for rows in comparisons.values() for row in rows if row["status"] == "FAIL"]
+  compared = sum(len(rows) for rows in comparisons.values())
+  gated = sum(1 for rows in comparisons.values() for row in rows if row["status"] != "INFO")
+
+  if compared:
+    chart_path = Path(args.chart).expanduser().resolve() if args.chart else paths[1].with_name("comparison.png")
+    build_comparison_chart(baseline, comparisons, chart_path, threshold=args.threshold)
+    print(f"\nSaved comparison chart to {chart_path}")
+
+  if args.report_json:
+    report_path = Path(args.report_json).expanduser().resolve()
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report = {
+        "baseline": str(paths[0]),
+        "threshold": args.threshold,
+        "alpha": args.alpha,
+        "confidence": args.confidence,
+        "result": "FAIL" if failures else "PASS",
+        "comparisons": comparisons,
+    }
+    report_path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Saved comparison report to {report_path}")
+
+  if not gated:
+    print("\nRESULT: no comparable cohorts")
+    raise SystemExit(2)
+  print(f"\nRESULT: {'FAIL' if failures else 'PASS'} ({len(failures)} regressed of {gated} gated comparisons)")
+  raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+  main()
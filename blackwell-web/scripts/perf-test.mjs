@@ -56,6 +56,7 @@ const RUN_STARTED_AT = new Date();
 const RUN_STAMP = RUN_STARTED_AT.toISOString().replace(/[:.]/g, "-");
 const OUTPUT_ROOT = path.resolve(PROJECT_ROOT, "tmp", "perf_outputs", RUN_STAMP);
 const SUMMARY_PATH = path.join(OUTPUT_ROOT, "summary.json");
+const RESULTS_STREAM_PATH = path.join(OUTPUT_ROOT, "results.jsonl");
 const LATEST_POINTER = path.resolve(PROJECT_ROOT, "tmp", "perf_outputs", "latest-run.txt");
 
 const BASE_IMAGE_DEFS = [
@@ -248,6 +249,7 @@ async function runCohort({
 
   const summaryLabel = `${kind} | ${label}`;
   console.log(`→ ${summaryLabel}`);
+  const startedAt = Date.now();
   const { finalPayload, totalMs, polls, jobId } = await runJob(payload, summaryLabel);
   const status = finalPayload.status ?? "UNKNOWN";
   const normalized = status.toUpperCase();
@@ -282,6 +284,7 @@ async function runCohort({
     imageLabel,
     imageIndex,
     outputPath,
+    startedAt,
   };
 
   console.log(
@@ -391,12 +394,12 @@ async function main() {
 
   const results = [];
   for (const descriptor of runDescriptors) {
+    let record;
     try {
-      const record = await runCohort(descriptor);
-      results.push(record);
+      record = await runCohort(descriptor);
     } catch (error) {
       console.error(`✖ Failed run for ${descriptor.label}:`, error);
-      results.push({
+      record = {
         ...descriptor,
         jobId: "n/a",
         status: "ERROR",
@@ -407,8 +410,11 @@ async function main() {
         queueMs: null,
         execMs: null,
         outputPath: null,
-      });
+      };
     }
+    results.push(record);
+    // Stream each sample as it lands so long runs can be plotted incrementally (plot_perf.py reads .jsonl).
+    await fs.appendFile(RESULTS_STREAM_PATH, `${JSON.stringify(record)}\n`);
   }
 
   const summaryRows = results.map((record) => ({
@@ -453,6 +459,7 @@ async function main() {
   await fs.mkdir(path.dirname(LATEST_POINTER), { recursive: true });
   await fs.writeFile(LATEST_POINTER, `${SUMMARY_PATH}\n`);
   console.log(`\nSummary saved to ${SUMMARY_PATH}`);
+  console.log(`Per-run results streamed to ${RESULTS_STREAM_PATH}`);
 }
 
 main().catch((error) => {
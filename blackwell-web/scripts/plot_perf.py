@@ -1,93 +1,341 @@
 #!/usr/bin/env python3
-"""Generate a visualization for Runpod turnaround benchmarks."""
+"""Generate a visualization for Runpod turnaround benchmarks.
+
+Accepts either the `summary.json` written by `perf-test.mjs` or a JSON-lines
+stream of result records (one `runCohort` result per line, e.g. the
+`results.jsonl` written next to the summary). JSON-lines input is parsed one
+line at a time into flat numeric columns, so runs with tens of thousands of
+samples never materialise as a list of dicts.
+"""
 
 from __future__ import annotations
 
+import argparse
 import json
-import sys
+from array import array
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional
 
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
+import matplotlib
 
+matplotlib.use("Agg")
 
-def load_data(summary_path: Path) -> dict:
-  with summary_path.open("r", encoding="utf-8") as handle:
-    return json.load(handle)
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+from matplotlib.lines import Line2D  # noqa: E402
 
+COLORS = {"Input": "#0ea5e9", "Output": "#22c55e"}
+FALLBACK_COLOR = "#64748b"
+STAGE_COLORS = {"queue": "#f59e0b", "execution": "#6366f1", "transfer": "#94a3b8"}
+PERCENTILES = (50, 95, 99)
+DEFAULT_MAX_POINTS = 2000
 
-def build_scatter_plot(summary: dict, output_path: Path) -> None:
-  results: List[dict] = summary.get("results", [])
-  aggregates: List[dict] = summary.get("aggregates", [])
-  cohort_order: List[str] = summary.get("cohortOrder") or []
-  images_per_cohort = summary.get("imagesPerCohort") or 1
 
-  cohort_labels: Dict[str, str] = {
-      entry["cohortKey"]: entry["cohortLabel"] for entry in aggregates if entry.get("cohortLabel")
-  }
-  positions: Dict[str, int] = {key: idx for idx, key in enumerate(cohort_order)}
+class ResultColumns:
+  """Columnar view of benchmark results, grouped by cohort."""
 
-  colors = {"Input": "#0ea5e9", "Output": "#22c55e"}
+  def __init__(self) -> None:
+    self.cohort_order: List[str] = []
+    self.cohort_labels: Dict[str, str] = {}
+    self.cohort_kinds: Dict[str, str] = {}
+    self._cohort_index: Dict[str, int] = {}
+    self._cohort = array("i")
+    self._image_index = array("d")
+    self._total = array("d")
+    self._queue = array("d")
+    self._exec = array("d")
+    self._started = array("d")
+    self.skipped = 0
 
-  fig, ax = plt.subplots(figsize=(14, 6))
+  def cohort_id(self, key: str) -> int:
+    idx = self._cohort_index.get(key)
+    if idx is None:
+      idx = len(self.cohort_order)
+      self._cohort_index[key] = idx
+      self.cohort_order.append(key)
+    return idx
 
-  for record in results:
-    total_ms = record.get("totalMs")
-    if total_ms is None:
-      continue
+  def append(self, record: dict) -> None:
+    total_ms = _as_float(record.get("totalMs"))
     cohort_key = record.get("cohortKey")
-    kind = record.get("kind", "Input")
-    idx = positions.get(cohort_key)
-    if idx is None:
+    if cohort_key is None or np.isnan(total_ms):
+      self.skipped += 1
+      return
+    idx = self.cohort_id(cohort_key)
+    if record.get("cohortLabel"):
+      self.cohort_labels.setdefault(cohort_key, record["cohortLabel"])
+    self.cohort_kinds.setdefault(cohort_key, record.get("kind", "Input"))
+    self._cohort.append(idx)
+    self._image_index.append(_as_float(record.get("imageIndex")))
+    self._total.append(total_ms)
+    self._queue.append(_as_float(record.get("queueMs")))
+    self._exec.append(_as_float(record.get("execMs")))
+    self._started.append(_as_float(record.get("startedAt")))
+
+  def finalize(self, preferred_order: Iterable[str] = ()) -> "ResultArrays":
+    # Re-map cohort ids so the plotting order follows `cohortOrder` when known.
+    order = [key for key in preferred_order if key in self._cohort_index]
+    order += [key for key in self.cohort_order if key not in order]
+    remap = np.empty(len(self.cohort_order), dtype=np.int32)
+    for position, key in enumerate(order):
+      remap[self._cohort_index[key]] = position
+    cohort = np.frombuffer(self._cohort, dtype=np.int32)
+    return ResultArrays(
+        cohort_order=order,
+        cohort_labels=self.cohort_labels,
+        cohort_kinds=self.cohort_kinds,
+        cohort=remap[cohort] if cohort.size else cohort,
+        image_index=np.frombuffer(self._image_index, dtype=np.float64),
+        total_ms=np.frombuffer(self._total, dtype=np.float64),
+        queue_ms=np.frombuffer(self._queue, dtype=np.float64),
+        exec_ms=np.frombuffer(self._exec, dtype=np.float64),
+        started_at=np.frombuffer(self._started, dtype=np.float64),
+    )
+
+
+class ResultArrays:
+  def __init__(
+      self,
+      *,
+      cohort_order: List[str],
+      cohort_labels: Dict[str, str],
+      cohort_kinds: Dict[str, str],
+      cohort: np.ndarray,
+      image_index: np.ndarray,
+      total_ms: np.ndarray,
+      queue_ms: np.ndarray,
+      exec_ms: np.ndarray,
+      started_at: np.ndarray,
+  ) -> None:
+    self.cohort_order = cohort_order
+    self.cohort_labels = cohort_labels
+    self.cohort_kinds = cohort_kinds
+    self.cohort = cohort
+    self.image_index = image_index
+    self.total_ms = total_ms
+    self.queue_ms = queue_ms
+    self.exec_ms = exec_ms
+    self.started_at = started_at
+
+  def __len__(self) -> int:
+    return int(self.total_ms.size)
+
+  def label(self, key: str) -> str:
+    return self.cohort_labels.get(key, key)
+
+  def kind(self, key: str) -> str:
+    return self.cohort_kinds.get(key, "Input")
+
+  def has_stages(self) -> bool:
+    return bool(np.any(~np.isnan(self.queue_ms) & ~np.isnan(self.exec_ms)))
+
+  def transfer_ms(self) -> np.ndarray:
+    """Whatever turnaround is not queue or execution: upload, polling and download."""
+    return np.clip(self.total_ms - np.nan_to_num(self.queue_ms) - np.nan_to_num(self.exec_ms), 0, None)
+
+  def groups(self) -> List[np.ndarray]:
+    """Row indices per cohort, in plotting order (one stable argsort, no per-row Python)."""
+    if not len(self):
+      return [np.empty(0, dtype=np.intp) for _ in self.cohort_order]
+    order = np.argsort(self.cohort, kind="stable")
+    bounds = np.searchsorted(self.cohort[order], np.arange(len(self.cohort_order) + 1))
+    return [order[bounds[i] : bounds[i + 1]] for i in range(len(self.cohort_order))]
+
+
+def _as_float(value) -> float:
+  if isinstance(value, bool) or value is None:
+    return float("nan")
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return float("nan")
+
+
+def open_source(source: Path) -> tuple[dict, Iterator[dict]]:
+  """Return `(summary_meta, records)` for a summary.json or a JSON-lines stream."""
+  if source.suffix != ".jsonl":
+    with source.open("r", encoding="utf-8") as handle:
+      head = handle.read(1)
+      while head and head.isspace():
+        head = handle.read(1)
+    if head == "{":
+      try:
+        with source.open("r", encoding="utf-8") as handle:
+          summary = json.load(handle)
+      except json.JSONDecodeError:
+        summary = None  # a JSON-lines stream of objects; fall through
+      if isinstance(summary, dict):
+        if "results" in summary:
+          return summary, iter(summary.get("results") or [])
+        return {}, iter([summary])
+  return {}, _iter_json_lines(source)
+
+
+def _iter_json_lines(source: Path) -> Iterator[dict]:
+  with source.open("r", encoding="utf-8") as handle:
+    for line in handle:
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        record = json.loads(line)
+      except json.JSONDecodeError:
+        continue
+      if isinstance(record, dict):
+        yield record
+
+
+def load_data(paths: Iterable[Path]) -> tuple[ResultArrays, dict]:
+  columns = ResultColumns()
+  meta: dict = {}
+  for path in paths:
+    summary, records = open_source(path)
+    for field in ("endpointId", "prompt", "cohortOrder"):
+      if summary.get(field) and not meta.get(field):
+        meta[field] = summary[field]
+    for record in records:
+      columns.append(record)
+  meta["skipped"] = columns.skipped
+  return columns.finalize(meta.get("cohortOrder") or ()), meta
+
+
+def compute_cohort_stats(data: ResultArrays) -> List[dict]:
+  stats: List[dict] = []
+  transfer = data.transfer_ms()
+  for key, rows in zip(data.cohort_order, data.groups()):
+    totals = data.total_ms[rows]
+    entry = {
+        "cohortKey": key,
+        "cohortLabel": data.label(key),
+        "kind": data.kind(key),
+        "runs": int(totals.size),
+    }
+    if totals.size:
+      p50, p95, p99 = np.percentile(totals, PERCENTILES)
+      entry.update(
+          avg_total_ms=float(totals.mean()),
+          p50_total_ms=float(p50),
+          p95_total_ms=float(p95),
+          p99_total_ms=float(p99),
+          throughput_per_min=_throughput_per_min(totals, data.started_at[rows]),
+      )
+      queue = data.queue_ms[rows]
+      execution = data.exec_ms[rows]
+      staged = ~np.isnan(queue) & ~np.isnan(execution)
+      if staged.any():
+        entry.update(
+            avg_queue_ms=float(queue[staged].mean()),
+            avg_exec_ms=float(execution[staged].mean()),
+            avg_transfer_ms=float(transfer[rows][staged].mean()),
+            p95_queue_ms=float(np.percentile(queue[staged], 95)),
+            p95_exec_ms=float(np.percentile(execution[staged], 95)),
+            p95_transfer_ms=float(np.percentile(transfer[rows][staged], 95)),
+        )
+    stats.append(entry)
+  return stats
+
+
+def _throughput_per_min(totals: np.ndarray, started_at: np.ndarray) -> float:
+  """Completed jobs per minute.
+
+  Uses the wall-clock span of the cohort when `startedAt` stamps exist (so
+  concurrent submissions count), otherwise assumes sequential submission.
+  """
+  stamped = ~np.isnan(started_at)
+  if stamped.sum() >= 2:
+    span_ms = float(np.max(started_at[stamped] + totals[stamped]) - np.min(started_at[stamped]))
+  else:
+    span_ms = float(totals.sum())
+  if span_ms <= 0:
+    return float("nan")
+  return totals.size * 60_000.0 / span_ms
+
+
+def _scatter_offsets(data: ResultArrays, rows: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+  image_index = data.image_index[rows]
+  known = ~np.isnan(image_index)
+  offsets = rng.uniform(-0.3, 0.3, size=rows.size)
+  if known.any():
+    span = max(float(np.nanmax(image_index)), 1.0)
+    offsets[known] = (image_index[known] / span - 0.5) * 0.5
+  return offsets
+
+
+def build_scatter_plot(
+    data: ResultArrays,
+    stats: List[dict],
+    meta: dict,
+    output_path: Path,
+    *,
+    max_points: int = DEFAULT_MAX_POINTS,
+) -> None:
+  rng = np.random.default_rng(0)
+  fig, ax = plt.subplots(figsize=(14, 6))
+
+  groups = data.groups()
+  violin_positions = [idx for idx, rows in enumerate(groups) if rows.size >= 2]
+  if violin_positions:
+    parts = ax.violinplot(
+        [data.total_ms[groups[idx]] / 1000 for idx in violin_positions],
+        positions=violin_positions,
+        widths=0.8,
+        showextrema=False,
+    )
+    for idx, body in zip(violin_positions, parts["bodies"]):
+      body.set_facecolor(COLORS.get(data.kind(data.cohort_order[idx]), FALLBACK_COLOR))
+      body.set_edgecolor("none")
+      body.set_alpha(0.18)
+
+  # One scatter call per kind; each cohort contributes at most `max_points` samples.
+  by_kind: Dict[str, List[tuple[np.ndarray, np.ndarray]]] = {}
+  for idx, rows in enumerate(groups):
+    if not rows.size:
       continue
-    image_index = record.get("imageIndex", 0)
-    jitter = (image_index - (images_per_cohort - 1) / 2) * 0.12
+    if rows.size > max_points:
+      rows = rng.choice(rows, size=max_points, replace=False)
+    xs = idx + _scatter_offsets(data, rows, rng)
+    ys = data.total_ms[rows] / 1000
+    by_kind.setdefault(data.kind(data.cohort_order[idx]), []).append((xs, ys))
+  for kind, chunks in by_kind.items():
     ax.scatter(
-        idx + jitter,
-        total_ms / 1000,
-        color=colors.get(kind, "#64748b"),
-        s=60,
+        np.concatenate([xs for xs, _ in chunks]),
+        np.concatenate([ys for _, ys in chunks]),
+        color=COLORS.get(kind, FALLBACK_COLOR),
+        s=14 if len(data) > 5000 else 60,
         edgecolors="white",
-        linewidths=0.5,
-        alpha=0.9,
+        linewidths=0.3 if len(data) > 5000 else 0.5,
+        alpha=0.5 if len(data) > 5000 else 0.9,
+        rasterized=len(data) > 5000,
     )
 
-  for entry in aggregates:
-    avg_ms = entry.get("avg_total_ms")
-    if avg_ms is None:
-      continue
-    idx = positions.get(entry.get("cohortKey"))
-    if idx is None:
-      continue
-    kind = entry.get("kind", "Input")
-    ax.hlines(
-        avg_ms / 1000,
-        idx - 0.25,
-        idx + 0.25,
-        colors=colors.get(kind, "#1f2937"),
-        linewidth=2.0,
-      )
+  marker_styles = (("p50_total_ms", "-", 2.0), ("p95_total_ms", "--", 1.4), ("p99_total_ms", ":", 1.4))
+  for idx, entry in enumerate(stats):
+    color = COLORS.get(entry["kind"], "#1f2937")
+    for field, style, width in marker_styles:
+      value = entry.get(field)
+      if value is None:
+        continue
+      ax.hlines(value / 1000, idx - 0.3, idx + 0.3, colors=color, linestyles=style, linewidth=width)
 
-  xticks = [positions[key] for key in cohort_order if key in positions]
-  labels = [cohort_labels.get(key, key) for key in cohort_order if key in cohort_labels or key in positions]
-  ax.set_xticks(xticks, labels, rotation=20, ha="right")
+  ax.set_xticks(range(len(data.cohort_order)), [data.label(key) for key in data.cohort_order], rotation=20, ha="right")
   ax.set_ylabel("Total turnaround (seconds)")
   ax.set_title(
-      f"RunPod turnaround by cohort ({summary.get('endpointId', 'unknown endpoint')})",
+      f"RunPod turnaround by cohort ({meta.get('endpointId') or 'unknown endpoint'}, n={len(data)})",
       loc="left",
       fontsize=13,
   )
   ax.grid(axis="y", linestyle="--", alpha=0.25)
 
   legend_handles = [
-      Line2D([0], [0], marker="o", color="white", markerfacecolor=colors["Input"], label="Input cohorts", markersize=8),
-      Line2D([0], [0], marker="o", color="white", markerfacecolor=colors["Output"], label="Output cohorts", markersize=8),
-      Line2D([0], [0], color="#0f172a", linewidth=2, label="Cohort average"),
+      Line2D([0], [0], marker="o", color="white", markerfacecolor=COLORS["Input"], label="Input cohorts", markersize=8),
+      Line2D([0], [0], marker="o", color="white", markerfacecolor=COLORS["Output"], label="Output cohorts", markersize=8),
+      Line2D([0], [0], color="#0f172a", linewidth=2, label="p50"),
+      Line2D([0], [0], color="#0f172a", linewidth=1.4, linestyle="--", label="p95"),
+      Line2D([0], [0], color="#0f172a", linewidth=1.4, linestyle=":", label="p99"),
   ]
   ax.legend(handles=legend_handles, loc="upper left")
 
-  footer = f"Prompt: {summary.get('prompt', 'n/a')[:90]}..."
+  footer = f"Prompt: {(meta.get('prompt') or 'n/a')[:90]}..."
   ax.text(0.01, -0.18, footer, transform=ax.transAxes, fontsize=9, color="#475569")
 
   fig.tight_layout()
@@ -96,26 +344,117 @@ def build_scatter_plot(summary: dict, output_path: Path) -> None:
   plt.close(fig)
 
 
+def build_stage_plot(data: ResultArrays, stats: List[dict], output_path: Path) -> bool:
+  staged = [entry for entry in stats if "avg_queue_ms" in entry]
+  if not staged:
+    return False
+
+  positions = np.arange(len(staged))
+  stages = (
+      ("queue", "avg_queue_ms", "Queue (delayTime)"),
+      ("execution", "avg_exec_ms", "Execution (executionTime)"),
+      ("transfer", "avg_transfer_ms", "Transfer + polling"),
+  )
+  fig, ax = plt.subplots(figsize=(14, 6))
+  bottom = np.zeros(len(staged))
+  for stage, field, label in stages:
+    values = np.array([entry[field] for entry in staged]) / 1000
+    ax.bar(positions, values, bottom=bottom, color=STAGE_COLORS[stage], label=label, width=0.6)
+    bottom += values
+  p95 = np.array([entry["p95_total_ms"] for entry in staged]) / 1000
+  ax.scatter(positions, p95, marker="_", s=400, color="#0f172a", label="p95 total", zorder=3)
+
+  ax.set_xticks(positions, [entry["cohortLabel"] for entry in staged], rotation=20, ha="right")
+  ax.set_ylabel("Mean turnaround by stage (seconds)")
+  ax.set_title("Turnaround breakdown: queue / execution / transfer", loc="left", fontsize=13)
+  ax.grid(axis="y", linestyle="--", alpha=0.25)
+  ax.legend(loc="upper left")
+
+  fig.tight_layout()
+  output_path.parent.mkdir(parents=True, exist_ok=True)
+  fig.savefig(output_path, dpi=150, bbox_inches="tight")
+  plt.close(fig)
+  return True
+
+
+def print_stats_table(stats: List[dict]) -> None:
+  def fmt(entry: dict, field: str, scale: float = 1000.0) -> str:
+    value = entry.get(field)
+    if value is None or np.isnan(value):
+      return "—"
+    return f"{value / scale:.2f}"
+
+  header = f"{'cohort':<24} {'runs':>6} {'p50_s':>8} {'p95_s':>8} {'p99_s':>8} {'jobs/min':>9} {'queue_s':>8} {'exec_s':>8} {'xfer_s':>8}"
+  print(header)
+  print("-" * len(header))
+  for entry in stats:
+    print(
+        f"{entry['cohortLabel'][:24]:<24} {entry['runs']:>6} "
+        f"{fmt(entry, 'p50_total_ms'):>8} {fmt(entry, 'p95_total_ms'):>8} {fmt(entry, 'p99_total_ms'):>8} "
+        f"{fmt(entry, 'throughput_per_min', 1.0):>9} "
+        f"{fmt(entry, 'avg_queue_ms'):>8} {fmt(entry, 'avg_exec_ms'):>8} {fmt(entry, 'avg_transfer_ms'):>8}"
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("source", help="summary.json or results .jsonl stream")
+  parser.add_argument("output", nargs="?", help="output PNG (default: turnaround.png next to the source)")
+  parser.add_argument(
+      "--extra",
+      action="append",
+      default=[],
+      metavar="PATH",
+      help="additional summary/JSON-lines files to merge into the same cohorts",
+  )
+  parser.add_argument(
+      "--max-points",
+      type=int,
+      default=DEFAULT_MAX_POINTS,
+      help=f"cap on scatter points drawn per cohort (default {DEFAULT_MAX_POINTS}); stats use every sample",
+  )
+  parser.add_argument("--stats-json", metavar="PATH", help="also write the per-cohort statistics as JSON")
+  return parser.parse_args(argv)
+
+
 def main() -> None:
-  if len(sys.argv) < 2:
-    print("Usage: python scripts/plot_perf.py <summary.json> [output.png]")
-    raise SystemExit(1)
+  args = parse_args()
 
-  summary_path = Path(sys.argv[1]).expanduser().resolve()
-  if not summary_path.exists():
-    print(f"Summary file not found: {summary_path}")
-    raise SystemExit(1)
+  summary_path = Path(args.source).expanduser().resolve()
+  extra_paths = [Path(item).expanduser().resolve() for item in args.extra]
+  for path in [summary_path, *extra_paths]:
+    if not path.exists():
+      print(f"Summary file not found: {path}")
+      raise SystemExit(1)
 
-  if len(sys.argv) >= 3:
-    output_path = Path(sys.argv[2]).expanduser().resolve()
+  if args.output:
+    output_path = Path(args.output).expanduser().resolve()
   else:
     output_path = summary_path.with_name("turnaround.png")
 
-  summary = load_data(summary_path)
-  build_scatter_plot(summary, output_path)
+  data, meta = load_data([summary_path, *extra_paths])
+  if not len(data):
+    print(f"No completed results found in {summary_path}")
+    raise SystemExit(1)
+
+  stats = compute_cohort_stats(data)
+  print_stats_table(stats)
+  if meta["skipped"]:
+    print(f"Skipped {meta['skipped']} records without a turnaround time.")
+
+  build_scatter_plot(data, stats, meta, output_path, max_points=max(1, args.max_points))
   print(f"Saved visualization to {output_path}")
 
+  stages_path = output_path.with_name(f"{output_path.stem}-stages{output_path.suffix}")
+  if data.has_stages() and build_stage_plot(data, stats, stages_path):
+    print(f"Saved stage breakdown to {stages_path}")
+
+  if args.stats_json:
+    stats_path = Path(args.stats_json).expanduser().resolve()
+    stats_path.parent.mkdir(parents=True, exist_ok=True)
+    stats_path.write_text(json.dumps(stats, indent=2), encoding="utf-8")
+    print(f"Saved cohort statistics to {stats_path}")
+
 
 if __name__ == "__main__":
   main()
-
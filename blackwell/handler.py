@@ -1,19 +1,36 @@
 import asyncio
 import base64
+import binascii
 import copy
+import gc
+import hashlib
+import itertools
 import json
+import math
+import mmap
 import os
+import random
+import shutil
 import sys
 import time
 import uuid
 import importlib.util
 import re
+import struct
+import subprocess
 from importlib import import_module
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple, Union
 from urllib.parse import urlparse
 from urllib import request as urllib_request
 import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import runpod
 
@@ -38,6 +55,9 @@ os.environ.setdefault("COMFYUI_INPUT_PATH", f"{COMFY_ROOT}/input")
 os.environ.setdefault("COMFYUI_OUTPUT_PATH", f"{COMFY_ROOT}/output")
 
 WORKFLOW_NAME = "nunchaku-qwen-image-edit-2509-workflow.json"
+WORKFLOW_DIR = Path(os.environ.get("RUNPOD_WORKFLOW_DIR", f"{COMFY_ROOT}/workflows"))
+# Minimum seconds between hot-reload scans of WORKFLOW_DIR (0 rescans on every job).
+WORKFLOW_RELOAD_INTERVAL = float(os.environ.get("RUNPOD_WORKFLOW_RELOAD_INTERVAL", "5"))
 COMFY_INPUT = Path(os.environ["COMFYUI_INPUT_PATH"])
 COMFY_OUTPUT = Path(os.environ["COMFYUI_OUTPUT_PATH"])
 
@@ -66,9 +86,93 @@ STORAGE_REGION = (
 )
 STORAGE_FORCE_PATH_STYLE = os.environ.get("RUNPOD_STORAGE_FORCE_PATH_STYLE", "1")
 STORAGE_OUTPUT_PREFIX = os.environ.get("RUNPOD_STORAGE_OUTPUT_PREFIX", "outputs")
+STORAGE_INPUT_PREFIX = os.environ.get("RUNPOD_STORAGE_INPUT_PREFIX", "inputs")
+PRESIGN_EXPIRES = int(os.environ.get("RUNPOD_STORAGE_PRESIGN_EXPIRES", "3600"))
+PRESIGN_OUTPUTS = os.environ.get("RUNPOD_STORAGE_PRESIGN_OUTPUTS", "1")
 STORAGE_PUBLIC_BASE_URL = os.environ.get("RUNPOD_STORAGE_PUBLIC_BASE_URL", "").rstrip("/")
 INCLUDE_OUTPUT_BASE64 = os.environ.get("RUNPOD_INCLUDE_OUTPUT_BASE64", "1")
 UPLOAD_OUTPUTS = os.environ.get("RUNPOD_STORAGE_UPLOAD_OUTPUTS", "1")
+STORAGE_CACHE_DIR = Path(os.environ.get("RUNPOD_STORAGE_CACHE_DIR", "/tmp/runpod-storage-cache"))
+# Disk budget for cached storage objects; 0 disables the cache.
+STORAGE_CACHE_BYTES = int(os.environ.get("RUNPOD_STORAGE_CACHE_BYTES", str(2 * 1024 * 1024 * 1024)))
+OUTPUT_WORKERS = max(1, int(os.environ.get("RUNPOD_OUTPUT_WORKERS", "4")))
+# Multiple of 3 so every chunk encodes to base64 without padding.
+BASE64_CHUNK_BYTES = 3 * 256 * 1024
+# Multiple of 4 so every slice of a base64 payload decodes on its own.
+BASE64_DECODE_CHUNK_CHARS = 4 * 256 * 1024
+# Longest `data:<mime>;base64,` header searched for the comma.
+DATA_URI_PROBE_CHARS = 1024
+INPUT_PROBE_BYTES = 64 * 1024
+BASE64_TEXT_RE = re.compile(r"[A-Za-z0-9+/]+={0,2}")
+RESIZE_INPUTS = os.environ.get("RUNPOD_RESIZE_INPUTS", "1")
+# 0 means "match the longest side of the requested width/height".
+INPUT_MAX_SIDE = int(os.environ.get("RUNPOD_INPUT_MAX_SIDE", "0"))
+INPUT_MAX_PIXELS = int(os.environ.get("RUNPOD_INPUT_MAX_PIXELS", str(64 * 1024 * 1024)))
+INPUT_WORKERS = max(1, int(os.environ.get("RUNPOD_INPUT_WORKERS", "2")))
+# Processes for base64 encode/decode and input resizing; 0 keeps that work on handler threads.
+CPU_PROCESSES = max(0, int(os.environ.get("RUNPOD_CPU_PROCESSES", "0")))
+# Below this size the IPC round trip costs more than the GIL time it saves.
+CPU_OFFLOAD_MIN_BYTES = 256 * 1024
+# Requests whose width * height * batch_size exceeds this switch to tiled VAE encode/decode.
+TILED_VAE_THRESHOLD = int(os.environ.get("RUNPOD_TILED_VAE_THRESHOLD", str(1536 * 1536)))
+VAE_TILE_SIZE = int(os.environ.get("RUNPOD_VAE_TILE_SIZE", "512"))
+VAE_TILE_OVERLAP = int(os.environ.get("RUNPOD_VAE_TILE_OVERLAP", "64"))
+COALESCE_REQUESTS = os.environ.get("RUNPOD_COALESCE_REQUESTS", "1")
+# Jobs a worker accepts at once; >1 overlaps input prep/packaging with execution and enables coalescing.
+MAX_CONCURRENCY = max(1, int(os.environ.get("RUNPOD_MAX_CONCURRENCY", "1")))
+RESOLUTION_BUCKETING = os.environ.get("RUNPOD_RESOLUTION_BUCKETING", "0")
+# Comma-separated WIDTHxHEIGHT list; empty uses the built-in aspect-ratio ladder.
+RESOLUTION_BUCKETS = os.environ.get("RUNPOD_RESOLUTION_BUCKETS", "")
+# How bucketed outputs get back to the requested size: crop, resize or none.
+BUCKET_RESTORE = os.environ.get("RUNPOD_BUCKET_RESTORE", "crop")
+# Buckets to run once at boot ("all" or a WIDTHxHEIGHT list); empty skips warmup.
+WARMUP_BUCKETS = os.environ.get("RUNPOD_WARMUP_BUCKETS", "")
+# One ComfyUI executor process per visible GPU, with the handler process routing jobs between them.
+MULTI_GPU = os.environ.get("RUNPOD_MULTI_GPU", "0")
+# Comma-separated device ids for multi-GPU mode; defaults to CUDA_VISIBLE_DEVICES or every GPU nvidia-smi lists.
+GPU_DEVICES = os.environ.get("RUNPOD_GPU_DEVICES", "")
+DEVICE_BASE_PORT = int(os.environ.get("RUNPOD_DEVICE_BASE_PORT", "8188"))
+# Jobs each device process runs at once (input prep and packaging overlap with sampling when > 1).
+DEVICE_CONCURRENCY = max(1, int(os.environ.get("RUNPOD_DEVICE_CONCURRENCY", "1")))
+# Extra in-flight jobs a device may carry over the least-loaded one to keep its models warm.
+AFFINITY_SLACK = int(os.environ.get("RUNPOD_AFFINITY_SLACK", "1"))
+MODEL_INDEX = os.environ.get("RUNPOD_MODEL_INDEX", "1")
+MODEL_INDEX_PATH = os.environ.get("RUNPOD_MODEL_INDEX_PATH", "/runpod-volume/.runpod-model-index.json")
+# Seconds between background index refreshes; the request path never scans model directories.
+MODEL_INDEX_REFRESH = float(os.environ.get("RUNPOD_MODEL_INDEX_REFRESH", "300"))
+EXTRA_MODEL_PATHS = os.environ.get("COMFYUI_EXTRA_MODEL_PATHS", f"{COMFY_ROOT}/extra_model_paths.yaml")
+MODEL_STAGING = os.environ.get("RUNPOD_MODEL_STAGING", "0")
+# Local NVMe (container disk) target for staged copies of the default models.
+STAGING_DIR = Path(os.environ.get("RUNPOD_STAGING_DIR", f"{COMFY_ROOT}/models/staged"))
+# Comma-separated `folder/name` entries; empty stages the DEFAULTS model, LoRA, CLIP and VAE.
+STAGING_MODELS = os.environ.get("RUNPOD_STAGING_MODELS", "")
+STAGING_WORKERS = int(os.environ.get("RUNPOD_STAGING_WORKERS", "3"))
+# Free space left on the staging disk after a copy, so outputs and inputs still fit.
+STAGING_RESERVE_BYTES = int(os.environ.get("RUNPOD_STAGING_RESERVE_GB", "5")) * 1024**3
+FUSED_LORA = os.environ.get("RUNPOD_FUSED_LORA", "0")
+# Registered as a diffusion_models folder; holds fused base+LoRA DiT checkpoints.
+FUSED_LORA_DIR = Path(os.environ.get("RUNPOD_FUSED_LORA_DIR", f"{COMFY_ROOT}/models/fused"))
+# Completed unfused jobs of one (model, LoRA, strength) before its fused checkpoint is built.
+FUSED_LORA_MIN_JOBS = int(os.environ.get("RUNPOD_FUSED_LORA_MIN_JOBS", "3"))
+FUSED_LORA_MAX = int(os.environ.get("RUNPOD_FUSED_LORA_MAX", "2"))
+# Jobs that may be fully prepared (inputs written, graph built) while another one holds the GPU.
+PIPELINE_DEPTH = max(0, int(os.environ.get("RUNPOD_PIPELINE_DEPTH", "1")))
+# off | observe (estimate and report ETAs) | reject | defer (hold until the ETA fits, then reject).
+ADMISSION = os.environ.get("RUNPOD_ADMISSION", "observe")
+# Completed jobs the cost model must have learned from before it may reject or defer anything.
+ADMISSION_MIN_SAMPLES = int(os.environ.get("RUNPOD_ADMISSION_MIN_SAMPLES", "8"))
+ADMISSION_MAX_DEFER = float(os.environ.get("RUNPOD_ADMISSION_MAX_DEFER", "60"))
+OOM_RETRY = os.environ.get("RUNPOD_OOM_RETRY", "1")
+# Seconds to wait for ComfyUI's prompt worker to drop its caches before a retry is queued.
+OOM_FREE_WAIT = float(os.environ.get("RUNPOD_OOM_FREE_WAIT", "15"))
+# Clean successes at a remembered profile before probing one level lighter again; 0 never steps down.
+OOM_DECAY_SUCCESSES = int(os.environ.get("RUNPOD_OOM_DECAY_SUCCESSES", "20"))
+# JSON-lines file that receives one sanitised trace record per job; empty disables tracing.
+TRACE_PATH = os.environ.get("RUNPOD_TRACE_PATH", "")
+TRACE_SAMPLE_RATE = float(os.environ.get("RUNPOD_TRACE_SAMPLE_RATE", "1"))
+TRACE_PROMPTS = os.environ.get("RUNPOD_TRACE_PROMPTS", "0")
+# The VAE downsamples 8x and the DiT patchifies 2x2 latents, so sides snap to multiples of 16.
+LATENT_ALIGNMENT = 16
 
 def _strtobool(value: Optional[str], *, default: bool = True) -> bool:
     if value is None:
@@ -80,6 +184,10 @@ STORAGE_ENABLED = (
 )
 
 _storage_client = None
+_output_executor: Optional[ThreadPoolExecutor] = None
+_input_executor: Optional[ThreadPoolExecutor] = None
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_cpu_pool_lock = threading.Lock()
 
 PromptServer = None  # type: ignore
 comfy = None  # type: ignore
@@ -89,7 +197,8 @@ server_start_future = None
 server_thread = None
 server_boot_error: Optional[BaseException] = None
 server_ready_event = threading.Event()
-workflow_template = None
+_comfy_init_lock = threading.Lock()
+workflow_registry = None
 
 DEFAULTS = {
     "model_name": "svdq-fp4_r128-qwen-image-edit-2509-lightningv2.0-4steps.safetensors",
@@ -298,10 +407,179 @@ def derive_public_url(object_key: str) -> Optional[str]:
     return f"{base}/{object_key.lstrip('/')}"
 
 
-def download_storage_object(object_key: str) -> bytes:
+class StorageObjectCache:
+    """LRU disk cache for storage objects, revalidated with `If-None-Match`.
+
+    Every hit still issues a conditional GET so an overwritten key is never
+    served stale; an unchanged object costs a 304 with no body. Entries are
+    a data file plus a JSON sidecar holding the key and ETag, so the index
+    survives worker restarts on the same disk.
+    """
+
+    CHUNK_BYTES = 1024 * 1024
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load_index()
+
+    def _paths(self, bucket: str, object_key: str) -> Tuple[Path, Path]:
+        digest = hashlib.sha256(f"{bucket}/{object_key}".encode("utf-8")).hexdigest()
+        return self.directory / f"{digest}.bin", self.directory / f"{digest}.json"
+
+    def _load_index(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        found = []
+        for meta_path in self.directory.glob("*.json"):
+            data_path = meta_path.with_suffix(".bin")
+            try:
+                meta = json.loads(meta_path.read_text(encoding="utf-8"))
+                stat = data_path.stat()
+                cache_key = f"{meta['bucket']}/{meta['key']}"
+            except (OSError, ValueError, KeyError, TypeError):
+                # Unreadable, truncated or foreign sidecar: treat the entry as corrupt.
+                meta_path.unlink(missing_ok=True)
+                data_path.unlink(missing_ok=True)
+                continue
+            found.append((stat.st_mtime, cache_key, {**meta, "size": stat.st_size}))
+        for _, cache_key, meta in sorted(found, key=lambda item: item[0]):
+            self._entries[cache_key] = meta
+            self._bytes += meta["size"]
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._entries:
+            cache_key, meta = self._entries.popitem(last=False)
+            self._bytes -= meta["size"]
+            data_path, meta_path = self._paths(meta["bucket"], meta["key"])
+            data_path.unlink(missing_ok=True)
+            meta_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _link_or_open(data_path: Path, target_path: Path):
+        """Hardlink a cached file to `target_path` (caller holds the lock).
+
+        Returns None when linked, else an open handle to copy from after the lock
+        is released; the handle keeps the data readable even if it is evicted.
+        """
+        try:
+            os.link(data_path, target_path)
+            return None
+        except OSError:
+            return open(data_path, "rb")
+
+    @staticmethod
+    def _copy_out(handle, target_path: Path) -> None:
+        with handle, open(target_path, "wb") as output:
+            shutil.copyfileobj(handle, output, StorageObjectCache.CHUNK_BYTES)
+
+    def fetch_to(self, client, bucket: str, object_key: str, target_path: Path) -> int:
+        """Write the object to `target_path` (hardlinked from the cache when possible); returns its size.
+
+        Consumers only ever replace input files (write-then-rename), so a link
+        never lets them modify the cached copy.
+        """
+        cache_key = f"{bucket}/{object_key}"
+        data_path, meta_path = self._paths(bucket, object_key)
+        with self._lock:
+            cached = self._entries.get(cache_key)
+        request = {"Bucket": bucket, "Key": object_key}
+        if cached and cached.get("etag"):
+            request["IfNoneMatch"] = cached["etag"]
+        try:
+            response = client.get_object(**request)
+        except ClientError as exc:
+            status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode")  # type: ignore[attr-defined]
+            code = exc.response.get("Error", {}).get("Code")  # type: ignore[attr-defined]
+            if not (cached and (status == 304 or code in ("304", "NotModified"))):
+                raise
+            served = False
+            with self._lock:
+                entry = self._entries.get(cache_key)
+                if entry is not None:
+                    try:
+                        handle = self._link_or_open(data_path, target_path)
+                        served = True
+                    except OSError:
+                        pass
+                if served:
+                    self._entries.move_to_end(cache_key)
+                    self.hits += 1
+            if served:
+                if handle is not None:
+                    self._copy_out(handle, target_path)
+                try:
+                    # Recency for the LRU order rebuilt at the next start; a race with eviction is harmless.
+                    os.utime(data_path)
+                except OSError:
+                    pass
+                return entry["size"]
+            # Evicted or unreadable since the lookup: download it again.
+            response = client.get_object(Bucket=bucket, Key=object_key)
+
+        # Stream the body to a temp file next to the entry, then publish it atomically.
+        temp_path = data_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        size = 0
+        body = response["Body"]
+        try:
+            with open(temp_path, "wb") as handle:
+                for chunk in iter(lambda: body.read(self.CHUNK_BYTES), b""):
+                    handle.write(chunk)
+                    size += len(chunk)
+            if size > self.max_bytes:
+                # Too large to cache: hand the download over as is.
+                shutil.move(str(temp_path), str(target_path))
+                return size
+            meta = {"bucket": bucket, "key": object_key, "etag": response.get("ETag"), "size": size}
+            with self._lock:
+                os.replace(temp_path, data_path)
+                meta_path.write_text(json.dumps(meta), encoding="utf-8")
+                previous = self._entries.pop(cache_key, None)
+                if previous:
+                    self._bytes -= previous["size"]
+                self._entries[cache_key] = meta
+                self._bytes += size
+                self.misses += 1
+                self._evict()
+                handle = self._link_or_open(data_path, target_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+        if handle is not None:
+            self._copy_out(handle, target_path)
+        return size
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+_storage_cache: Optional[StorageObjectCache] = None
+
+
+def get_storage_cache() -> Optional[StorageObjectCache]:
+    global _storage_cache
+    if STORAGE_CACHE_BYTES <= 0:
+        return None
+    if _storage_cache is None:
+        _storage_cache = StorageObjectCache(STORAGE_CACHE_DIR, STORAGE_CACHE_BYTES)
+    return _storage_cache
+
+
+def download_storage_object(object_key: str, target_path: Path) -> int:
+    """Stream a storage object into `target_path` through the disk cache; returns its size."""
     client = get_storage_client()
+    cache = get_storage_cache()
+    if cache is not None:
+        return cache.fetch_to(client, STORAGE_BUCKET, object_key, target_path)
     response = client.get_object(Bucket=STORAGE_BUCKET, Key=object_key)
-    return response["Body"].read()
+    with open(target_path, "wb") as handle:
+        shutil.copyfileobj(response["Body"], handle, StorageObjectCache.CHUNK_BYTES)
+    return target_path.stat().st_size
 
 
 def upload_storage_object(
@@ -322,12 +600,103 @@ def upload_storage_object(
     return key
 
 
+def presign_storage_url(
+    method: str,
+    object_key: str,
+    *,
+    expires: int = PRESIGN_EXPIRES,
+    content_type: Optional[str] = None,
+) -> str:
+    """Presigned GET/PUT URL so clients move image bytes straight to/from the bucket."""
+    client = get_storage_client()
+    params = {"Bucket": STORAGE_BUCKET, "Key": object_key}
+    if content_type and method == "put_object":
+        params["ContentType"] = content_type
+    return client.generate_presigned_url(method, Params=params, ExpiresIn=expires)
+
+
+def presign_input_uploads(job_input, job_id: Optional[str]) -> dict:
+    """Handle `action: presign_upload`: hand out input keys plus PUT URLs, no GPU work."""
+    if not storage_available():
+        return {"error": "RunPod storage is not configured."}
+    count = int(job_input.get("count", 1))
+    if not 1 <= count <= 16:
+        return {"error": "count must be between 1 and 16."}
+    content_type = _clean_str(job_input.get("content_type")) or "image/png"
+    expires = min(int(job_input.get("expires", PRESIGN_EXPIRES)), 7 * 24 * 3600)
+    extension = {"image/jpeg": ".jpg", "image/webp": ".webp"}.get(content_type, ".png")
+    prefix = f"{STORAGE_INPUT_PREFIX.rstrip('/')}/{job_id or uuid.uuid4().hex}"
+    uploads = []
+    for _ in range(count):
+        object_key = f"{prefix}/{uuid.uuid4().hex}{extension}"
+        uploads.append(
+            {
+                "object_key": object_key,
+                "upload_url": presign_storage_url(
+                    "put_object", object_key, expires=expires, content_type=content_type
+                ),
+                "content_type": content_type,
+            }
+        )
+    return {"uploads": uploads, "expires_in": expires}
+
+
 def download_http_resource(url: str, *, timeout: float = 30.0) -> bytes:
     request = urllib_request.Request(url, method="GET")
     with urllib_request.urlopen(request, timeout=timeout) as response:
         return response.read()
 
 
+def encode_file_base64(file_path: Path) -> str:
+    """Base64-encode a file chunk by chunk.
+
+    The raw bytes are never held in full, but the encoded chunks and the joined
+    string coexist briefly, so peak memory is about twice the encoded size.
+    """
+    parts: list[str] = []
+    with open(file_path, "rb") as handle:
+        while True:
+            chunk = handle.read(BASE64_CHUNK_BYTES)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+def get_output_executor() -> ThreadPoolExecutor:
+    global _output_executor
+    if _output_executor is None:
+        _output_executor = ThreadPoolExecutor(max_workers=OUTPUT_WORKERS, thread_name_prefix="output")
+    return _output_executor
+
+
+def get_input_executor() -> ThreadPoolExecutor:
+    global _input_executor
+    if _input_executor is None:
+        _input_executor = ThreadPoolExecutor(max_workers=INPUT_WORKERS, thread_name_prefix="input")
+    return _input_executor
+
+
+def get_cpu_pool() -> Optional[ProcessPoolExecutor]:
+    """Process pool for GIL-heavy per-job work, so it can't stall ComfyUI's executor thread."""
+    global _cpu_pool
+    if CPU_PROCESSES <= 0:
+        return None
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            # spawn: the parent holds CUDA state and live threads, which fork would copy.
+            _cpu_pool = ProcessPoolExecutor(
+                max_workers=CPU_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+    return _cpu_pool
+
+
+def resolve_output_path(image_info: dict) -> Path:
+    filename = image_info["filename"]
+    subfolder = image_info.get("subfolder", "")
+    return COMFY_OUTPUT / subfolder / filename if subfolder else COMFY_OUTPUT / filename
+
+
 class TimelineLogger:
     """Utility to emit per-request timeline markers to stdout."""
 
@@ -335,6 +704,10 @@ class TimelineLogger:
         self.start = time.perf_counter()
         self.job_id = job_id or ""
         self._seen: set[str] = set()
+        # (label, seconds since start) for every emitted marker, consumed by the trace recorder.
+        self.events: list[Tuple[str, float]] = []
+        # GPU seconds of the prompt that produced the outputs, from ComfyUI's status timestamps.
+        self.execution_s: Optional[float] = None
 
     def mark(self, label: str, *, key: Optional[str] = None, dedupe: bool = True) -> None:
         label = (label or "").strip()
@@ -346,6 +719,7 @@ class TimelineLogger:
         if dedupe and dedupe_key:
             self._seen.add(dedupe_key)
         elapsed = time.perf_counter() - self.start
+        self.events.append((label, elapsed))
         prefix = f"[{elapsed:0.3f}]"
         job_tag = f" ({self.job_id})" if self.job_id else ""
         print(f"{prefix}{job_tag} {label}", flush=True)
@@ -390,6 +764,72 @@ def wait_for_cuda(timeout: float = 120.0, poll: float = 2.0) -> None:
     raise RuntimeError("Timed out waiting for CUDA device") from last_exc
 
 
+def reset_peak_vram() -> None:
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_vram_mib() -> Optional[float]:
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return torch.cuda.max_memory_allocated() / (1024 * 1024)
+
+
+_prompt_peaks: "OrderedDict[str, float]" = OrderedDict()
+_prompt_peaks_lock = threading.Lock()
+
+
+def install_vram_tracking(prompt_queue) -> None:
+    """Measure each prompt's CUDA peak on ComfyUI's prompt worker thread.
+
+    The handler admits the next prompt while one is still running, so a reset
+    from the handler side would clear the running prompt's peak. The worker
+    calls `get()` right before executing a prompt and `task_done()` right
+    after (before its outputs appear in the history), so the peak is reset and
+    read there, exactly around one prompt.
+    """
+    get = getattr(prompt_queue, "get", None)
+    task_done = getattr(prompt_queue, "task_done", None)
+    if get is None or task_done is None or getattr(prompt_queue, "_vram_tracking", False):
+        return
+    running: dict = {}
+
+    def tracked_get(*args, **kwargs):
+        queued = get(*args, **kwargs)
+        if queued is not None:
+            item, item_id = queued
+            running[item_id] = item[1]
+            try:
+                reset_peak_vram()
+            except Exception:
+                pass
+        return queued
+
+    def tracked_task_done(item_id, *args, **kwargs):
+        prompt_id = running.pop(item_id, None)
+        try:
+            peak = peak_vram_mib()
+        except Exception:
+            peak = None
+        if prompt_id is not None and peak is not None:
+            with _prompt_peaks_lock:
+                _prompt_peaks[prompt_id] = peak
+                while len(_prompt_peaks) > 256:
+                    _prompt_peaks.popitem(last=False)
+        return task_done(item_id, *args, **kwargs)
+
+    prompt_queue.get = tracked_get
+    prompt_queue.task_done = tracked_task_done
+    prompt_queue._vram_tracking = True
+
+
+def prompt_peak_vram_mib(prompt_id: str) -> Optional[float]:
+    with _prompt_peaks_lock:
+        return _prompt_peaks.pop(prompt_id, None)
+
+
 def _start_comfy_background_server() -> None:
     global server_thread, server_event_loop, server_start_future, server, server_boot_error  # type: ignore
 
@@ -420,14 +860,6 @@ def _start_comfy_background_server() -> None:
     server_thread.start()
 
 
-def load_workflow_template(filename: str):
-    workflow_path = Path(COMFY_ROOT) / "workflows" / filename
-    if not workflow_path.exists():
-        raise FileNotFoundError(f"Workflow file not found at {workflow_path}")
-    with workflow_path.open("r", encoding="utf-8") as handle:
-        return json.load(handle)
-
-
 def _force_load_package(name: str, package_dir: Path) -> None:
     """Load a ComfyUI package from disk and register it in sys.modules."""
     init_path = package_dir / "__init__.py"
@@ -460,32 +892,49 @@ def _load_comfy_utils() -> None:
 
 
 def ensure_comfy_ready() -> None:
-    global server, workflow_template, PromptServer, comfy, server_event_loop, server_start_future, server_thread, server_boot_error  # type: ignore
+    global server, workflow_registry, PromptServer, comfy, server_event_loop, server_start_future, server_thread, server_boot_error  # type: ignore
 
-    if server is not None:
+    if server is not None and workflow_registry is not None:
         return
 
-    if comfy is None or PromptServer is None:
-        wait_for_cuda()
-        if "utils" in sys.modules and not getattr(sys.modules["utils"], "__path__", None):
-            del sys.modules["utils"]
-        _load_comfy_utils()
-        import comfy as comfy_mod  # noqa: E402
-        from server import PromptServer as PromptServerCls  # noqa: E402
-
-        comfy = comfy_mod  # type: ignore
-        PromptServer = PromptServerCls  # type: ignore
-
-    if server is None:
-        _start_comfy_background_server()
-        server_ready_event.wait(timeout=120)
-        if server_boot_error is not None:
-            raise RuntimeError("Failed to start ComfyUI server") from server_boot_error
+    with _comfy_init_lock:
+        if server is not None and workflow_registry is not None:
+            return
+
+        if comfy is None or PromptServer is None:
+            wait_for_cuda()
+            if "utils" in sys.modules and not getattr(sys.modules["utils"], "__path__", None):
+                del sys.modules["utils"]
+            _load_comfy_utils()
+            import comfy as comfy_mod  # noqa: E402
+            from server import PromptServer as PromptServerCls  # noqa: E402
+
+            comfy = comfy_mod  # type: ignore
+            PromptServer = PromptServerCls  # type: ignore
+
         if server is None:
-            raise RuntimeError("ComfyUI server failed to initialize")
+            _start_comfy_background_server()
+            server_ready_event.wait(timeout=120)
+            if server_boot_error is not None:
+                raise RuntimeError("Failed to start ComfyUI server") from server_boot_error
+            if server is None:
+                raise RuntimeError("ComfyUI server failed to initialize")
+
+        install_vram_tracking(server.prompt_queue)
+        register_staging_paths()
+        fused_cache = get_fused_lora_cache()
+        if fused_cache is not None:
+            fused_cache.register()
+        index = get_model_index()
+        if index is not None:
+            install_model_index_hooks(index)
+
+        if workflow_registry is None:
+            registry = WorkflowRegistry(WORKFLOW_DIR, default_name=WORKFLOW_NAME)
+            registry.refresh(force=True)
+            workflow_registry = registry
+
 
-    template = load_workflow_template(WORKFLOW_NAME)
-    workflow_template = template
 def find_nodes(workflow):
     nodes = {}
     for node_id, node in workflow.items():
@@ -504,6 +953,10 @@ def find_nodes(workflow):
             nodes["sampler"] = node_id
         elif node_type == "ModelSamplingAuraFlow":
             nodes["sampling_wrapper"] = node_id
+        elif node_type in ("VAEDecode", "VAEDecodeTiled"):
+            nodes["vae_decode"] = node_id
+        elif node_type in ("VAEEncode", "VAEEncodeTiled"):
+            nodes["vae_encode"] = node_id
         elif node_type == "SaveImage":
             nodes["save_image"] = node_id
         elif node_type == "LoadImage":
@@ -515,286 +968,1973 @@ def find_nodes(workflow):
             prompt_value = node["inputs"].get("prompt", "")
             key = "positive" if prompt_value.strip() else "negative"
             nodes[key] = node_id
-    required = [
-        "model_loader",
-        "lora_loader",
-        "clip_loader",
-        "vae_loader",
-        "latent",
-        "sampler",
-        "sampling_wrapper",
-        "save_image",
-        "load_image",
-        "positive",
-        "negative",
-    ]
-    missing = [item for item in required if item not in nodes]
+    missing = [item for item in REQUIRED_ROLES if item not in nodes]
     if missing:
         raise RuntimeError(f"Missing nodes in workflow: {', '.join(missing)}")
     return nodes
 
 
-def prepare_image(
-    job_input,
-    *,
-    base64_key: str = "image_base64",
-    object_key: str = "image_object_key",
-    url_key: str = "image_url",
-    name_key: str = "image_name",
-    default_name: Optional[str] = None,
-    fallback_base64: Optional[str] = None,
-    timeline: Optional[TimelineLogger] = None,
-):
-    def decode_payload(payload: str) -> bytes:
-        try:
-            return base64.b64decode(payload, validate=True)
-        except Exception as exc:
-            raise ValueError(f"Invalid base64 payload: {exc}") from exc
+REQUIRED_ROLES = (
+    "model_loader",
+    "clip_loader",
+    "vae_loader",
+    "latent",
+    "sampler",
+    "save_image",
+    "load_image",
+    "positive",
+    "negative",
+)
+# Roles a lighter template may leave out; build_prompt skips their inputs.
+OPTIONAL_ROLES = ("lora_loader", "sampling_wrapper", "background_load_image", "vae_decode", "vae_encode")
 
-    def log(message: str) -> None:
-        if timeline:
-            timeline.mark(message)
 
-    image_name = job_input.get(name_key) or default_name or DEFAULTS["image_name"]
-    image_bytes: Optional[bytes] = None
-    created = False
+def validate_workflow(workflow) -> dict[str, str]:
+    """Check an API-format workflow is well formed and return its role map."""
+    if not isinstance(workflow, dict) or not workflow:
+        raise ValueError("workflow must be a non-empty object keyed by node id")
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str):
+            raise ValueError(f"node {node_id} has no class_type")
+        inputs = node.get("inputs")
+        if not isinstance(inputs, dict):
+            raise ValueError(f"node {node_id} has no inputs object")
+        for key, value in inputs.items():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                if str(value[0]) not in workflow:
+                    raise ValueError(f"node {node_id} input {key} links to missing node {value[0]}")
+    return find_nodes(workflow)
 
-    storage_key = job_input.get(object_key)
-    if storage_key and image_bytes is None:
-        if not storage_available():
-            raise RuntimeError("Storage key provided but RunPod storage is not configured.")
-        log(f"Downloading input image from storage ({storage_key})")
-        image_bytes = download_storage_object(storage_key)
-        if not job_input.get(name_key):
-            image_name = Path(storage_key).name or f"{uuid.uuid4().hex}.png"
 
-    image_url = job_input.get(url_key)
-    if image_bytes is None and image_url:
-        log("Downloading input image from URL")
+class WorkflowTemplate:
+    def __init__(self, name: str, path: Path, mtime_ns: int, workflow: dict, nodes: dict[str, str]) -> None:
+        self.name = name
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.workflow = workflow
+        self.nodes = nodes
+
+
+class WorkflowRegistry:
+    """Every workflow JSON in a directory, validated and compiled to a role map.
+
+    Files are re-scanned at most every `reload_interval` seconds; changed files
+    are reloaded in place and a file that fails validation keeps serving its
+    last good version.
+    """
+
+    def __init__(self, directory: Path, *, default_name: str, reload_interval: float = WORKFLOW_RELOAD_INTERVAL) -> None:
+        self.directory = directory
+        self.default_name = default_name
+        self.reload_interval = reload_interval
+        self._templates: dict[str, WorkflowTemplate] = {}
+        self._errors: dict[str, str] = {}
+        self._last_scan = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        name = Path(str(name).strip()).name
+        return name if name.endswith(".json") else f"{name}.json"
+
+    def names(self) -> list[str]:
+        return sorted(self._templates)
+
+    def refresh(self, *, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_scan < self.reload_interval:
+                return
+            self._last_scan = now
+            seen: set[str] = set()
+            for entry in sorted(self.directory.glob("*.json")):
+                name = entry.name
+                seen.add(name)
+                try:
+                    mtime_ns = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+                current = self._templates.get(name)
+                if current is not None and current.mtime_ns == mtime_ns:
+                    continue
+                try:
+                    with entry.open("r", encoding="utf-8") as handle:
+                        workflow = json.load(handle)
+                    nodes = validate_workflow(workflow)
+                except Exception as exc:
+                    if self._errors.get(name) != str(exc):
+                        print(f"Skipping workflow {name}: {exc}", flush=True)
+                    self._errors[name] = str(exc)
+                    continue
+                self._errors.pop(name, None)
+                self._templates[name] = WorkflowTemplate(name, entry, mtime_ns, workflow, nodes)
+                print(f"{'Reloaded' if current else 'Loaded'} workflow {name}", flush=True)
+            for name in list(self._templates):
+                if name not in seen and name != self.default_name:
+                    del self._templates[name]
+                    print(f"Unloaded workflow {name}", flush=True)
+            if self.default_name not in self._templates:
+                detail = self._errors.get(self.default_name) or "file not found"
+                raise FileNotFoundError(
+                    f"Default workflow {self.default_name} unavailable in {self.directory}: {detail}"
+                )
+
+    def get(self, name: Optional[str] = None) -> WorkflowTemplate:
+        self.refresh()
+        key = self.normalize_name(name) if name else self.default_name
+        template = self._templates.get(key)
+        if template is None:
+            raise ValueError(f"Unknown workflow '{name}'. Available: {', '.join(self.names())}")
+        return template
+
+
+# Mirrors ComfyUI's folder_paths.supported_pt_extensions.
+MODEL_EXTENSIONS = {".ckpt", ".pt", ".pt2", ".bin", ".pth", ".safetensors", ".pkl", ".sft"}
+LEGACY_MODEL_FOLDERS = {"clip": "text_encoders", "unet": "diffusion_models"}
+INDEXED_MODEL_FOLDERS = ("diffusion_models", "checkpoints", "text_encoders", "vae", "loras")
+# (request field, workflow role that consumes it, model folder it names a file in)
+MODEL_FIELDS = (
+    ("model_name", "model_loader", "diffusion_models"),
+    ("lora_name", "lora_loader", "loras"),
+    ("clip_name", "clip_loader", "text_encoders"),
+    ("vae_name", "vae_loader", "vae"),
+)
+QUICK_HASH_BYTES = 1024 * 1024
+
+
+def load_model_roots(config_path: str) -> dict[str, list[Tuple[Path, set]]]:
+    """Model folders -> search roots, parsed the way ComfyUI reads extra_model_paths.yaml."""
+    roots: dict[str, list[Tuple[Path, set]]] = {
+        folder: [(Path(COMFY_ROOT) / "models" / folder, MODEL_EXTENSIONS)] for folder in INDEXED_MODEL_FOLDERS
+    }
+    if not config_path or not os.path.exists(config_path):
+        return roots
+    import yaml
+
+    with open(config_path, "r", encoding="utf-8") as handle:
+        config = yaml.safe_load(handle) or {}
+    for section in config.values():
+        if not isinstance(section, dict):
+            continue
+        section = dict(section)
+        base_path = section.pop("base_path", None)
+        if base_path:
+            base_path = os.path.expandvars(os.path.expanduser(base_path))
+            if not os.path.isabs(base_path):
+                base_path = os.path.abspath(os.path.join(os.path.dirname(config_path), base_path))
+        is_default = bool(section.pop("is_default", False))
+        for folder, value in section.items():
+            folder = LEGACY_MODEL_FOLDERS.get(folder, folder)
+            if folder not in roots:
+                continue
+            for line in str(value).split("\n"):
+                line = line.strip()
+                if not line:
+                    continue
+                path = Path(os.path.join(base_path, line) if base_path else line)
+                if is_default:
+                    roots[folder].insert(0, (path, MODEL_EXTENSIONS))
+                else:
+                    roots[folder].append((path, MODEL_EXTENSIONS))
+    return roots
+
+
+def quick_file_hash(path: str, size: int) -> str:
+    """SHA-256 over size + first/last MiB: detects swapped checkpoints without reading GBs off the volume."""
+    digest = hashlib.sha256(str(size).encode("ascii"))
+    with open(path, "rb") as handle:
+        digest.update(handle.read(QUICK_HASH_BYTES))
+        if size > QUICK_HASH_BYTES:
+            handle.seek(max(QUICK_HASH_BYTES, size - QUICK_HASH_BYTES))
+            digest.update(handle.read(QUICK_HASH_BYTES))
+    return digest.hexdigest()[:32]
+
+
+class ModelIndex:
+    """Persistent index of model files (name, size, mtime, quick hash) under the model roots.
+
+    Directory listings are cached by directory mtime, so a refresh only relists
+    directories that gained or lost entries and only hashes new or changed
+    files. Lookups are dict hits; a miss falls back to a direct `isfile` under
+    each root so freshly copied models work before the next refresh. With
+    `scan=False` the index never touches the volumes: it resolves names from
+    the directory snapshots handed to `adopt()` by the process that scans.
+    """
+
+    def __init__(
+        self, roots: dict[str, list[Tuple[Path, set]]], cache_path: Optional[Path] = None, *, scan: bool = True
+    ) -> None:
+        self.roots = roots
+        self.cache_path = cache_path
+        self.scan = scan
+        # Called with the directory snapshot after each scanning refresh.
+        self.on_refresh: Optional[Callable[[dict], None]] = None
+        self._lock = threading.Lock()
+        self._dirs: dict[str, dict] = {}
+        self._by_folder: dict[str, dict[str, str]] = {}
+        self._sorted: dict[str, list[str]] = {}
+        self._covered: set[str] = set()
+        self.last_refresh_s = 0.0
+        self.rescanned_dirs = 0
+        self.hashed_files = 0
+        self.lookups = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self) -> None:
+        if self.cache_path is None or not self.cache_path.exists():
+            return
         try:
-            image_bytes = download_http_resource(image_url)
-        except Exception as exc:
-            raise RuntimeError(f"Failed to download image from URL: {exc}") from exc
-        if not job_input.get(name_key):
-            parsed = urlparse(image_url)
-            candidate = Path(parsed.path).name
-            if candidate:
-                image_name = candidate
+            with open(self.cache_path, "r", encoding="utf-8") as handle:
+                payload = json.load(handle)
+            if payload.get("version") == 1:
+                self._dirs = payload.get("dirs") or {}
+        except (OSError, ValueError) as exc:
+            print(f"Ignoring unreadable model index {self.cache_path}: {exc}", flush=True)
 
-    image_data = job_input.get(base64_key)
-    if image_bytes is None:
-        if image_data:
-            if isinstance(image_data, str):
-                image_bytes = decode_payload(image_data)
-            else:
-                image_bytes = image_data
-        elif isinstance(image_name, str):
+    def _save(self) -> None:
+        if self.cache_path is None:
+            return
+        temp_path = self.cache_path.with_name(f".{self.cache_path.name}.{os.getpid()}.tmp")
+        try:
+            # No mkdir: an unmounted volume must not be shadowed by a directory on the container disk.
+            with open(temp_path, "w", encoding="utf-8") as handle:
+                json.dump({"version": 1, "dirs": self._dirs}, handle, separators=(",", ":"))
+            os.replace(temp_path, self.cache_path)
+        except OSError as exc:
+            temp_path.unlink(missing_ok=True)
+            print(f"Model index not persisted to {self.cache_path}: {exc}", flush=True)
+
+    def _scan_dir(self, directory: str, fresh: dict[str, dict]) -> None:
+        if directory in fresh:
+            return
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        cached = self._dirs.get(directory)
+        if cached is not None and cached.get("mtime") == mtime:
+            entry = cached
+        else:
+            self.rescanned_dirs += 1
+            previous = cached.get("files", {}) if cached else {}
+            files: dict[str, list] = {}
+            subdirs: list[str] = []
             try:
-                maybe_bytes = decode_payload(image_name)
-            except ValueError:
-                maybe_bytes = None
-            if maybe_bytes is not None:
-                image_bytes = maybe_bytes
-                image_name = f"{uuid.uuid4().hex}.png"
-
-    if image_bytes is None and fallback_base64:
-        try:
-            image_bytes = decode_payload(fallback_base64)
-            if not image_name:
-                image_name = f"{base64_key}-{uuid.uuid4().hex}.png"
-        except Exception:
-            image_bytes = None
+                listing = os.scandir(directory)
+            except OSError as exc:
+                # Unreadable directory (permissions, stale mount): leave it out rather than fail the refresh.
+                print(f"Model index skipped {directory}: {exc}", flush=True)
+                return
+            with listing:
+                for item in listing:
+                    try:
+                        if item.is_dir():
+                            subdirs.append(item.name)
+                            continue
+                        if not item.is_file():
+                            continue
+                        info = item.stat()
+                        known = previous.get(item.name)
+                        if known and known[0] == info.st_size and known[1] == info.st_mtime:
+                            digest = known[2]
+                        elif os.path.splitext(item.name)[1].lower() in MODEL_EXTENSIONS:
+                            digest = quick_file_hash(item.path, info.st_size)
+                            self.hashed_files += 1
+                        else:
+                            digest = None
+                    except OSError:
+                        continue
+                    files[item.name] = [info.st_size, info.st_mtime, digest]
+            entry = {"mtime": mtime, "files": files, "subdirs": sorted(subdirs)}
+        fresh[directory] = entry
+        for name in entry["subdirs"]:
+            self._scan_dir(os.path.join(directory, name), fresh)
 
-    if image_bytes:
-        if not image_name:
-            image_name = f"{uuid.uuid4().hex}.png"
-        target_path = COMFY_INPUT / image_name
-        with open(target_path, "wb") as handle:
-            handle.write(image_bytes)
-        created = True
-    else:
-        target_path = COMFY_INPUT / image_name
-        if not target_path.exists():
-            raise FileNotFoundError(f"Image {image_name} not found in {COMFY_INPUT}")
-    return image_name, target_path if created else None
+    @staticmethod
+    def _walk(fresh: dict[str, dict], directory: str, prefix: str = ""):
+        entry = fresh.get(directory)
+        if entry is None:
+            return
+        for name in entry["files"]:
+            yield f"{prefix}{name}", os.path.join(directory, name)
+        for name in entry["subdirs"]:
+            yield from ModelIndex._walk(fresh, os.path.join(directory, name), f"{prefix}{name}/")
 
+    def refresh(self) -> None:
+        started = time.perf_counter()
+        fresh: dict[str, dict] = {}
+        if self.scan:
+            for roots in self.roots.values():
+                for root, _ in roots:
+                    self._scan_dir(str(root), fresh)
+        else:
+            fresh = self._dirs
+        by_folder: dict[str, dict[str, str]] = {}
+        covered: set[str] = set()
+        for folder, roots in self.roots.items():
+            names: dict[str, str] = {}
+            for root, extensions in roots:
+                if str(root) in fresh:
+                    covered.add(folder)
+                for name, path in self._walk(fresh, str(root)):
+                    if extensions and os.path.splitext(name)[1].lower() not in extensions:
+                        continue
+                    # First root wins, as in folder_paths.get_full_path.
+                    names.setdefault(name, path)
+            by_folder[folder] = names
+        with self._lock:
+            self._dirs = fresh
+            self._by_folder = by_folder
+            self._sorted = {folder: sorted(names) for folder, names in by_folder.items()}
+            self._covered = covered
+            self.last_refresh_s = time.perf_counter() - started
+        if not self.scan:
+            return
+        self._save()
+        if self.on_refresh is not None:
+            self.on_refresh(fresh)
 
-def build_prompt(job_input, *, timeline: Optional[TimelineLogger] = None):
-    ensure_comfy_ready()
-    workflow = copy.deepcopy(workflow_template)
-    nodes = find_nodes(workflow)
-    cleanup_paths: list[Path] = []
-    image_name, primary_cleanup = prepare_image(job_input, timeline=timeline)
-    if primary_cleanup:
-        cleanup_paths.append(primary_cleanup)
+    def snapshot(self) -> dict[str, dict]:
+        """Directory listings of the last refresh; treat as read-only, a refresh replaces it whole."""
+        return self._dirs
 
-    background_default_name = job_input.get("background_image_name") or f"background_{uuid.uuid4().hex}.png"
-    background_name, background_cleanup = prepare_image(
-        job_input,
-        base64_key="background_image_base64",
-        object_key="background_image_object_key",
-        url_key="background_image_url",
-        name_key="background_image_name",
-        default_name=background_default_name,
-        fallback_base64=PLACEHOLDER_PIXEL_BASE64,
-        timeline=timeline,
-    )
-    if background_cleanup:
-        cleanup_paths.append(background_cleanup)
+    def adopt(self, dirs: dict[str, dict]) -> None:
+        """Resolve names from directory listings scanned elsewhere (see `snapshot`)."""
+        with self._lock:
+            self._dirs = dirs
+        self.refresh()
 
-    def set_input(name, key, value):
-        workflow[nodes[name]]["inputs"][key] = value
+    def set_roots(self, roots: dict[str, list[Tuple[Path, set]]]) -> None:
+        self.roots = roots
+        self.refresh()
 
-    width = int(job_input.get("width", DEFAULTS["width"]))
-    height = int(job_input.get("height", DEFAULTS["height"]))
+    def covers(self, folder: str) -> bool:
+        with self._lock:
+            return folder in self._covered
 
-    set_input("model_loader", "model_name", job_input.get("model_name", DEFAULTS["model_name"]))
-    set_input("model_loader", "cpu_offload", job_input.get("cpu_offload", DEFAULTS["cpu_offload"]))
-    set_input(
-        "model_loader",
-        "num_blocks_on_gpu",
-        int(job_input.get("num_blocks_on_gpu", DEFAULTS["num_blocks_on_gpu"])),
-    )
-    set_input("model_loader", "use_pin_memory", job_input.get("use_pin_memory", DEFAULTS["use_pin_memory"]))
+    def lookup(self, folder: str, name: str) -> Optional[str]:
+        folder = LEGACY_MODEL_FOLDERS.get(folder, folder)
+        # pin() and the fallback below add names in place, so reads take the lock too.
+        with self._lock:
+            self.lookups += 1
+            path = self._by_folder.get(folder, {}).get(name)
+            if path is not None:
+                return path
+            self.misses += 1
+        for root, extensions in self.roots.get(folder, ()):
+            candidate = os.path.normpath(os.path.join(root, name))
+            if not candidate.startswith(os.path.join(os.path.normpath(root), "")):
+                continue
+            if extensions and os.path.splitext(name)[1].lower() not in extensions:
+                continue
+            if os.path.isfile(candidate):
+                with self._lock:
+                    self._by_folder.setdefault(folder, {})[name] = candidate
+                    self._sorted[folder] = sorted(self._by_folder[folder])
+                return candidate
+        return None
 
-    set_input("lora_loader", "lora_name", job_input.get("lora_name", DEFAULTS["lora_name"]))
-    set_input(
-        "lora_loader",
-        "lora_strength",
-        float(job_input.get("lora_strength", DEFAULTS["lora_strength"])),
-    )
+    def pin(self, folder: str, name: str, path: str) -> None:
+        """Point `name` at a specific copy (a staged local file) until the next refresh re-resolves it."""
+        with self._lock:
+            names = self._by_folder.setdefault(folder, {})
+            if name not in names:
+                self._sorted[folder] = sorted([*names, name])
+            names[name] = path
 
-    set_input("clip_loader", "clip_name", job_input.get("clip_name", DEFAULTS["clip_name"]))
-    set_input("clip_loader", "type", job_input.get("clip_type", DEFAULTS["clip_type"]))
-    set_input("clip_loader", "device", job_input.get("clip_device", DEFAULTS["clip_device"]))
+    def names(self, folder: str) -> list[str]:
+        # The sorted lists are replaced, never mutated, so the one returned stays consistent.
+        with self._lock:
+            return self._sorted.get(LEGACY_MODEL_FOLDERS.get(folder, folder), [])
 
-    set_input("vae_loader", "vae_name", job_input.get("vae_name", DEFAULTS["vae_name"]))
-    if "load_image" in nodes:
-        set_input("load_image", "image", image_name)
-    if "background_load_image" in nodes:
-        set_input("background_load_image", "image", background_name)
+    def entry(self, path: str) -> Optional[dict]:
+        directory, name = os.path.split(path)
+        with self._lock:
+            record = self._dirs.get(directory, {}).get("files", {}).get(name)
+        if record is None:
+            return None
+        return {"path": path, "size": record[0], "mtime": record[1], "hash": record[2]}
 
-    prompt_text = _clean_str(job_input.get("prompt") or job_input.get("prompt_text"))
-    negative_text = _clean_str(job_input.get("negative_prompt") or job_input.get("negativePrompt"))
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": {folder: len(names) for folder, names in self._by_folder.items()},
+                "directories": len(self._dirs),
+                "last_refresh_ms": round(self.last_refresh_s * 1000, 1),
+                "rescanned_dirs": self.rescanned_dirs,
+                "hashed_files": self.hashed_files,
+                "lookups": self.lookups,
+                "misses": self.misses,
+            }
 
-    if not prompt_text:
-        built = _build_prompts_from_structured_forms(job_input, {"width": width, "height": height})
-        if built:
-            prompt_text = built["prompt"]
-            negative_text = built["negative"]
-    if not prompt_text:
-        prompt_text = DEFAULTS["prompt"]
-    if not negative_text:
-        negative_text = DEFAULTS["negative_prompt"]
 
-    set_input("positive", "prompt", prompt_text)
-    set_input("negative", "prompt", negative_text)
+_model_index: Optional[ModelIndex] = None
+_model_index_lock = threading.Lock()
+# Set in device processes: the router scans, persists and refreshes the index, devices adopt its snapshots.
+_model_index_follower = False
 
-    set_input("latent", "width", width)
-    set_input("latent", "height", height)
-    set_input("latent", "batch_size", int(job_input.get("batch_size", DEFAULTS["batch_size"])))
 
-    set_input("sampling_wrapper", "shift", float(job_input.get("shift", DEFAULTS["shift"])))
+def get_model_index() -> Optional[ModelIndex]:
+    global _model_index
+    if not _strtobool(MODEL_INDEX, default=True):
+        return None
+    with _model_index_lock:
+        if _model_index is None and _model_index_follower:
+            _model_index = ModelIndex(load_model_roots(EXTRA_MODEL_PATHS), scan=False)
+        if _model_index is None:
+            index = ModelIndex(
+                load_model_roots(EXTRA_MODEL_PATHS), Path(MODEL_INDEX_PATH) if MODEL_INDEX_PATH else None
+            )
+            index.refresh()
+            print(f"Model index ready in {index.last_refresh_s * 1000:0.0f} ms: {index.stats()['files']}", flush=True)
+            if MODEL_INDEX_REFRESH > 0:
 
-    sampler_inputs = workflow[nodes["sampler"]]["inputs"]
-    sampler_inputs["seed"] = int(job_input.get("seed", DEFAULTS["seed"]))
-    sampler_inputs["steps"] = int(job_input.get("steps", DEFAULTS["steps"]))
-    sampler_inputs["cfg"] = float(job_input.get("cfg", DEFAULTS["cfg"]))
-    sampler_inputs["sampler_name"] = job_input.get("sampler_name", DEFAULTS["sampler_name"])
-    sampler_inputs["scheduler"] = job_input.get("scheduler", DEFAULTS["scheduler"])
-    sampler_inputs["denoise"] = float(job_input.get("denoise", DEFAULTS["denoise"]))
+                def refresher() -> None:
+                    while True:
+                        time.sleep(MODEL_INDEX_REFRESH)
+                        try:
+                            index.refresh()
+                        except Exception as exc:  # keep serving the previous snapshot
+                            print(f"Model index refresh failed: {exc}", flush=True)
 
-    set_input("save_image", "filename_prefix", job_input.get("filename_prefix", DEFAULTS["filename_prefix"]))
+                threading.Thread(target=refresher, name="ModelIndex-Refresh", daemon=True).start()
+            _model_index = index
+    return _model_index
 
-    return workflow, nodes["save_image"], cleanup_paths
 
+def install_model_index_hooks(index: ModelIndex) -> None:
+    """Serve ComfyUI's model folder lookups from the index instead of rescanning the volumes."""
+    folder_paths = import_module("folder_paths")
+    if getattr(folder_paths, "_runpod_model_index", None) is index:
+        return
+    roots = {}
+    for folder in INDEXED_MODEL_FOLDERS:
+        entry = folder_paths.folder_names_and_paths.get(folder)
+        if entry:
+            paths, extensions = entry[0], entry[1]
+            roots[folder] = [(Path(path), {ext.lower() for ext in extensions}) for path in paths]
+    # ComfyUI's own folder registry (extra paths, custom nodes) is authoritative once it is loaded.
+    index.set_roots(roots)
+    original_full_path = folder_paths.get_full_path
+    original_filename_list = folder_paths.get_filename_list
 
-def handler(job):
-    job_id = None
-    if isinstance(job, dict):
-        for key in ("id", "job_id", "jobId", "requestId"):
-            value = job.get(key)
-            if value:
-                job_id = str(value)
-                break
+    def get_full_path(folder_name, filename):
+        folder_name = LEGACY_MODEL_FOLDERS.get(folder_name, folder_name)
+        if folder_name in index.roots:
+            path = index.lookup(folder_name, filename)
+            if path is not None:
+                return path
+        return original_full_path(folder_name, filename)
 
-    timeline = TimelineLogger(job_id=job_id)
-    timeline.mark("Request received", dedupe=False)
+    def get_filename_list(folder_name):
+        folder_name = LEGACY_MODEL_FOLDERS.get(folder_name, folder_name)
+        # Until a follower has adopted its first snapshot, ComfyUI's own listing is the safe answer.
+        if folder_name in index.roots and index.covers(folder_name):
+            return list(index.names(folder_name))
+        return original_filename_list(folder_name)
 
-    ensure_comfy_ready()
-    timeline.mark("Comfy ready")
+    folder_paths.get_full_path = get_full_path
+    folder_paths.get_filename_list = get_filename_list
+    folder_paths._runpod_model_index = index
 
-    job_input = job.get("input", {})
-    cleanup_paths: list[Path] = []
-    try:
-        workflow, output_node_id, cleanup_paths = build_prompt(job_input, timeline=timeline)
-        timeline.mark("Workflow prepared")
-    except Exception as exc:
-        timeline.mark(f"Workflow preparation failed: {exc}", dedupe=False)
-        return {"error": f"Failed to build workflow: {exc}"}
 
-    prompt_id = str(uuid.uuid4())
-    queue_item = (
-        time.time(),
-        prompt_id,
-        workflow,
-        {},
-        [output_node_id],
-        {},
-    )
-    server.prompt_queue.put(queue_item)
-    timeline.mark("Workflow enqueued")
+def validate_model_inputs(job_input, nodes) -> None:
+    """Reject unknown model/LoRA/CLIP/VAE names before anything is downloaded or enqueued."""
+    index = get_model_index()
+    if index is None:
+        return
+    problems = []
+    for field, role, folder in MODEL_FIELDS:
+        if role not in nodes or not index.covers(folder):
+            continue
+        value = job_input.get(field, DEFAULTS[field])
+        if not isinstance(value, str) or index.lookup(folder, value) is None:
+            available = index.names(folder)
+            shown = ", ".join(available[:8]) + (", ..." if len(available) > 8 else "")
+            problems.append(f"{field} '{value}' not found in {folder} (available: {shown or 'none'})")
+    if problems:
+        raise ValueError("; ".join(problems))
 
-    timeout = float(job_input.get("timeout", 120))
-    start = time.time()
-    graph_started = False
 
-    try:
-        while time.time() - start < timeout:
-            history = server.prompt_queue.get_history(prompt_id=prompt_id)
-            record = history.get(prompt_id)
-            if record:
-                if not graph_started:
-                    timeline.mark("Graph execution started", dedupe=False)
-                    graph_started = True
-                status = record.get("status") or {}
-                timeline.mark_status_messages(status.get("messages"))
-                outputs = record.get("outputs") or {}
+STAGING_CHUNK_BYTES = 16 * 1024 * 1024
+FICLONE = 0x40049409
+
+
+def staging_targets() -> list[Tuple[str, str]]:
+    if STAGING_MODELS.strip():
+        targets = []
+        for entry in STAGING_MODELS.split(","):
+            folder, _, name = entry.strip().partition("/")
+            if folder and name:
+                targets.append((LEGACY_MODEL_FOLDERS.get(folder, folder), name))
+        return targets
+    return [(folder, DEFAULTS[field]) for field, _, folder in MODEL_FIELDS]
+
+
+class ModelStager:
+    """Copies hot models from the network volume to local disk in the background.
+
+    Each file is copied to a `.partial` name and renamed into place, so ComfyUI
+    only ever sees complete copies. Until then lookups resolve to the volume.
+    A manifest next to the copies records the source size/mtime and the SHA-256
+    taken during the copy; a staged file whose source is unchanged is reused
+    without being read again.
+    """
+
+    def __init__(self, root: Path, targets: list[Tuple[str, str]], *, workers: int = 3) -> None:
+        self.root = root
+        self.targets = targets
+        self.workers = max(1, workers)
+        self.manifest_path = root / "manifest.json"
+        self._lock = threading.Lock()
+        self.files: dict[str, dict] = {}
+        self.bytes_staged = 0
+        self.started_at: Optional[float] = None
+        self.ready_s: Optional[float] = None
+        self.done = threading.Event()
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as handle:
+                self.manifest = json.load(handle)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def start(self) -> "ModelStager":
+        self.started_at = time.perf_counter()
+        threading.Thread(target=self._run, name="ModelStager", daemon=True).start()
+        return self
+
+    def _run(self) -> None:
+        # Resolve against the configured volumes only, never against earlier staged copies.
+        sources = ModelIndex(load_model_roots(EXTRA_MODEL_PATHS))
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ModelStager") as executor:
+            for folder, name in self.targets:
+                executor.submit(self._stage_one, sources, folder, name)
+        self.ready_s = time.perf_counter() - self.started_at
+        self._save_manifest()
+        self.done.set()
+        stats = self.stats()
+        print(
+            f"Model staging finished in {self.ready_s:0.1f}s: {stats['staged']} staged, {stats['cached']} cached, "
+            f"{stats['failed']} failed, {self.bytes_staged / 2**30:0.2f} GiB at {stats['throughput_mb_s']} MB/s",
+            flush=True,
+        )
+
+    def _stage_one(self, sources: ModelIndex, folder: str, name: str) -> None:
+        key = f"{folder}/{name}"
+        record = {"status": "pending"}
+        with self._lock:
+            self.files[key] = record
+        try:
+            source = sources.lookup(folder, name)
+            if source is None:
+                raise FileNotFoundError(f"{name} not found in {folder}")
+            info = os.stat(source)
+            target = self.root / folder / name
+            record.update(source=source, bytes=info.st_size)
+            cached = self.manifest.get(key)
+            if (
+                cached
+                and cached.get("size") == info.st_size
+                and cached.get("mtime") == info.st_mtime
+                and target.is_file()
+                and target.stat().st_size == info.st_size
+            ):
+                record.update(status="cached", sha256=cached.get("sha256"), path=str(target))
+                self._publish(folder, name, target)
+                return
+            free = shutil.disk_usage(self.root).free
+            if free - info.st_size < STAGING_RESERVE_BYTES:
+                raise OSError(f"needs {info.st_size / 2**30:0.1f} GiB, {free / 2**30:0.1f} GiB free on {self.root}")
+            target.parent.mkdir(parents=True, exist_ok=True)
+            partial = target.with_name(f".{target.name}.partial")
+            started = time.perf_counter()
+            try:
+                method, digest = self._copy(source, partial)
+                os.replace(partial, target)
+            except BaseException:
+                partial.unlink(missing_ok=True)
+                raise
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.bytes_staged += info.st_size
+                self.manifest[key] = {"size": info.st_size, "mtime": info.st_mtime, "sha256": digest}
+            record.update(status="staged", method=method, sha256=digest, path=str(target), seconds=round(elapsed, 2))
+            self._publish(folder, name, target)
+        except Exception as exc:  # the volume copy keeps serving
+            record.update(status="failed", error=str(exc))
+            print(f"Staging {key} failed, serving it from the volume: {exc}", flush=True)
+
+    @staticmethod
+    def _copy(source: str, target: Path) -> Tuple[str, Optional[str]]:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            try:
+                import fcntl
+
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink", None
+            except (ImportError, OSError):
+                pass
+            digest = hashlib.sha256()
+            buffer = bytearray(STAGING_CHUNK_BYTES)
+            view = memoryview(buffer)
+            while True:
+                read = src.readinto(buffer)
+                if not read:
+                    break
+                digest.update(view[:read])
+                dst.write(view[:read])
+        return "copy", digest.hexdigest()
+
+    def _publish(self, folder: str, name: str, target: Path) -> None:
+        if _model_index is not None:
+            _model_index.pin(folder, name, str(target))
+
+    def _save_manifest(self) -> None:
+        temp_path = self.manifest_path.with_name(f".{self.manifest_path.name}.tmp")
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as handle:
+                json.dump(self.manifest, handle, indent=2)
+            os.replace(temp_path, self.manifest_path)
+        except OSError as exc:
+            print(f"Staging manifest not written: {exc}", flush=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            files = {key: dict(record) for key, record in self.files.items()}
+        counts = {status: 0 for status in ("pending", "staged", "cached", "failed")}
+        for record in files.values():
+            counts[record["status"]] += 1
+        elapsed = self.ready_s if self.ready_s is not None else time.perf_counter() - (self.started_at or 0)
+        return {
+            **counts,
+            "ready": self.done.is_set(),
+            "time_to_ready_s": round(self.ready_s, 2) if self.ready_s is not None else None,
+            "elapsed_s": round(elapsed, 2),
+            "bytes_staged": self.bytes_staged,
+            # Aggregate over the parallel copies; per-file times are in `files`.
+            "throughput_mb_s": round(self.bytes_staged / 1e6 / elapsed, 1) if self.bytes_staged and elapsed else 0.0,
+            "files": files,
+        }
+
+
+model_stager: Optional[ModelStager] = None
+
+
+def start_model_staging() -> Optional[ModelStager]:
+    global model_stager
+    if model_stager is None and _strtobool(MODEL_STAGING, default=False):
+        STAGING_DIR.mkdir(parents=True, exist_ok=True)
+        model_stager = ModelStager(STAGING_DIR, staging_targets(), workers=STAGING_WORKERS).start()
+    return model_stager
+
+
+def register_staging_paths() -> None:
+    """Put the staging directory first in ComfyUI's search order; only complete copies live there."""
+    # Also runs in multi-GPU device processes, which serve the copies staged by the parent.
+    if not _strtobool(MODEL_STAGING, default=False):
+        return
+    folder_paths = import_module("folder_paths")
+    for folder in sorted({folder for folder, _ in staging_targets()}):
+        path = str(STAGING_DIR / folder)
+        os.makedirs(path, exist_ok=True)
+        if path not in folder_paths.folder_names_and_paths.get(folder, ([], set()))[0]:
+            folder_paths.add_model_folder_path(folder, path, is_default=True)
+
+
+LORA_LOADER_CLASS = "NunchakuQwenImageLoraLoader"
+
+
+class FusionUnsupported(RuntimeError):
+    pass
+
+
+def fused_lora_key(job_input) -> Tuple[str, str, float]:
+    return (
+        job_input.get("model_name", DEFAULTS["model_name"]),
+        job_input.get("lora_name", DEFAULTS["lora_name"]),
+        round(float(job_input.get("lora_strength", DEFAULTS["lora_strength"])), 4),
+    )
+
+
+def _model_stem(name: str) -> str:
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return re.sub(r"[^A-Za-z0-9._-]+", "-", stem)[:60]
+
+
+def loaded_nunchaku_transformers() -> list[Tuple[object, object]]:
+    """(diffusion model wrapper, Nunchaku transformer) pairs currently loaded by ComfyUI."""
+    model_management = import_module("comfy.model_management")
+    found = []
+    for loaded in list(getattr(model_management, "current_loaded_models", [])):
+        patcher = getattr(loaded, "model", None)
+        root = getattr(getattr(patcher, "model", None), "diffusion_model", None)
+        if root is None:
+            continue
+        modules = list(root.modules()) if hasattr(root, "modules") else []
+        inner = getattr(root, "model", None)
+        if inner is not None and hasattr(inner, "modules"):
+            modules.extend(inner.modules())
+        for module in modules:
+            name = type(module).__name__
+            if name.startswith("Nunchaku") and "Transformer" in name:
+                found.append((root, module))
+                break
+    return found
+
+
+def loaded_model_snapshot(candidates) -> list[Tuple[int, int, str]]:
+    """Identity of the loaded transformers and their applied LoRAs, to detect changes during a copy."""
+    return [(id(wrapper), id(transformer), repr(getattr(wrapper, "loras", None))) for wrapper, transformer in candidates]
+
+
+def comfy_queue_idle() -> bool:
+    get_remaining = getattr(getattr(server, "prompt_queue", None), "get_tasks_remaining", None)
+    return get_remaining is None or get_remaining() == 0
+
+
+class FusedLoraCache:
+    """Fused base+LoRA DiT checkpoints for hot (model, LoRA, strength) combinations.
+
+    A combination becomes hot after `min_jobs` completed unfused jobs. Right
+    after the next one, the LoRA-composed transformer weights are captured from
+    the model ComfyUI has loaded and written next to the base file's metadata
+    as a standalone checkpoint. Later jobs load it with the DiT loader and drop
+    the LoRA node from the graph. The manifest ties each checkpoint to the
+    size and quick hash of its base and LoRA files, so a staged copy still
+    matches and replacing either drops the fused file for a rebuild.
+    Combinations whose weights cannot be captured safely are marked
+    unsupported and stay on the unfused path.
+    """
+
+    def __init__(self, root: Path, *, min_jobs: int = 3, max_entries: int = 2) -> None:
+        self.root = root
+        self.min_jobs = max(1, min_jobs)
+        self.max_entries = max(1, max_entries)
+        self.manifest_path = root / "manifest.json"
+        self._lock = threading.Lock()
+        self._capture_lock = threading.Lock()
+        self._counts: dict[Tuple[str, str, float], int] = {}
+        self._state: dict[Tuple[str, str, float], str] = {}
+        self._hashes: dict[Tuple[str, int, float], str] = {}
+        self.fused_jobs = 0
+        self.captures: list[dict] = []
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as handle:
+                self.manifest: dict[str, dict] = json.load(handle)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    @staticmethod
+    def file_name(key: Tuple[str, str, float]) -> str:
+        model_name, lora_name, strength = key
+        return f"{_model_stem(model_name)}+{_model_stem(lora_name)}@{strength:g}.safetensors"
+
+    def _signature(self, folder: str, name: str) -> Optional[list]:
+        """[path, size, quick hash]: content identity, so a staged copy (new path/mtime) still matches."""
+        path = import_module("folder_paths").get_full_path(folder, name)
+        if not path:
+            return None
+        info = os.stat(path)
+        cache_key = (path, info.st_size, info.st_mtime)
+        digest = self._hashes.get(cache_key)
+        if digest is None:
+            digest = quick_file_hash(path, info.st_size)
+            self._hashes[cache_key] = digest
+        return [path, info.st_size, digest]
+
+    def register(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        folder_paths = import_module("folder_paths")
+        if str(self.root) not in folder_paths.folder_names_and_paths.get("diffusion_models", ([], set()))[0]:
+            folder_paths.add_model_folder_path("diffusion_models", str(self.root))
+
+    def lookup(self, key: Tuple[str, str, float]) -> Optional[str]:
+        name = self.file_name(key)
+        with self._lock:
+            entry = self.manifest.get(name)
+        if entry is None:
+            return None
+        try:
+            current = [self._signature("diffusion_models", key[0]), self._signature("loras", key[1])]
+        except OSError:
+            return None
+        expected = [entry["model"][1:], entry["lora"][1:]]
+        if not (self.root / name).is_file() or [sig[1:] if sig else None for sig in current] != expected:
+            # Base or LoRA replaced (or the file is gone): drop the entry so the combination can be rebuilt.
+            self._discard(name)
+            return None
+        with self._lock:
+            entry["last_used"] = time.time()
+            self.fused_jobs += 1
+        return name
+
+    def note_unfused(self, key: Tuple[str, str, float]) -> bool:
+        """Count a completed unfused job; True when this combination should be captured now."""
+        with self._lock:
+            if self._state.get(key) in ("building", "unsupported"):
+                return False
+            self._counts[key] = self._counts.get(key, 0) + 1
+            if self._counts[key] < self.min_jobs or self.file_name(key) in self.manifest:
+                return False
+            self._state[key] = "building"
+            return True
+
+    def capture(self, key: Tuple[str, str, float], timeline: Optional[TimelineLogger] = None) -> Optional[str]:
+        """Write the loaded, LoRA-composed transformer of `key` as a fused checkpoint."""
+        name = self.file_name(key)
+        started = time.perf_counter()
+        try:
+            with self._capture_lock:
+                size = self._write(key, name)
+        except FusionUnsupported as exc:
+            with self._lock:
+                self._state[key] = "unsupported"
+                self.captures.append({"name": name, "error": str(exc)})
+            print(f"LoRA fusion unsupported for {name}: {exc}", flush=True)
+            return None
+        except Exception as exc:
+            with self._lock:
+                # Transient (disk, memory, nothing loaded yet): try again once the combination runs again.
+                self._state.pop(key, None)
+                self._counts[key] = 0
+                self.captures.append({"name": name, "error": str(exc)})
+            print(f"LoRA fusion of {name} failed: {exc}", flush=True)
+            return None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._state[key] = "ready"
+            self.captures.append({"name": name, "bytes": size, "seconds": round(elapsed, 1)})
+        if _model_index is not None:
+            _model_index.pin("diffusion_models", name, str(self.root / name))
+        message = f"Fused checkpoint {name} written ({size / 2**30:0.2f} GiB in {elapsed:0.1f}s)"
+        if timeline is not None:
+            timeline.mark(message, dedupe=False)
+        else:
+            print(message, flush=True)
+        return name
+
+    def _write(self, key: Tuple[str, str, float], name: str) -> int:
+        import torch  # noqa: F401  (safetensors.torch needs it loaded)
+        from safetensors import safe_open
+        from safetensors.torch import save_file
+
+        model_name, lora_name, strength = key
+        model_signature = self._signature("diffusion_models", model_name)
+        lora_signature = self._signature("loras", lora_name)
+        if model_signature is None or lora_signature is None:
+            raise FusionUnsupported("base model or LoRA file not found")
+
+        with safe_open(model_signature[0], framework="pt") as base:
+            metadata = dict(base.metadata() or {})
+            base_shapes = {key: tuple(base.get_slice(key).get_shape()) for key in base.keys()}
+            pipeline = get_pipeline()
+            # No prompt may run while weights are copied: a LoRA switch mid-copy would tear the checkpoint.
+            # Only the copy is exclusive; checks and the multi-GB write below run alongside new jobs.
+            with pipeline.exclusive() if pipeline is not None else nullcontext():
+                candidates = loaded_nunchaku_transformers()
+                before = loaded_model_snapshot(candidates)
+                matching = []
+                for wrapper, transformer in candidates:
+                    loras = getattr(wrapper, "loras", None)
+                    if loras is None:
+                        matching.append(transformer)
+                        continue
+                    applied = [(os.path.basename(str(path)), round(float(weight), 4)) for path, weight in loras]
+                    if applied == [(os.path.basename(lora_name), strength)]:
+                        matching.append(transformer)
+                if len(matching) != 1:
+                    raise RuntimeError(f"expected one loaded transformer with this LoRA, found {len(matching)}")
+                if not comfy_queue_idle():
+                    raise RuntimeError("a prompt is running; capture again after the next job")
+                state = {
+                    key: value.detach().to("cpu").contiguous() for key, value in matching[0].state_dict().items()
+                }
+                if not comfy_queue_idle() or loaded_model_snapshot(loaded_nunchaku_transformers()) != before:
+                    raise RuntimeError("loaded weights changed during the copy; discarded")
+            if set(state) != set(base_shapes):
+                raise FusionUnsupported("loaded parameter names differ from the base checkpoint")
+            ranks = set()
+            for key, value in state.items():
+                base_shape = base_shapes[key]
+                if tuple(value.shape) == base_shape:
+                    continue
+                differing = [dim for dim, (old, new) in enumerate(zip(base_shape, value.shape)) if old != new]
+                if not key.endswith(("proj_down", "proj_up")) or len(value.shape) != len(base_shape) or len(differing) != 1:
+                    raise FusionUnsupported(f"{key} changed shape outside the low-rank branch")
+                ranks.add(value.shape[differing[0]])
+            if not ranks:
+                # Same shapes: make sure the LoRA was composed in rather than still pending.
+                probes = [key for key in state if key.endswith("proj_up")][:4]
+                if probes and all(torch.equal(state[key], base.get_tensor(key)) for key in probes):
+                    raise RuntimeError("LoRA not composed into the loaded weights yet")
+        if len(ranks) > 1:
+            raise FusionUnsupported(f"LoRA leaves mixed low-rank sizes {sorted(ranks)}")
+        if ranks:
+            try:
+                quantization = json.loads(metadata["quantization_config"])
+                quantization["rank"]
+            except (KeyError, TypeError, ValueError):
+                raise FusionUnsupported("base checkpoint metadata has no quantization rank") from None
+            quantization["rank"] = ranks.pop()
+            metadata["quantization_config"] = json.dumps(quantization)
+        metadata["runpod_fused_lora"] = json.dumps({"lora": lora_name, "strength": strength})
+
+        size = sum(value.numel() * value.element_size() for value in state.values())
+        self.root.mkdir(parents=True, exist_ok=True)
+        free = shutil.disk_usage(self.root).free
+        if free < size * 1.1:
+            raise RuntimeError(f"needs {size / 2**30:0.1f} GiB, {free / 2**30:0.1f} GiB free on {self.root}")
+        partial = self.root / f".{name}.partial"
+        try:
+            save_file(state, str(partial), metadata=metadata)
+            os.replace(partial, self.root / name)
+        finally:
+            partial.unlink(missing_ok=True)
+        with self._lock:
+            self.manifest[name] = {
+                "model": model_signature,
+                "lora": lora_signature,
+                "strength": strength,
+                "bytes": size,
+                "built_at": time.time(),
+                "last_used": time.time(),
+            }
+            self._evict()
+            self._save()
+        return size
+
+    def _discard(self, name: str) -> None:
+        with self._lock:
+            if self.manifest.pop(name, None) is None:
+                return
+            try:
+                (self.root / name).unlink(missing_ok=True)
+                self._save()
+            except OSError as exc:
+                print(f"Stale fused checkpoint {name} not fully removed: {exc}", flush=True)
+        print(f"Fused checkpoint {name} is stale; dropped", flush=True)
+
+    def _evict(self) -> None:
+        while len(self.manifest) > self.max_entries:
+            oldest = min(self.manifest, key=lambda entry: self.manifest[entry].get("last_used", 0))
+            self.manifest.pop(oldest)
+            (self.root / oldest).unlink(missing_ok=True)
+
+    def _save(self) -> None:
+        temp_path = self.manifest_path.with_name(f".{self.manifest_path.name}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as handle:
+            json.dump(self.manifest, handle, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "fused_jobs": self.fused_jobs,
+                "checkpoints": {name: {"bytes": entry["bytes"], "strength": entry["strength"]} for name, entry in self.manifest.items()},
+                "states": {self.file_name(key): state for key, state in self._state.items()},
+                "captures": self.captures[-10:],
+            }
+
+
+_fused_lora_cache: Optional[FusedLoraCache] = None
+
+
+def get_fused_lora_cache() -> Optional[FusedLoraCache]:
+    global _fused_lora_cache
+    if not _strtobool(FUSED_LORA, default=False):
+        return None
+    with _model_index_lock:
+        if _fused_lora_cache is None:
+            _fused_lora_cache = FusedLoraCache(FUSED_LORA_DIR, min_jobs=FUSED_LORA_MIN_JOBS, max_entries=FUSED_LORA_MAX)
+    return _fused_lora_cache
+
+
+def use_fused_lora(job_input) -> bool:
+    return _strtobool(str(job_input.get("fused_lora", FUSED_LORA)), default=False)
+
+
+def apply_fused_lora(workflow, nodes, job_input) -> Optional[str]:
+    """Load a fused checkpoint directly and splice the LoRA node out of the graph."""
+    cache = get_fused_lora_cache()
+    if cache is None or not use_fused_lora(job_input) or "lora_loader" not in nodes or "model_loader" not in nodes:
+        return None
+    name = cache.lookup(fused_lora_key(job_input))
+    if name is None:
+        return None
+    lora_id, model_id = nodes["lora_loader"], nodes["model_loader"]
+    workflow[model_id]["inputs"]["model_name"] = name
+    for node in workflow.values():
+        for field, value in node["inputs"].items():
+            if isinstance(value, list) and len(value) == 2 and value[0] == lora_id:
+                node["inputs"][field] = [model_id, value[1]]
+    del workflow[lora_id]
+    return name
+
+
+def note_unfused_lora_job(job_input, workflow, timeline: TimelineLogger) -> None:
+    """After a successful unfused job: count it, and capture the fused weights once the combination is hot."""
+    cache = get_fused_lora_cache()
+    if cache is None or not use_fused_lora(job_input):
+        return
+    if not any(node.get("class_type") == LORA_LOADER_CLASS for node in workflow.values()):
+        return
+    key = fused_lora_key(job_input)
+    if cache.note_unfused(key):
+        threading.Thread(target=cache.capture, args=(key,), name="FusedLora-Capture", daemon=True).start()
+
+
+IMAGE_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp", "GIF": ".gif", "BMP": ".bmp"}
+
+
+def probe_image_header(data: bytes) -> Tuple[str, int, int]:
+    """Return `(format, width, height)` from the file header without decoding pixels."""
+    if len(data) >= 24 and data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return "PNG", width, height
+    if len(data) >= 10 and data[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = struct.unpack("<HH", data[6:10])
+        return "GIF", width, height
+    if len(data) >= 26 and data[:2] == b"BM":
+        width, height = struct.unpack("<ii", data[18:26])
+        return "BMP", abs(width), abs(height)
+    if len(data) >= 30 and data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8X":
+            width = int.from_bytes(data[24:27], "little") + 1
+            height = int.from_bytes(data[27:30], "little") + 1
+            return "WEBP", width, height
+        if chunk == b"VP8L" and data[20] == 0x2F:
+            bits = int.from_bytes(data[21:25], "little")
+            return "WEBP", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", data[26:30])
+            return "WEBP", width & 0x3FFF, height & 0x3FFF
+    if len(data) >= 4 and data[:2] == b"\xff\xd8":
+        offset = 2
+        while offset + 4 <= len(data):
+            if data[offset] != 0xFF:
+                break
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                offset += 1
+                continue
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                offset += 2
+                continue
+            (length,) = struct.unpack(">H", data[offset + 2 : offset + 4])
+            # SOF0-SOF15 carry the frame size; C4/C8/CC are DHT/JPG/DAC.
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC) and offset + 9 <= len(data):
+                height, width = struct.unpack(">HH", data[offset + 5 : offset + 9])
+                return "JPEG", width, height
+            offset += 2 + length
+    raise ValueError("Unsupported or corrupt image payload (expected PNG, JPEG, WebP, GIF or BMP).")
+
+
+def _sniff_image_magic(head: bytes) -> bool:
+    return (
+        head.startswith((b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"BM"))
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+    )
+
+
+def looks_like_base64_payload(value: str) -> bool:
+    """Cheap check that a string is an inline base64 image rather than a file name.
+
+    Only the first few characters are decoded, to compare against image magic
+    bytes; the full payload is validated later by the streaming decoder.
+    """
+    if value.startswith("data:"):
+        return ";base64," in value[:64]
+    if len(value) < 16 or len(value) % 4 or not BASE64_TEXT_RE.fullmatch(value[:256]):
+        return False
+    try:
+        head = binascii.a2b_base64(value[:16])
+    except binascii.Error:
+        return False
+    return _sniff_image_magic(head)
+
+
+def decode_base64_to_file(payload: Union[str, memoryview], target_path: Path) -> int:
+    """Validate and decode base64 text straight into `target_path`.
+
+    Works through the payload in fixed-size slices, so the transient cost is
+    about one slice plus its decoded bytes rather than the whole decoded
+    image. Each slice gets fresh buffers (binascii has no decode-into API);
+    they are freed before the next one. `payload` may be a str or an ASCII memoryview (shared memory), whose
+    slices are decoded without copying. Accepts an optional
+    `data:...;base64,` prefix. Returns bytes written.
+    """
+    text = isinstance(payload, str)
+    head = payload[:DATA_URI_PROBE_CHARS] if text else bytes(payload[:DATA_URI_PROBE_CHARS]).decode("latin-1")
+    start = 0
+    if head.startswith("data:"):
+        start = head.find(",") + 1
+        if start == 0:
+            raise ValueError("Invalid base64 payload: malformed data URI")
+    end = len(payload)
+    if (end - start) % 4:
+        raise ValueError("Invalid base64 payload: length is not a multiple of 4")
+    padding = "=" if text else b"="
+    written = 0
+    try:
+        with open(target_path, "wb") as handle:
+            for offset in range(start, end, BASE64_DECODE_CHUNK_CHARS):
+                stop = min(offset + BASE64_DECODE_CHUNK_CHARS, end)
+                chunk = payload[offset:stop]
+                try:
+                    early_padding = stop < end and chunk[-1:] == padding
+                    decoded = b"" if early_padding else binascii.a2b_base64(chunk, strict_mode=True)
+                except (binascii.Error, ValueError) as exc:
+                    raise ValueError(f"Invalid base64 payload: {exc}") from exc
+                finally:
+                    if not text:
+                        # Drop the export at once so the shared-memory block can close even on errors.
+                        chunk.release()
+                if early_padding:
+                    raise ValueError("Invalid base64 payload: padding before end of data")
+                handle.write(decoded)
+                written += len(decoded)
+    except BaseException:
+        target_path.unlink(missing_ok=True)
+        raise
+    return written
+
+
+def normalize_input_file(
+    path: Path,
+    *,
+    max_side: int,
+    timeline: Optional[TimelineLogger] = None,
+) -> Path:
+    """Validate an input image on disk and downscale it so its longest side fits `max_side`.
+
+    Rejects corrupt or oversized payloads before they reach `LoadImage`. Images
+    already within the bound are left untouched. Returns the (possibly renamed)
+    path when re-encoding changes the format.
+    """
+    started = time.perf_counter()
+    original_size = path.stat().st_size
+    with open(path, "rb") as handle:
+        head = handle.read(INPUT_PROBE_BYTES)
+        try:
+            image_format, width, height = probe_image_header(head)
+        except ValueError:
+            if len(head) < INPUT_PROBE_BYTES:
+                raise
+            # Large EXIF/ICC segments can push a JPEG frame header past the probe window.
+            handle.seek(0)
+            image_format, width, height = probe_image_header(handle.read())
+        handle.seek(max(0, original_size - 64))
+        tail = handle.read()
+        truncated = image_format == "PNG" and b"IEND" not in tail
+        if image_format == "JPEG" and original_size:
+            # Camera/MPF files append data after EOI, so look for it after the last scan, not at the end.
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                last_scan = data.rfind(b"\xff\xda")
+                truncated = last_scan < 0 or data.find(b"\xff\xd9", last_scan) < 0
+    if truncated:
+        raise ValueError(f"Input image {path.name} is truncated.")
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Input image {path.name} has invalid dimensions {width}x{height}.")
+    if width * height > INPUT_MAX_PIXELS:
+        raise ValueError(
+            f"Input image {path.name} is {width}x{height}, above the {INPUT_MAX_PIXELS} pixel limit."
+        )
+    if max_side <= 0 or max(width, height) <= max_side:
+        return path
+
+    from PIL import Image, ImageOps
+
+    scale = max_side / max(width, height)
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    with Image.open(path) as image:
+        if image_format == "JPEG":
+            # Let libjpeg decode at a reduced DCT scale instead of full resolution.
+            image.draft(image.mode, target)
+        image.load()
+        # The re-encoded file carries no EXIF, so bake the orientation into the pixels first.
+        upright = ImageOps.exif_transpose(image)
+        if upright.size != image.size:
+            target = (target[1], target[0])
+        resized = upright.resize(target, Image.Resampling.LANCZOS)
+    save_kwargs: dict = {}
+    if image_format == "JPEG":
+        if resized.mode not in ("RGB", "L"):
+            resized = resized.convert("RGB")
+        save_kwargs = {"quality": 95}
+    elif image_format == "PNG":
+        save_kwargs = {"compress_level": 1}
+    elif image_format == "WEBP":
+        save_kwargs = {"quality": 95}
+    else:
+        image_format = "PNG"
+        save_kwargs = {"compress_level": 1}
+    target_path = path.with_name(f"{path.stem}{IMAGE_EXTENSIONS[image_format]}")
+    temp_path = path.with_name(f".{path.stem}.resize{IMAGE_EXTENSIONS[image_format]}")
+    resized.save(temp_path, format=image_format, **save_kwargs)
+    os.replace(temp_path, target_path)
+    if target_path != path:
+        path.unlink(missing_ok=True)
+    if timeline:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        timeline.mark(
+            f"Resized input {width}x{height} -> {target[0]}x{target[1]} "
+            f"({original_size - target_path.stat().st_size} bytes saved, {elapsed_ms:0.1f} ms)",
+            dedupe=False,
+        )
+    return target_path
+
+
+class _MarkCollector:
+    """Stands in for a TimelineLogger inside pool processes; the parent replays the labels."""
+
+    def __init__(self) -> None:
+        self.labels: list[str] = []
+
+    def mark(self, label: str, **_) -> None:
+        self.labels.append(label)
+
+
+def _text_to_shared_memory(text: str) -> shared_memory.SharedMemory:
+    """Copy ASCII text into a new shared-memory block one slice at a time."""
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(text)))
+    try:
+        for offset in range(0, len(text), BASE64_DECODE_CHUNK_CHARS):
+            chunk = text[offset : offset + BASE64_DECODE_CHUNK_CHARS].encode("ascii")
+            block.buf[offset : offset + len(chunk)] = chunk
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    return block
+
+
+def _decode_base64_shared(name: str, size: int, target_path: str) -> int:
+    block = shared_memory.SharedMemory(name=name)
+    view = block.buf[:size]
+    try:
+        return decode_base64_to_file(view, Path(target_path))
+    finally:
+        view.release()
+        block.close()
+
+
+def _encode_base64_shared(file_path: str) -> Tuple[str, int]:
+    size = os.path.getsize(file_path)
+    block = shared_memory.SharedMemory(create=True, size=max(1, 4 * ((size + 2) // 3)))
+    written = 0
+    try:
+        with open(file_path, "rb") as handle:
+            for chunk in iter(lambda: handle.read(BASE64_CHUNK_BYTES), b""):
+                encoded = binascii.b2a_base64(chunk, newline=False)
+                block.buf[written : written + len(encoded)] = encoded
+                written += len(encoded)
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    # The parent unlinks the block once it has copied the text out.
+    return block.name, written
+
+
+def _normalize_input_remote(path: str, max_side: int) -> Tuple[str, list[str]]:
+    collector = _MarkCollector()
+    result = normalize_input_file(Path(path), max_side=max_side, timeline=collector)
+    return str(result), collector.labels
+
+
+def decode_base64_input(payload: str, target_path: Path) -> int:
+    """`decode_base64_to_file`, run in the CPU pool with the payload handed over in shared memory."""
+    pool = get_cpu_pool()
+    if pool is None or len(payload) < CPU_OFFLOAD_MIN_BYTES:
+        return decode_base64_to_file(payload, target_path)
+    if not payload.isascii():
+        raise ValueError("Invalid base64 payload: non-ASCII characters")
+    block = _text_to_shared_memory(payload)
+    try:
+        return pool.submit(_decode_base64_shared, block.name, len(payload), str(target_path)).result()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def normalize_input(path: Path, *, max_side: int, timeline: Optional[TimelineLogger] = None) -> Path:
+    pool = get_cpu_pool()
+    if pool is None or path.stat().st_size < CPU_OFFLOAD_MIN_BYTES:
+        return normalize_input_file(path, max_side=max_side, timeline=timeline)
+    result, labels = pool.submit(_normalize_input_remote, str(path), max_side).result()
+    if timeline:
+        for label in labels:
+            timeline.mark(label, dedupe=False)
+    return Path(result)
+
+
+def _take_shared_text(name: str, size: int) -> str:
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        # Decode straight from the mapping: the returned str is the only copy.
+        with block.buf[:size] as view:
+            return str(view, "ascii")
+    finally:
+        block.close()
+        block.unlink()
+
+
+def encode_outputs_base64(file_paths: list[Path]) -> list[str]:
+    """`encode_file_base64` for each file, in order.
+
+    The encoder holds the GIL, so without the CPU pool the files are encoded
+    one after another on the calling thread; threads would only interleave
+    them. With the pool, large files are encoded concurrently in its processes
+    and the text is handed back in shared memory.
+    """
+    pool = get_cpu_pool()
+    futures: list[Optional[Future]] = []
+    for path in file_paths:
+        try:
+            offload = pool is not None and path.stat().st_size >= CPU_OFFLOAD_MIN_BYTES
+        except OSError:
+            offload = False  # encode_file_base64 below reports the error
+        futures.append(pool.submit(_encode_base64_shared, str(path)) if offload else None)
+    encoded: list[str] = []
+    error: Optional[BaseException] = None
+    # Collect every future even after a failure so no shared-memory block is left behind.
+    for path, future in zip(file_paths, futures):
+        try:
+            encoded.append(encode_file_base64(path) if future is None else _take_shared_text(*future.result()))
+        except Exception as exc:
+            error = error or exc
+    if error is not None:
+        raise error
+    return encoded
+
+
+def encode_output_base64(file_path: Path) -> str:
+    return encode_outputs_base64([file_path])[0]
+
+
+def input_max_side(job_input, width: int, height: int) -> int:
+    if not _strtobool(str(job_input.get("resize_inputs", RESIZE_INPUTS)), default=True):
+        return 0
+    configured = int(job_input.get("input_max_side") or INPUT_MAX_SIDE)
+    return configured if configured > 0 else max(width, height)
+
+
+def prepare_image(
+    job_input,
+    *,
+    base64_key: str = "image_base64",
+    object_key: str = "image_object_key",
+    url_key: str = "image_url",
+    name_key: str = "image_name",
+    default_name: Optional[str] = None,
+    fallback_base64: Optional[str] = None,
+    max_side: int = 0,
+    timeline: Optional[TimelineLogger] = None,
+):
+    def log(message: str) -> None:
+        if timeline:
+            timeline.mark(message)
+
+    image_name = job_input.get(name_key) or default_name or DEFAULTS["image_name"]
+    # Raw bytes (URL downloads), a base64 string decoded straight to disk, or a
+    # callable that writes the input to a given path (storage objects).
+    source = None
+
+    storage_key = job_input.get(object_key)
+    if storage_key:
+        if not storage_available():
+            raise RuntimeError("Storage key provided but RunPod storage is not configured.")
+        log(f"Downloading input image from storage ({storage_key})")
+        source = partial(download_storage_object, storage_key)
+        if not job_input.get(name_key):
+            image_name = Path(storage_key).name or f"{uuid.uuid4().hex}.png"
+
+    image_url = job_input.get(url_key)
+    if source is None and image_url:
+        log("Downloading input image from URL")
+        try:
+            source = download_http_resource(image_url)
+        except Exception as exc:
+            raise RuntimeError(f"Failed to download image from URL: {exc}") from exc
+        if not job_input.get(name_key):
+            parsed = urlparse(image_url)
+            candidate = Path(parsed.path).name
+            if candidate:
+                image_name = candidate
+
+    image_data = job_input.get(base64_key)
+    if source is None:
+        if image_data:
+            source = image_data
+        elif isinstance(image_name, str) and looks_like_base64_payload(image_name):
+            source = image_name
+            image_name = f"{uuid.uuid4().hex}.png"
+
+    if source is None and fallback_base64:
+        source = fallback_base64
+        if not image_name:
+            image_name = f"{base64_key}-{uuid.uuid4().hex}.png"
+
+    if not source:
+        target_path = COMFY_INPUT / image_name
+        if not target_path.exists():
+            raise FileNotFoundError(f"Image {image_name} not found in {COMFY_INPUT}")
+        return image_name, None
+
+    if not image_name:
+        image_name = f"{uuid.uuid4().hex}.png"
+    else:
+        # Unique per job: concurrent or coalesced jobs must not overwrite or delete each other's inputs.
+        candidate = Path(image_name)
+        image_name = f"{candidate.stem}_{uuid.uuid4().hex[:8]}{candidate.suffix or '.png'}"
+    target_path = COMFY_INPUT / image_name
+    try:
+        if callable(source):
+            source(target_path)
+        elif isinstance(source, str):
+            decode_base64_input(source, target_path)
+        else:
+            with open(target_path, "wb") as handle:
+                handle.write(source)
+        source = None
+        target_path = normalize_input(target_path, max_side=max_side, timeline=timeline)
+    except BaseException:
+        target_path.unlink(missing_ok=True)
+        raise
+    return target_path.name, target_path
+
+
+def use_tiled_vae(job_input, width: int, height: int, batch_size: int) -> bool:
+    requested = job_input.get("tiled_vae", "auto")
+    if isinstance(requested, str) and requested.strip().lower() == "auto":
+        return width * height * batch_size > TILED_VAE_THRESHOLD
+    return _strtobool(str(requested), default=False)
+
+
+def apply_tiled_vae(workflow, nodes, job_input) -> None:
+    """Swap the whole-frame VAE nodes for their tiled variants, keeping the wiring."""
+    tile_size = int(job_input.get("vae_tile_size", VAE_TILE_SIZE))
+    overlap = int(job_input.get("vae_tile_overlap", VAE_TILE_OVERLAP))
+    if tile_size < 64 or overlap < 0 or overlap >= tile_size // 2:
+        raise ValueError("vae_tile_size must be >= 64 and vae_tile_overlap below half the tile size.")
+    for role, class_type in (("vae_decode", "VAEDecodeTiled"), ("vae_encode", "VAEEncodeTiled")):
+        if role not in nodes:
+            continue
+        node = workflow[nodes[role]]
+        node["class_type"] = class_type
+        node["inputs"].update(
+            {"tile_size": tile_size, "overlap": overlap, "temporal_size": 64, "temporal_overlap": 8}
+        )
+
+
+BUCKET_AREAS = (512 * 512, 768 * 768, 1024 * 1024, 1280 * 1280, 1536 * 1536)
+BUCKET_ASPECTS = ((1, 1), (5, 4), (4, 5), (4, 3), (3, 4), (3, 2), (2, 3), (16, 9), (9, 16), (21, 9), (9, 21))
+BUCKET_RESTORE_MODES = {"crop", "resize", "none"}
+
+
+def align_to_latent(value: float) -> int:
+    return max(LATENT_ALIGNMENT, int(round(value / LATENT_ALIGNMENT)) * LATENT_ALIGNMENT)
+
+
+def parse_bucket(spec: str) -> Tuple[int, int]:
+    match = re.fullmatch(r"\s*(\d+)\s*[xX]\s*(\d+)\s*", str(spec))
+    if not match:
+        raise ValueError(f"Invalid resolution bucket {spec!r}; expected WIDTHxHEIGHT.")
+    return align_to_latent(int(match.group(1))), align_to_latent(int(match.group(2)))
+
+
+def load_resolution_buckets(spec: str) -> list[Tuple[int, int]]:
+    """Parse `RUNPOD_RESOLUTION_BUCKETS`, or build the default area x aspect ladder."""
+    if spec.strip():
+        buckets = [parse_bucket(item) for item in spec.split(",") if item.strip()]
+    else:
+        buckets = []
+        for area in BUCKET_AREAS:
+            for aspect_w, aspect_h in BUCKET_ASPECTS:
+                width = math.sqrt(area * aspect_w / aspect_h)
+                buckets.append((align_to_latent(width), align_to_latent(area / width)))
+    return sorted(set(buckets))
+
+
+resolution_buckets = load_resolution_buckets(RESOLUTION_BUCKETS)
+
+
+def snap_to_bucket(width: int, height: int, buckets: Optional[list[Tuple[int, int]]] = None) -> Tuple[int, int]:
+    """Nearest bucket in log space, weighting aspect ratio well above area so crops stay small.
+
+    Sizes above the largest bucket area pass through unchanged: snapping them
+    down would quietly trade away the resolution the caller asked for.
+    """
+    if width <= 0 or height <= 0:
+        raise ValueError("width and height must be positive.")
+    buckets = buckets or resolution_buckets
+    if width * height > max(bucket[0] * bucket[1] for bucket in buckets):
+        return width, height
+    aspect = math.log(width / height)
+    area = math.log(width * height)
+    return min(
+        buckets,
+        key=lambda bucket: 4 * abs(math.log(bucket[0] / bucket[1]) - aspect)
+        + abs(math.log(bucket[0] * bucket[1]) - area),
+    )
+
+
+def use_resolution_bucketing(job_input) -> bool:
+    return _strtobool(str(job_input.get("resolution_bucketing", RESOLUTION_BUCKETING)), default=False)
+
+
+class BucketStats:
+    """Per-bucket request counters, used to tune `RUNPOD_RESOLUTION_BUCKETS`."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._buckets: dict[str, dict[str, int]] = {}
+        self._requested: dict[str, set[str]] = {}
+
+    def record(self, bucket: Tuple[int, int], requested: Tuple[int, int]) -> int:
+        key = f"{bucket[0]}x{bucket[1]}"
+        with self._lock:
+            entry = self._buckets.setdefault(key, {"requests": 0, "exact": 0, "warmups": 0})
+            entry["requests"] += 1
+            if bucket == requested:
+                entry["exact"] += 1
+            self._requested.setdefault(key, set()).add(f"{requested[0]}x{requested[1]}")
+            return entry["requests"]
+
+    def record_warmup(self, bucket: Tuple[int, int]) -> None:
+        key = f"{bucket[0]}x{bucket[1]}"
+        with self._lock:
+            self._buckets.setdefault(key, {"requests": 0, "exact": 0, "warmups": 0})["warmups"] += 1
+
+    def snapshot(self) -> dict[str, dict[str, int]]:
+        with self._lock:
+            return {
+                key: dict(entry, distinct_requested=len(self._requested.get(key, ())))
+                for key, entry in sorted(self._buckets.items(), key=lambda item: -item[1]["requests"])
+            }
+
+
+bucket_stats = BucketStats()
+
+
+def next_node_id(workflow) -> str:
+    numeric_ids = [int(node_id) for node_id in workflow if str(node_id).isdigit()]
+    return str(max(numeric_ids, default=0) + 1)
+
+
+def edit_strength(job_input) -> Optional[float]:
+    """Requested partial-denoise strength, or None for a full generation from an empty latent."""
+    value = job_input.get("edit_strength")
+    if value is None or value == "":
+        return None
+    strength = float(value)
+    if not 0 < strength <= 1:
+        raise ValueError("edit_strength must be in (0, 1].")
+    return strength if strength < 1 else None
+
+
+def effective_steps(job_input) -> int:
+    """Sampler steps actually run: edit mode keeps the full schedule's spacing over its shorter tail."""
+    steps = int(job_input.get("steps", DEFAULTS["steps"]))
+    strength = edit_strength(job_input)
+    if strength is None:
+        return steps
+    return max(1, int(steps * strength + 0.5))
+
+
+def apply_edit_mode(workflow, nodes, *, strength: float, steps: int, width: int, height: int, batch_size: int) -> None:
+    """Sample from the VAE-encoded reference instead of an empty latent.
+
+    KSampler with `denoise` < 1 builds a schedule of steps / denoise and runs
+    its last `steps`, so `steps` is already the scaled count. The reference is
+    resized to the output size before encoding so the latent matches it.
+    """
+    if "vae_encode" not in nodes:
+        raise ValueError("edit_strength needs a workflow that VAE-encodes the reference image.")
+    encode_inputs = workflow[nodes["vae_encode"]]["inputs"]
+    scale_id = next_node_id(workflow)
+    workflow[scale_id] = {
+        "class_type": "ImageScale",
+        "inputs": {
+            "image": encode_inputs["pixels"],
+            "upscale_method": "lanczos",
+            "width": width,
+            "height": height,
+            "crop": "center",
+        },
+        "_meta": {"title": "Reference at output size"},
+    }
+    encode_inputs["pixels"] = [scale_id, 0]
+    latent = [nodes["vae_encode"], 0]
+    if batch_size > 1:
+        repeat_id = next_node_id(workflow)
+        workflow[repeat_id] = {
+            "class_type": "RepeatLatentBatch",
+            "inputs": {"samples": latent, "amount": batch_size},
+            "_meta": {"title": "Reference latent batch"},
+        }
+        latent = [repeat_id, 0]
+    sampler_inputs = workflow[nodes["sampler"]]["inputs"]
+    sampler_inputs["latent_image"] = latent
+    sampler_inputs["steps"] = steps
+    sampler_inputs["denoise"] = strength
+
+
+def apply_bucket_restore(workflow, nodes, job_input, requested: Tuple[int, int]) -> Optional[str]:
+    """Insert an `ImageScale` between the decoder and `SaveImage` so outputs match `requested`."""
+    mode = _clean_str(str(job_input.get("bucket_restore", BUCKET_RESTORE))).lower() or "crop"
+    if mode not in BUCKET_RESTORE_MODES:
+        raise ValueError(f"bucket_restore must be one of {sorted(BUCKET_RESTORE_MODES)}.")
+    if mode == "none":
+        return None
+    save_inputs = workflow[nodes["save_image"]]["inputs"]
+    node_id = next_node_id(workflow)
+    workflow[node_id] = {
+        "class_type": "ImageScale",
+        "inputs": {
+            "image": save_inputs["images"],
+            "upscale_method": "lanczos",
+            "width": requested[0],
+            "height": requested[1],
+            "crop": "center" if mode == "crop" else "disabled",
+        },
+        "_meta": {"title": "Restore requested size"},
+    }
+    save_inputs["images"] = [node_id, 0]
+    return mode
+
+
+def build_prompt(job_input, *, timeline: Optional[TimelineLogger] = None):
+    ensure_comfy_ready()
+    template = workflow_registry.get(_clean_str(job_input.get("workflow")) or None)
+    workflow = copy.deepcopy(template.workflow)
+    nodes = dict(template.nodes)
+    validate_model_inputs(job_input, nodes)
+    cleanup_paths: list[Path] = []
+
+    width = int(job_input.get("width", DEFAULTS["width"]))
+    height = int(job_input.get("height", DEFAULTS["height"]))
+    requested = (width, height)
+    bucketed = use_resolution_bucketing(job_input)
+    if bucketed:
+        width, height = snap_to_bucket(width, height)
+        count = bucket_stats.record((width, height), requested)
+        if timeline:
+            timeline.mark(f"Resolution bucket {width}x{height} for {requested[0]}x{requested[1]} (#{count})")
+    max_side = input_max_side(job_input, width, height)
+
+    # Fetch, validate and resize both references concurrently before enqueueing.
+    executor = get_input_executor()
+    background_default_name = job_input.get("background_image_name") or f"background_{uuid.uuid4().hex}.png"
+    futures = [
+        executor.submit(prepare_image, job_input, max_side=max_side, timeline=timeline),
+        executor.submit(
+            prepare_image,
+            job_input,
+            base64_key="background_image_base64",
+            object_key="background_image_object_key",
+            url_key="background_image_url",
+            name_key="background_image_name",
+            default_name=background_default_name,
+            fallback_base64=PLACEHOLDER_PIXEL_BASE64,
+            max_side=max_side,
+            timeline=timeline,
+        ),
+    ]
+    wait(futures)
+    failures = [future.exception() for future in futures if future.exception() is not None]
+    prepared = [future.result() for future in futures if future.exception() is None]
+    for _, cleanup in prepared:
+        if cleanup:
+            cleanup_paths.append(cleanup)
+    if failures:
+        for path in cleanup_paths:
+            if path.exists():
+                path.unlink()
+        raise failures[0]
+    (image_name, _), (background_name, _) = prepared
+
+    def set_input(name, key, value):
+        if name not in nodes and name in OPTIONAL_ROLES:
+            return
+        workflow[nodes[name]]["inputs"][key] = value
+
+    set_input("model_loader", "model_name", job_input.get("model_name", DEFAULTS["model_name"]))
+    set_input("model_loader", "cpu_offload", job_input.get("cpu_offload", DEFAULTS["cpu_offload"]))
+    set_input(
+        "model_loader",
+        "num_blocks_on_gpu",
+        int(job_input.get("num_blocks_on_gpu", DEFAULTS["num_blocks_on_gpu"])),
+    )
+    set_input("model_loader", "use_pin_memory", job_input.get("use_pin_memory", DEFAULTS["use_pin_memory"]))
+
+    set_input("lora_loader", "lora_name", job_input.get("lora_name", DEFAULTS["lora_name"]))
+    set_input(
+        "lora_loader",
+        "lora_strength",
+        float(job_input.get("lora_strength", DEFAULTS["lora_strength"])),
+    )
+
+    set_input("clip_loader", "clip_name", job_input.get("clip_name", DEFAULTS["clip_name"]))
+    set_input("clip_loader", "type", job_input.get("clip_type", DEFAULTS["clip_type"]))
+    set_input("clip_loader", "device", job_input.get("clip_device", DEFAULTS["clip_device"]))
+
+    set_input("vae_loader", "vae_name", job_input.get("vae_name", DEFAULTS["vae_name"]))
+    if "load_image" in nodes:
+        set_input("load_image", "image", image_name)
+    if "background_load_image" in nodes:
+        set_input("background_load_image", "image", background_name)
+
+    prompt_text = _clean_str(job_input.get("prompt") or job_input.get("prompt_text"))
+    negative_text = _clean_str(job_input.get("negative_prompt") or job_input.get("negativePrompt"))
+
+    if not prompt_text:
+        built = _build_prompts_from_structured_forms(job_input, {"width": width, "height": height})
+        if built:
+            prompt_text = built["prompt"]
+            negative_text = built["negative"]
+    if not prompt_text:
+        prompt_text = DEFAULTS["prompt"]
+    if not negative_text:
+        negative_text = DEFAULTS["negative_prompt"]
+
+    set_input("positive", "prompt", prompt_text)
+    set_input("negative", "prompt", negative_text)
+
+    set_input("latent", "width", width)
+    set_input("latent", "height", height)
+    batch_size = int(job_input.get("batch_size", DEFAULTS["batch_size"]))
+    set_input("latent", "batch_size", batch_size)
+    if use_tiled_vae(job_input, width, height, batch_size):
+        apply_tiled_vae(workflow, nodes, job_input)
+        if timeline:
+            timeline.mark(f"Tiled VAE enabled for {width}x{height} x{batch_size}")
+
+    set_input("sampling_wrapper", "shift", float(job_input.get("shift", DEFAULTS["shift"])))
+
+    sampler_inputs = workflow[nodes["sampler"]]["inputs"]
+    sampler_inputs["seed"] = int(job_input.get("seed", DEFAULTS["seed"]))
+    sampler_inputs["steps"] = int(job_input.get("steps", DEFAULTS["steps"]))
+    sampler_inputs["cfg"] = float(job_input.get("cfg", DEFAULTS["cfg"]))
+    sampler_inputs["sampler_name"] = job_input.get("sampler_name", DEFAULTS["sampler_name"])
+    sampler_inputs["scheduler"] = job_input.get("scheduler", DEFAULTS["scheduler"])
+    sampler_inputs["denoise"] = float(job_input.get("denoise", DEFAULTS["denoise"]))
+    strength = edit_strength(job_input)
+    if strength is not None:
+        steps = effective_steps(job_input)
+        apply_edit_mode(
+            workflow, nodes, strength=strength, steps=steps, width=width, height=height, batch_size=batch_size
+        )
+        if timeline:
+            timeline.mark(f"Edit mode: denoise {strength:g} from the encoded reference, {steps} step(s)")
+
+    set_input("save_image", "filename_prefix", job_input.get("filename_prefix", DEFAULTS["filename_prefix"]))
+    fused = apply_fused_lora(workflow, nodes, job_input)
+    if timeline and fused:
+        timeline.mark(f"Loading fused checkpoint {fused}; LoRA node bypassed")
+    if bucketed and (width, height) != requested:
+        restore = apply_bucket_restore(workflow, nodes, job_input, requested)
+        if timeline and restore:
+            timeline.mark(f"Output restored to {requested[0]}x{requested[1]} by {restore}")
+
+    return workflow, nodes["save_image"], cleanup_paths
+
+
+def upload_output_image(output_path: Path, *, job_id: Optional[str], index: int, timeline: TimelineLogger) -> dict[str, str]:
+    """Upload one output to RunPod storage; an empty dict means it was not uploaded."""
+    payload: dict[str, str] = {}
+    if not (_strtobool(UPLOAD_OUTPUTS, default=True) and storage_available()):
+        return payload
+    try:
+        timeline.mark(f"Uploading output {index} to RunPod storage", dedupe=False)
+        object_key = upload_storage_object(output_path, job_id=job_id)
+        payload["image_object_key"] = object_key
+        public_url = derive_public_url(object_key)
+        if public_url:
+            payload["image_url"] = public_url
+        if _strtobool(PRESIGN_OUTPUTS, default=True):
+            payload["image_download_url"] = presign_storage_url("get_object", object_key)
+    except Exception as exc:
+        timeline.mark(f"Output {index} upload failed: {exc}", dedupe=False)
+        return {}
+    return payload
+
+
+def package_outputs(
+    output_paths: list[Path],
+    *,
+    job_id: Optional[str],
+    include_base64: bool,
+    timeline: TimelineLogger,
+) -> dict:
+    """Upload every output image in parallel, then base64-encode the ones the response needs.
+
+    A single image is returned with the legacy top-level keys. Batches get an
+    ordered `images` list with one entry per output; the top level keeps the
+    first image's key and URL but not its base64, which would double the
+    response size.
+    """
+    try:
+        if len(output_paths) == 1:
+            results = [upload_output_image(output_paths[0], job_id=job_id, index=0, timeline=timeline)]
+        else:
+            executor = get_output_executor()
+            futures = [
+                executor.submit(upload_output_image, path, job_id=job_id, index=index, timeline=timeline)
+                for index, path in enumerate(output_paths)
+            ]
+            # The files are removed below, so let every upload finish before raising.
+            wait(futures)
+            results = [future.result() for future in futures]
+        # Base64 is skipped only once the bytes are safely in the bucket.
+        pending = [index for index, payload in enumerate(results) if include_base64 or not payload]
+        for index, encoded in zip(pending, encode_outputs_base64([output_paths[index] for index in pending])):
+            results[index]["image_base64"] = encoded
+    finally:
+        for path in output_paths:
+            if path.exists():
+                os.remove(path)
+    response_payload: dict = dict(results[0])
+    if len(results) > 1:
+        response_payload.pop("image_base64", None)
+        response_payload["images"] = results
+    return response_payload
+
+
+def workflow_fingerprint(workflow) -> str:
+    """Canonical hash of a built workflow, with input file names replaced by content hashes.
+
+    Two jobs with the same graph parameters and byte-identical reference images
+    map to the same key even though their inputs were written under different
+    (random) file names.
+    """
+    canonical = copy.deepcopy(workflow)
+    for node in canonical.values():
+        node.pop("_meta", None)
+        if node.get("class_type") != "LoadImage":
+            continue
+        image = node["inputs"].get("image")
+        path = COMFY_INPUT / str(image)
+        if isinstance(image, str) and path.is_file():
+            digest = hashlib.sha256()
+            with open(path, "rb") as handle:
+                for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            node["inputs"]["image"] = f"sha256:{digest.hexdigest()}"
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class InFlightExecution:
+    def __init__(self, job_id: Optional[str]) -> None:
+        self.job_id = job_id
+        self.done = threading.Event()
+        self.result: Optional[dict] = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Let identical concurrent jobs share one ComfyUI execution."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: dict[str, InFlightExecution] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def join(self, key: str, job_id: Optional[str]) -> Tuple[InFlightExecution, bool]:
+        """Return the flight for `key` and whether the caller leads (must execute) it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = InFlightExecution(job_id)
+            self._flights[key] = flight
+            self.executions += 1
+            return flight, True
+
+    def finish(self, key: str, flight: InFlightExecution, result: dict) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.done.set()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"executions": self.executions, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+
+single_flight = SingleFlight()
+
+
+def run_workflow(
+    workflow,
+    output_node_id: str,
+    *,
+    job_id: Optional[str],
+    timeout: float,
+    include_base64: bool,
+    timeline: TimelineLogger,
+    discard_outputs: bool = False,
+    on_outputs: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    prompt_id = str(uuid.uuid4())
+    queue_item = (
+        time.time(),
+        prompt_id,
+        workflow,
+        {},
+        [output_node_id],
+        {},
+    )
+    server.prompt_queue.put(queue_item)
+    timeline.mark("Workflow enqueued")
+
+    start = time.time()
+    graph_started = False
+
+    try:
+        while time.time() - start < timeout:
+            history = server.prompt_queue.get_history(prompt_id=prompt_id)
+            record = history.get(prompt_id)
+            if record:
+                if not graph_started:
+                    timeline.mark("Graph execution started", dedupe=False)
+                    graph_started = True
+                status = record.get("status") or {}
+                timeline.mark_status_messages(status.get("messages"))
+                outputs = record.get("outputs") or {}
                 if output_node_id in outputs:
                     images = outputs[output_node_id].get("images", [])
                     if images:
-                        image_info = images[0]
-                        filename = image_info["filename"]
-                        subfolder = image_info.get("subfolder", "")
-                        output_path = (
-                            COMFY_OUTPUT / subfolder / filename if subfolder else COMFY_OUTPUT / filename
-                        )
+                        output_paths = [resolve_output_path(image_info) for image_info in images]
                         timeline.mark("Sampling finished")
-                        response_payload: dict[str, str] = {}
-                        uploaded = False
-                        if _strtobool(UPLOAD_OUTPUTS, default=True) and storage_available():
-                            try:
-                                timeline.mark("Uploading output to RunPod storage")
-                                object_key = upload_storage_object(output_path, job_id=job_id)
-                                response_payload["image_object_key"] = object_key
-                                public_url = derive_public_url(object_key)
-                                if public_url:
-                                    response_payload["image_url"] = public_url
-                                uploaded = True
-                            except Exception as exc:
-                                timeline.mark(f"Output upload failed: {exc}", dedupe=False)
-                        include_base64 = _strtobool(INCLUDE_OUTPUT_BASE64, default=True)
-                        if include_base64 or not uploaded:
-                            with open(output_path, "rb") as created:
-                                encoded = base64.b64encode(created.read()).decode("utf-8")
-                                response_payload["image_base64"] = encoded
+                        started, finished = execution_window(status)
+                        if started is not None and finished is not None:
+                            timeline.execution_s = max(0.0, finished - started)
+                        if on_outputs is not None:
+                            # The GPU is free from here on; packaging overlaps the next job.
+                            on_outputs(status)
+                        peak = prompt_peak_vram_mib(prompt_id)
+                        if peak is not None:
+                            timeline.mark(f"Peak VRAM {peak:0.0f} MiB")
+                        if discard_outputs:
+                            for path in output_paths:
+                                path.unlink(missing_ok=True)
+                            response_payload = {"images": len(output_paths)}
+                        else:
+                            response_payload = package_outputs(
+                                output_paths, job_id=job_id, include_base64=include_base64, timeline=timeline
+                            )
                         timeline.mark("Response sent", dedupe=False)
-                        os.remove(output_path)
                         server.prompt_queue.delete_history_item(prompt_id)
-                        for path in cleanup_paths:
-                            if path and path.exists():
-                                path.unlink()
-                        timeline.mark("Request completed", dedupe=False)
                         return response_payload
                 if status and not status.get("completed", True):
                     messages = status.get("messages") or []
@@ -807,12 +2947,1489 @@ def handler(job):
         timeline.mark("Timed out waiting for workflow output", dedupe=False)
         return {"error": "Timed out waiting for workflow output"}
     except Exception as exc:
-        timeline.mark(f"An error occurred: {exc}", dedupe=False)
-        return {"error": f"An error occurred: {exc}"}
+        timeline.mark(f"An error occurred: {exc}", dedupe=False)
+        return {"error": f"An error occurred: {exc}"}
+
+
+# Progressively lighter execution profiles tried after an out-of-memory failure.
+OOM_PROFILES = (
+    {},
+    {"tiled_vae": True},
+    {"tiled_vae": True, "cpu_offload": "enable", "num_blocks_on_gpu": 20, "use_pin_memory": "enable"},
+    {"tiled_vae": True, "cpu_offload": "enable", "num_blocks_on_gpu": 8, "use_pin_memory": "enable"},
+    {"tiled_vae": True, "cpu_offload": "enable", "num_blocks_on_gpu": 1, "use_pin_memory": "enable"},
+)
+OOM_ERROR_RE = re.compile(
+    r"out of memory|OutOfMemoryError|CUDA_ERROR_OUT_OF_MEMORY|allocation on device|\bOOM\b", re.IGNORECASE
+)
+
+
+def is_oom_error(message: Optional[str]) -> bool:
+    return bool(message) and bool(OOM_ERROR_RE.search(message))
+
+
+def resolution_class(workflow) -> int:
+    """Work size of a built workflow in units of 512x512 latent pixels (times batch)."""
+    for node in workflow.values():
+        if node.get("class_type") == "EmptySD3LatentImage":
+            inputs = node["inputs"]
+            pixels = int(inputs["width"]) * int(inputs["height"]) * int(inputs.get("batch_size", 1))
+            return max(1, math.ceil(pixels / (512 * 512)))
+    return 1
+
+
+def apply_memory_profile(workflow, profile: dict, job_input) -> None:
+    """Lighten a built workflow in place; never makes a job heavier than it asked for."""
+    vae_nodes = {}
+    for node_id, node in workflow.items():
+        class_type = node.get("class_type")
+        if class_type == "NunchakuQwenImageDiTLoader":
+            inputs = node["inputs"]
+            if "cpu_offload" in profile:
+                inputs["cpu_offload"] = profile["cpu_offload"]
+            if "num_blocks_on_gpu" in profile:
+                current = int(inputs.get("num_blocks_on_gpu", profile["num_blocks_on_gpu"]))
+                inputs["num_blocks_on_gpu"] = min(current, profile["num_blocks_on_gpu"])
+            if "use_pin_memory" in profile:
+                inputs["use_pin_memory"] = profile["use_pin_memory"]
+        elif class_type == "VAEDecode":
+            vae_nodes["vae_decode"] = node_id
+        elif class_type == "VAEEncode":
+            vae_nodes["vae_encode"] = node_id
+    if profile.get("tiled_vae") and vae_nodes:
+        apply_tiled_vae(workflow, vae_nodes, job_input)
+
+
+class OomProfileMemory:
+    """Remembers the lightest profile that was needed per resolution class.
+
+    A class at least as large as one that needed level N starts at level N too,
+    so only the first oversized job of a shape pays for the failed attempts.
+    After `decay_successes` clean jobs at a remembered level, that level drops
+    by one, so a transient squeeze (another tenant, fragmentation) does not pin
+    a class to a slow profile forever. If the lighter level still runs out of
+    memory, the retry raises it again.
+    """
+
+    def __init__(self, decay_successes: int = OOM_DECAY_SUCCESSES) -> None:
+        self._lock = threading.Lock()
+        self._levels: dict[int, int] = {}
+        self._streaks: dict[int, int] = {}
+        self.decay_successes = decay_successes
+        self.oom_failures = 0
+        self.recovered = 0
+        self.decays = 0
+
+    def _governing(self, units: int) -> Optional[int]:
+        """Remembered class whose level a job of `units` starts at (caller holds the lock)."""
+        candidates = [size for size in self._levels if size <= units]
+        return max(candidates, key=lambda size: (self._levels[size], size)) if candidates else None
+
+    def start_level(self, units: int) -> int:
+        with self._lock:
+            governing = self._governing(units)
+            return self._levels[governing] if governing is not None else 0
+
+    def record_oom(self, units: int) -> None:
+        with self._lock:
+            self.oom_failures += 1
+            for size in self._streaks:
+                if size <= units:
+                    self._streaks[size] = 0
+
+    def record_success(self, units: int, level: int, *, retried: bool) -> None:
+        with self._lock:
+            if retried:
+                self.recovered += 1
+            governing = self._governing(units)
+            start = self._levels[governing] if governing is not None else 0
+            if level > start:
+                self._levels[units] = level
+                self._streaks[units] = 0
+                return
+            if retried or governing is None or level != start or self.decay_successes <= 0:
+                return
+            self._streaks[governing] = self._streaks.get(governing, 0) + 1
+            if self._streaks[governing] >= self.decay_successes:
+                self._streaks[governing] = 0
+                self.decays += 1
+                if self._levels[governing] > 1:
+                    self._levels[governing] -= 1
+                else:
+                    del self._levels[governing]
+                    del self._streaks[governing]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "oom_failures": self.oom_failures,
+                "recovered": self.recovered,
+                "decays": self.decays,
+                "levels": {f"{units * 0.25:g}MP": level for units, level in sorted(self._levels.items())},
+            }
+
+
+oom_memory = OomProfileMemory()
+
+
+def free_comfy_memory(timeline: TimelineLogger) -> None:
+    """Drop ComfyUI's loaded models and node cache, then release cached CUDA blocks.
+
+    The prompt worker does the unloading (same flags as ComfyUI's POST /free) so
+    it never races a prompt that is loading models; we wait for it to clear them.
+    Only a ComfyUI without flags gets a direct unload, with the GPU kept idle.
+    """
+    queue = server.prompt_queue
+    set_flag = getattr(queue, "set_flag", None)
+    if set_flag is None:
+        pipeline = get_pipeline()
+        try:
+            with pipeline.exclusive() if pipeline is not None else nullcontext():
+                model_management = import_module("comfy.model_management")
+                model_management.unload_all_models()
+                model_management.soft_empty_cache()
+        except Exception as exc:
+            timeline.mark(f"Model unload failed: {exc}", dedupe=False)
+        gc.collect()
+        return
+    set_flag("unload_models", True)
+    set_flag("free_memory", True)
+    gc.collect()
+    deadline = time.time() + OOM_FREE_WAIT
+    while getattr(queue, "flags", None) and time.time() < deadline:
+        time.sleep(0.1)
+
+
+def run_workflow_adaptive(
+    workflow,
+    output_node_id: str,
+    *,
+    job_input,
+    job_id: Optional[str],
+    timeout: float,
+    include_base64: bool,
+    timeline: TimelineLogger,
+    on_outputs: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """`run_workflow` that retries out-of-memory failures with lighter `OOM_PROFILES`."""
+    if not _strtobool(str(job_input.get("oom_retry", OOM_RETRY)), default=True):
+        return run_workflow(
+            workflow,
+            output_node_id,
+            job_id=job_id,
+            timeout=timeout,
+            include_base64=include_base64,
+            timeline=timeline,
+            on_outputs=on_outputs,
+        )
+
+    units = resolution_class(workflow)
+    level = oom_memory.start_level(units)
+    if level:
+        apply_memory_profile(workflow, OOM_PROFILES[level], job_input)
+        timeline.mark(f"Starting at memory profile {level} remembered for this resolution class")
+    deadline = time.time() + timeout
+    retried = False
+    while True:
+        result = run_workflow(
+            workflow,
+            output_node_id,
+            job_id=job_id,
+            timeout=max(1.0, deadline - time.time()),
+            include_base64=include_base64,
+            timeline=timeline,
+            on_outputs=on_outputs,
+        )
+        if "error" not in result:
+            oom_memory.record_success(units, level, retried=retried)
+            return result
+        if not is_oom_error(result["error"]):
+            return result
+        oom_memory.record_oom(units)
+        if level + 1 >= len(OOM_PROFILES) or time.time() >= deadline:
+            return result
+        level += 1
+        retried = True
+        timeline.mark(f"Out of memory; freeing caches and retrying with memory profile {level}", dedupe=False)
+        free_comfy_memory(timeline)
+        apply_memory_profile(workflow, OOM_PROFILES[level], job_input)
+
+
+class Reservation:
+    """A look-ahead slot: held from the start of preparation until the job reaches the GPU."""
+
+    def __init__(self, semaphore: threading.BoundedSemaphore) -> None:
+        self._semaphore = semaphore
+        self._held = True
+
+    def release(self) -> None:
+        if self._held:
+            self._held = False
+            self._semaphore.release()
+
+
+def execution_window(status) -> Tuple[Optional[float], Optional[float]]:
+    """Start/end (epoch seconds) of a prompt from ComfyUI's timestamped status messages."""
+    started = finished = None
+    for entry in (status or {}).get("messages") or []:
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2 or not isinstance(entry[1], dict):
+            continue
+        event, payload = entry
+        timestamp = payload.get("timestamp")
+        if not isinstance(timestamp, (int, float)):
+            continue
+        if event == "execution_start":
+            started = timestamp / 1000
+        elif event in ("execution_success", "execution_error", "execution_interrupted"):
+            finished = timestamp / 1000
+    return started, finished
+
+
+class GpuTurn:
+    def __init__(self, pipeline: "ExecutionPipeline", timeline: TimelineLogger) -> None:
+        self._pipeline = pipeline
+        self._timeline = timeline
+        self._released = False
+        self.admitted_at = time.time()
+
+    def release(self, status=None) -> None:
+        if not self._released:
+            self._released = True
+            self._pipeline._release_gpu(self, status)
+
+
+class ExecutionPipeline:
+    """Overlaps the preparation of up to `depth` queued jobs with the job running on the GPU.
+
+    A job reserves a look-ahead slot before fetching inputs and building its
+    graph, then waits (FIFO, in order of readiness) for admission to ComfyUI's
+    prompt queue. Two prompts are admitted at a time, the running one and the
+    next, so the executor starts the next prompt without waiting on handler
+    polling. A turn ends as soon as outputs exist, so packaging overlaps the
+    next execution. GPU idle time is the gap between one prompt's end and the
+    next one's start, taken from ComfyUI's status timestamps. It is split by
+    whether the next job had already been admitted when the GPU went idle.
+    """
+
+    ADMITTED = 2
+
+    def __init__(self, depth: int) -> None:
+        self.depth = depth
+        self._slots = threading.BoundedSemaphore(depth)
+        self._gpu = threading.Condition()
+        self._admitted = 0
+        self._waiting: deque = deque()
+        self._exclusive = 0
+        self._last_end: Optional[float] = None
+        self._gaps: deque = deque(maxlen=512)
+        self._backlog_gaps: deque = deque(maxlen=512)
+        self.executed = 0
+        self.cancelled = 0
+
+    def reserve(self, should_abort: Callable[[], bool]) -> Optional[Reservation]:
+        while not self._slots.acquire(timeout=0.1):
+            if should_abort():
+                return None
+        return Reservation(self._slots)
+
+    @contextmanager
+    def gpu_turn(self, reservation: Optional[Reservation], should_abort: Callable[[], bool], timeline: TimelineLogger):
+        ticket = object()
+        ready_at = time.perf_counter()
+        acquired = False
+        with self._gpu:
+            self._waiting.append(ticket)
+            while self._admitted >= self.ADMITTED or self._exclusive or self._waiting[0] is not ticket:
+                if should_abort():
+                    self._waiting.remove(ticket)
+                    self.cancelled += 1
+                    self._gpu.notify_all()
+                    break
+                self._gpu.wait(0.1)
+            else:
+                self._waiting.popleft()
+                self._admitted += 1
+                acquired = True
+                waited = time.perf_counter() - ready_at
+                if waited > 0.001:
+                    timeline.mark(f"Prepared; waited {waited:0.2f}s for admission", dedupe=False)
+        if reservation is not None:
+            reservation.release()
+        if not acquired:
+            yield None
+            return
+        turn = GpuTurn(self, timeline)
+        try:
+            yield turn
+        finally:
+            turn.release()
+
+    @contextmanager
+    def exclusive(self):
+        """Keep ComfyUI idle: drain admitted prompts and admit nothing until the block exits."""
+        with self._gpu:
+            self._exclusive += 1
+            while self._admitted:
+                self._gpu.wait(0.1)
+        try:
+            yield
+        finally:
+            with self._gpu:
+                self._exclusive -= 1
+                self._gpu.notify_all()
+
+    def _release_gpu(self, turn: GpuTurn, status) -> None:
+        started, finished = execution_window(status)
+        with self._gpu:
+            self._admitted -= 1
+            self._gpu.notify_all()
+            if status is None:
+                # Failed or timed out before outputs: no reliable window, just advance the clock.
+                self._last_end = max(self._last_end or 0.0, time.time())
+                return
+            self.executed += 1
+            if started is None or finished is None:
+                # Status without timestamps: fall back to what the handler observed.
+                started, finished = turn.admitted_at, time.time()
+            gap = None
+            if self._last_end is not None and started >= self._last_end:
+                gap = started - self._last_end
+                self._gaps.append(gap)
+                if turn.admitted_at <= self._last_end:
+                    self._backlog_gaps.append(gap)
+            self._last_end = max(self._last_end or 0.0, finished)
+        if gap is not None:
+            turn._timeline.mark(f"GPU idle {gap * 1000:0.1f} ms before this job", dedupe=False)
+
+    def stats(self) -> dict:
+        def summary(values) -> dict:
+            ordered = sorted(values)
+            if not ordered:
+                return {"count": 0}
+            return {
+                "count": len(ordered),
+                "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+                "total_ms": round(sum(ordered) * 1000, 1),
+            }
+
+        with self._gpu:
+            return {
+                "depth": self.depth,
+                "executed": self.executed,
+                "cancelled": self.cancelled,
+                "admitted": self._admitted,
+                "waiting": len(self._waiting),
+                "gpu_idle_between_jobs": summary(self._gaps),
+                "gpu_idle_with_backlog": summary(self._backlog_gaps),
+            }
+
+
+_pipeline: Optional[ExecutionPipeline] = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> Optional[ExecutionPipeline]:
+    global _pipeline
+    if PIPELINE_DEPTH <= 0:
+        return None
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = ExecutionPipeline(PIPELINE_DEPTH)
+    return _pipeline
+
+
+ADMISSION_MODES = ("off", "observe", "reject", "defer")
+
+
+def cost_features(width: int, height: int, batch_size: int, steps: int) -> Tuple[float, float, float]:
+    megapixels = width * height * batch_size / 1_000_000
+    return (megapixels * steps, megapixels, 1.0)
+
+
+def job_cost_features(job_input) -> Tuple[float, float, float]:
+    """Cost features of a request before its graph is built (mirrors build_prompt's sizing)."""
+    width = int(job_input.get("width", DEFAULTS["width"]))
+    height = int(job_input.get("height", DEFAULTS["height"]))
+    if use_resolution_bucketing(job_input):
+        width, height = snap_to_bucket(width, height)
+    try:
+        steps = effective_steps(job_input)
+    except ValueError:  # rejected later by build_prompt with a proper message
+        steps = int(job_input.get("steps", DEFAULTS["steps"]))
+    return cost_features(width, height, int(job_input.get("batch_size", DEFAULTS["batch_size"])), steps)
+
+
+def workflow_cost_features(workflow) -> Optional[Tuple[float, float, float]]:
+    latent = steps = None
+    for node in workflow.values():
+        if node.get("class_type") == "EmptySD3LatentImage":
+            latent = node["inputs"]
+        elif node.get("class_type") == "KSampler":
+            steps = node["inputs"].get("steps")
+    if latent is None or steps is None:
+        return None
+    return cost_features(int(latent["width"]), int(latent["height"]), int(latent.get("batch_size", 1)), int(steps))
+
+
+def _relative_error_summary(values) -> dict:
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+    return {
+        "count": len(ordered),
+        "p50": round(ordered[len(ordered) // 2], 3),
+        "p90": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))], 3),
+    }
+
+
+class CostModel:
+    """Online fit of GPU execution seconds: a·(megapixels × steps) + b·megapixels + c.
+
+    Updated by recursive least squares with a forgetting factor, so the fit
+    follows driver, offload and traffic changes. Once trusted, observations
+    above `OUTLIER_RATIO` × the prediction (model loads after a restart or a
+    switch) are counted but not learned. Non-GPU time per job (preparation and
+    packaging) is tracked as a moving average.
+    """
+
+    FORGET = 0.98
+    OUTLIER_RATIO = 3.0
+
+    def __init__(self, min_samples: int = ADMISSION_MIN_SAMPLES) -> None:
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self.theta = [0.0, 0.0, 0.0]
+        self._p = [[1000.0 if row == col else 0.0 for col in range(3)] for row in range(3)]
+        self.samples = 0
+        self.outliers = 0
+        self.overhead_s: Optional[float] = None
+        self._errors: deque = deque(maxlen=256)
+
+    @property
+    def trusted(self) -> bool:
+        return self.samples >= self.min_samples
+
+    def predict(self, features) -> Optional[float]:
+        with self._lock:
+            if not self.samples:
+                return None
+            return max(0.05, sum(weight * value for weight, value in zip(self.theta, features)))
+
+    def observe(self, features, execution_s: float, overhead_s: Optional[float] = None) -> None:
+        predicted = self.predict(features)
+        with self._lock:
+            if predicted is not None:
+                self._errors.append(abs(predicted - execution_s) / max(execution_s, 0.05))
+            if overhead_s is not None:
+                self.overhead_s = overhead_s if self.overhead_s is None else 0.8 * self.overhead_s + 0.2 * overhead_s
+            if self.trusted and predicted is not None and execution_s > self.OUTLIER_RATIO * predicted:
+                self.outliers += 1
+                return
+            p = self._p
+            px = [sum(p[row][col] * features[col] for col in range(3)) for row in range(3)]
+            denominator = self.FORGET + sum(features[row] * px[row] for row in range(3))
+            gain = [value / denominator for value in px]
+            residual = execution_s - sum(weight * value for weight, value in zip(self.theta, features))
+            self.theta = [weight + g * residual for weight, g in zip(self.theta, gain)]
+            self._p = [
+                [(p[row][col] - gain[row] * px[col]) / self.FORGET for col in range(3)] for row in range(3)
+            ]
+            self.samples += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "samples": self.samples,
+                "trusted": self.trusted,
+                "outliers_skipped": self.outliers,
+                "coefficients": {
+                    "s_per_megapixel_step": round(self.theta[0], 4),
+                    "s_per_megapixel": round(self.theta[1], 4),
+                    "s_fixed": round(self.theta[2], 4),
+                },
+                "overhead_s": round(self.overhead_s, 3) if self.overhead_s is not None else None,
+                "execution_relative_error": _relative_error_summary(self._errors),
+            }
+
+
+class AdmissionTicket:
+    def __init__(self, ticket_id: int, estimate: dict, features) -> None:
+        self.id = ticket_id
+        self.estimate = estimate
+        self.features = features
+        self.admitted_at = time.time()
+
+
+class AdmissionController:
+    """Predicts when a job would finish and turns away jobs that would miss their `timeout`.
+
+    The ETA is the predicted GPU work of admitted jobs still in flight (minus
+    what the running one has already done), plus this job's predicted
+    execution and the average preparation/packaging time. Nothing is rejected
+    or deferred until the cost model is trusted.
+    """
+
+    def __init__(self, model: CostModel) -> None:
+        self.model = model
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._inflight: OrderedDict[int, float] = OrderedDict()
+        self._busy_since = time.time()
+        self.admitted = 0
+        self.rejected = 0
+        self.deferred = 0
+        self._eta_errors: deque = deque(maxlen=256)
+
+    def _backlog(self) -> float:
+        if not self._inflight:
+            return 0.0
+        head = next(iter(self._inflight.values()))
+        done = min(head, time.time() - self._busy_since)
+        return max(0.0, sum(self._inflight.values()) - done)
+
+    def estimate(self, job_input, features=None) -> dict:
+        features = features or job_cost_features(job_input)
+        predicted = self.model.predict(features)
+        with self._lock:
+            queue_s = self._backlog()
+            ahead = len(self._inflight)
+        overhead = self.model.overhead_s or 0.0
+        return {
+            "predicted_execution_s": round(predicted, 2) if predicted is not None else None,
+            "queue_s": round(queue_s, 2),
+            "jobs_ahead": ahead,
+            "eta_s": round(queue_s + predicted + overhead, 2) if predicted is not None else None,
+            "trusted": self.model.trusted,
+        }
+
+    def admit(
+        self, job_input, *, timeout: float, mode: str, should_abort: Callable[[], bool], timeline: TimelineLogger
+    ) -> Tuple[Optional[AdmissionTicket], dict]:
+        features = job_cost_features(job_input)
+        estimate = self.estimate(job_input, features)
+        enforce = mode in ("reject", "defer") and estimate["eta_s"] is not None and self.model.trusted
+        if enforce and estimate["eta_s"] > timeout:
+            alone = estimate["predicted_execution_s"] + (self.model.overhead_s or 0.0)
+            if mode == "defer" and alone <= timeout:
+                with self._lock:
+                    self.deferred += 1
+                timeline.mark(f"Deferred: ETA {estimate['eta_s']:0.1f}s exceeds timeout {timeout:0.0f}s", dedupe=False)
+                deadline = time.time() + ADMISSION_MAX_DEFER
+                while estimate["eta_s"] > timeout and time.time() < deadline and not should_abort():
+                    time.sleep(0.25)
+                    estimate = self.estimate(job_input, features)
+            if estimate["eta_s"] > timeout:
+                with self._lock:
+                    self.rejected += 1
+                return None, estimate
+        with self._lock:
+            if not self._inflight:
+                self._busy_since = time.time()
+            ticket = AdmissionTicket(next(self._ids), estimate, features)
+            self._inflight[ticket.id] = estimate["predicted_execution_s"] or 0.0
+            self.admitted += 1
+        if estimate["eta_s"] is not None:
+            timeline.mark(
+                f"Admitted: ETA {estimate['eta_s']:0.1f}s ({estimate['jobs_ahead']} ahead, "
+                f"predicted execution {estimate['predicted_execution_s']:0.1f}s)",
+                dedupe=False,
+            )
+        return ticket, estimate
+
+    def release(self, ticket: AdmissionTicket) -> None:
+        """Drop a ticket without learning from it (coalesced followers, failures)."""
+        with self._lock:
+            head = next(iter(self._inflight), None)
+            # Only the head is the running job; dropping a queued ticket must not restart its clock.
+            if self._inflight.pop(ticket.id, None) is not None and ticket.id == head:
+                self._busy_since = time.time()
+
+    def finish(self, ticket: AdmissionTicket, workflow, timeline: TimelineLogger, *, prepare_s: float) -> None:
+        self.release(ticket)
+        if timeline.execution_s is None:
+            return
+        features = (workflow_cost_features(workflow) if workflow else None) or ticket.features
+        marks: dict[str, float] = {}
+        for label, elapsed in timeline.events:
+            marks.setdefault(label, elapsed)
+        overhead = None
+        if "Sampling finished" in marks and "Response sent" in marks:
+            overhead = prepare_s + marks["Response sent"] - marks["Sampling finished"]
+        self.model.observe(features, timeline.execution_s, overhead)
+        eta = ticket.estimate.get("eta_s")
+        if eta is not None:
+            actual = time.time() - ticket.admitted_at
+            with self._lock:
+                self._eta_errors.append(abs(eta - actual) / max(actual, 0.05))
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "deferred": self.deferred,
+                "in_flight": len(self._inflight),
+                "queue_s": round(self._backlog(), 2),
+                "eta_relative_error": _relative_error_summary(self._eta_errors),
+            }
+        return {"mode": admission_mode(), **counters, "model": self.model.stats()}
+
+
+def admission_mode(job_input=None) -> str:
+    mode = _clean_str((job_input or {}).get("admission")) or ADMISSION
+    mode = mode.lower()
+    return mode if mode in ADMISSION_MODES else "observe"
+
+
+_admission: Optional[AdmissionController] = None
+_admission_lock = threading.Lock()
+
+
+def get_admission_controller() -> Optional[AdmissionController]:
+    global _admission
+    if admission_mode() == "off":
+        return None
+    with _admission_lock:
+        if _admission is None:
+            _admission = AdmissionController(CostModel())
+    return _admission
+
+
+def warmup_resolution_buckets(spec, *, timeline: TimelineLogger) -> dict[str, dict]:
+    """Run a one-step job per bucket so its kernels, allocations and node cache are hot.
+
+    Warming every bucket is dozens of jobs, so it needs an explicit "all".
+    """
+    if spec in (None, "", []):
+        raise ValueError('No buckets to warm; list them or pass "all" for every bucket.')
+    if spec == "all" or spec == ["all"]:
+        buckets = list(resolution_buckets)
+    elif isinstance(spec, str):
+        buckets = [parse_bucket(item) for item in spec.split(",") if item.strip()]
+    else:
+        buckets = [parse_bucket(item) for item in spec]
+    results: dict[str, dict] = {}
+    for width, height in buckets:
+        key = f"{width}x{height}"
+        started = time.perf_counter()
+        job_input = {
+            "width": width,
+            "height": height,
+            "steps": 1,
+            "image_base64": PLACEHOLDER_PIXEL_BASE64,
+            "resolution_bucketing": False,
+            "filename_prefix": "warmup/bucket",
+        }
+        try:
+            workflow, output_node_id, cleanup_paths = build_prompt(job_input, timeline=timeline)
+        except Exception as exc:
+            results[key] = {"error": str(exc), "seconds": 0.0}
+            continue
+        try:
+            outcome = run_workflow(
+                workflow,
+                output_node_id,
+                job_id=None,
+                timeout=600,
+                include_base64=False,
+                timeline=timeline,
+                discard_outputs=True,
+            )
+        except Exception as exc:
+            outcome = {"error": str(exc)}
+        finally:
+            for path in cleanup_paths:
+                path.unlink(missing_ok=True)
+        elapsed = time.perf_counter() - started
+        if "error" in outcome:
+            results[key] = {"error": outcome["error"], "seconds": round(elapsed, 3)}
+        else:
+            bucket_stats.record_warmup((width, height))
+            results[key] = {"seconds": round(elapsed, 3)}
+        timeline.mark(f"Warmed bucket {key} in {elapsed:0.2f}s", dedupe=False)
+    return results
+
+
+TRACE_STAGES = {
+    "Comfy ready": "comfy_ready",
+    "Workflow prepared": "prepared",
+    "Workflow enqueued": "enqueued",
+    "Graph execution started": "graph_started",
+    "Sampling finished": "sampling_finished",
+    "Response sent": "response_sent",
+    "Request completed": "completed",
+}
+TRACE_TEXT_KEYS = {"prompt", "prompt_text", "negative_prompt", "negativePrompt"}
+TRACE_STRUCTURED_KEYS = {"character", "background", "combo"}
+
+
+def _redact_text(value):
+    if isinstance(value, str):
+        return {"_redacted": "text", "chars": len(value)}
+    if isinstance(value, dict):
+        return {key: _redact_text(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_redact_text(item) for item in value]
+    return value
+
+
+def sanitize_job_input(job_input, *, keep_prompts: bool = False) -> dict:
+    """Copy of a job input that is safe to persist: no image bytes, URL credentials or (by default) prompts."""
+    sanitized = {}
+    for key, value in job_input.items():
+        if key.endswith("_base64") and isinstance(value, str):
+            sanitized[key] = {"_redacted": "base64", "chars": len(value)}
+        elif key.endswith("_name") and isinstance(value, str) and looks_like_base64_payload(value):
+            sanitized[key] = {"_redacted": "base64", "chars": len(value)}
+        elif key.endswith("_url") and isinstance(value, str):
+            # Presigned query strings carry credentials.
+            sanitized[key] = value.split("?", 1)[0]
+        elif not keep_prompts and (key in TRACE_TEXT_KEYS or key in TRACE_STRUCTURED_KEYS):
+            sanitized[key] = _redact_text(value)
+        else:
+            sanitized[key] = copy.deepcopy(value)
+    return sanitized
+
+
+class TraceRecorder:
+    """Appends one JSON line per job: arrival time, sanitised input, stage offsets and outcome."""
+
+    def __init__(self, path: Path, *, sample_rate: float = 1.0, keep_prompts: bool = False) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self.keep_prompts = keep_prompts
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def record_job(
+        self,
+        job_input,
+        *,
+        job_id: Optional[str],
+        received_at: float,
+        timeline: TimelineLogger,
+        result: dict,
+    ) -> None:
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        stages: dict[str, float] = {}
+        for label, elapsed in timeline.events:
+            stage = TRACE_STAGES.get(label)
+            if stage and stage not in stages:
+                stages[stage] = round(elapsed, 4)
+        entry = {
+            "ts": round(received_at, 4),
+            "job_id": job_id,
+            "status": "error" if "error" in result else "ok",
+            "total_s": round(time.perf_counter() - timeline.start, 4),
+            "stages": stages,
+            "input": sanitize_job_input(job_input, keep_prompts=self.keep_prompts),
+        }
+        if "error" in result:
+            entry["error"] = str(result["error"])[:500]
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as handle:
+                handle.write(line + "\n")
+        except OSError as exc:
+            timeline.mark(f"Trace write failed: {exc}", dedupe=False)
+
+
+_trace_recorder: Optional[TraceRecorder] = None
+
+
+def get_trace_recorder() -> Optional[TraceRecorder]:
+    global _trace_recorder
+    if not TRACE_PATH:
+        return None
+    if _trace_recorder is None:
+        _trace_recorder = TraceRecorder(
+            Path(TRACE_PATH),
+            sample_rate=TRACE_SAMPLE_RATE,
+            keep_prompts=_strtobool(TRACE_PROMPTS, default=False),
+        )
+    return _trace_recorder
+
+
+def collect_metrics() -> dict:
+    metrics = {
+        "coalescing": single_flight.stats(),
+        "resolution_buckets": bucket_stats.snapshot(),
+        "oom": oom_memory.stats(),
+    }
+    pipeline = get_pipeline()
+    if pipeline is not None:
+        metrics["pipeline"] = pipeline.stats()
+    if _admission is not None:
+        metrics["admission"] = _admission.stats()
+    if _model_index is not None:
+        metrics["model_index"] = _model_index.stats()
+    if _fused_lora_cache is not None:
+        metrics["fused_lora"] = _fused_lora_cache.stats()
+    if model_stager is not None:
+        metrics["model_staging"] = model_stager.stats()
+    cache = get_storage_cache() if storage_available() else None
+    if cache is not None:
+        metrics["storage_cache"] = cache.stats()
+    return metrics
+
+
+def report_eta(job, estimate: dict) -> None:
+    """Publish the admission ETA as a RunPod progress update, visible on /status while the job runs."""
+    if not isinstance(job, dict) or not job.get("id"):
+        return
+    try:
+        runpod.serverless.progress_update(job, {"eta": estimate})
+    except Exception as exc:
+        print(f"ETA progress update failed: {exc}", flush=True)
+
+
+def handler(job, cancelled: Optional[threading.Event] = None):
+    job_id = None
+    if isinstance(job, dict):
+        for key in ("id", "job_id", "jobId", "requestId"):
+            value = job.get(key)
+            if value:
+                job_id = str(value)
+                break
+
+    timeline = TimelineLogger(job_id=job_id)
+    timeline.mark("Request received", dedupe=False)
+
+    job_input = job.get("input", {})
+    if _clean_str(job_input.get("action")).lower() == "presign_upload":
+        try:
+            return presign_input_uploads(job_input, job_id)
+        except Exception as exc:
+            return {"error": f"Failed to presign uploads: {exc}"}
+    if _clean_str(job_input.get("action")).lower() == "metrics":
+        metrics = collect_metrics()
+        if device_pool is not None:
+            metrics["devices"] = device_pool.metrics()
+        return metrics
+    if _clean_str(job_input.get("action")).lower() == "estimate":
+        if device_pool is not None:
+            return device_pool.estimate(job_input)
+        admission = get_admission_controller()
+        if admission is None:
+            return {"error": "Admission control is off (RUNPOD_ADMISSION=off)"}
+        return {"eta": admission.estimate(job_input)}
+    if _clean_str(job_input.get("action")).lower() == "warmup":
+        try:
+            if device_pool is not None:
+                return {"warmup": device_pool.warmup(job_input.get("buckets"))}
+            ensure_comfy_ready()
+            return {"warmup": warmup_resolution_buckets(job_input.get("buckets"), timeline=timeline)}
+        except Exception as exc:
+            return {"error": f"Warmup failed: {exc}"}
+
+    received_at = time.time()
+    if device_pool is not None:
+        result = device_pool.submit(
+            job_input,
+            job_id=job_id,
+            timeline=timeline,
+            cancelled=cancelled,
+            on_admitted=lambda estimate: report_eta(job, estimate),
+        )
+    else:
+        result = generate(
+            job_input,
+            job_id=job_id,
+            timeline=timeline,
+            cancelled=cancelled,
+            on_admitted=lambda estimate: report_eta(job, estimate),
+        )
+    recorder = get_trace_recorder()
+    if recorder is not None:
+        recorder.record_job(job_input, job_id=job_id, received_at=received_at, timeline=timeline, result=result)
+    return result
+
+
+def generate(
+    job_input,
+    *,
+    job_id: Optional[str],
+    timeline: TimelineLogger,
+    cancelled: Optional[threading.Event] = None,
+    on_admitted: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    ensure_comfy_ready()
+    timeline.mark("Comfy ready")
+
+    def is_cancelled() -> bool:
+        return cancelled is not None and cancelled.is_set()
+
+    timeout = float(job_input.get("timeout", 120))
+    admission = get_admission_controller()
+    ticket = estimate = None
+    if admission is not None and admission_mode(job_input) != "off":
+        ticket, estimate = admission.admit(
+            job_input, timeout=timeout, mode=admission_mode(job_input), should_abort=is_cancelled, timeline=timeline
+        )
+        if ticket is None:
+            timeline.mark(f"Rejected: ETA {estimate['eta_s']:0.1f}s exceeds timeout {timeout:0.0f}s", dedupe=False)
+            return {
+                "error": f"Rejected by admission control: predicted completion in {estimate['eta_s']:0.1f}s "
+                f"exceeds timeout {timeout:0.0f}s",
+                "eta": estimate,
+            }
+        if on_admitted is not None and estimate["eta_s"] is not None:
+            on_admitted(estimate)
+
+    pipeline = get_pipeline()
+    reservation = None
+    if pipeline is not None:
+        reservation = pipeline.reserve(is_cancelled)
+        if reservation is None:
+            if ticket is not None:
+                admission.release(ticket)
+            timeline.mark("Cancelled before preparation", dedupe=False)
+            return {"error": "Job cancelled"}
+
+    cleanup_paths: list[Path] = []
+    workflow = None
+    prepare_s = 0.0
+    try:
+        try:
+            prepare_started = time.perf_counter()
+            workflow, output_node_id, cleanup_paths = build_prompt(job_input, timeline=timeline)
+            prepare_s = time.perf_counter() - prepare_started
+            timeline.mark("Workflow prepared")
+        except Exception as exc:
+            timeline.mark(f"Workflow preparation failed: {exc}", dedupe=False)
+            return {"error": f"Failed to build workflow: {exc}"}
+
+        include_base64 = _strtobool(
+            str(job_input.get("include_output_base64", INCLUDE_OUTPUT_BASE64)), default=True
+        )
+        flight = None
+
+        def execute() -> dict:
+            result = execute_on_gpu()
+            if "error" not in result:
+                note_unfused_lora_job(job_input, workflow, timeline)
+            return result
+
+        def execute_on_gpu() -> dict:
+            if pipeline is None:
+                return run_workflow_adaptive(
+                    workflow,
+                    output_node_id,
+                    job_input=job_input,
+                    job_id=job_id,
+                    timeout=timeout,
+                    include_base64=include_base64,
+                    timeline=timeline,
+                )
+            # A cancelled leader still runs when coalesced followers depend on its result.
+            abort = lambda: is_cancelled() and not (flight and flight.followers)  # noqa: E731
+            with pipeline.gpu_turn(reservation, abort, timeline) as turn:
+                if turn is None:
+                    timeline.mark(f"Cancelled while queued; rolled back {len(cleanup_paths)} prepared input(s)")
+                    return {"error": "Job cancelled"}
+                return run_workflow_adaptive(
+                    workflow,
+                    output_node_id,
+                    job_input=job_input,
+                    job_id=job_id,
+                    timeout=timeout,
+                    include_base64=include_base64,
+                    timeline=timeline,
+                    on_outputs=turn.release,
+                )
+
+        coalesce = _strtobool(str(job_input.get("coalesce", COALESCE_REQUESTS)), default=True)
+        if not coalesce:
+            return execute()
+
+        # The response shape is part of the key: a base64 follower must not get a URL-only result.
+        flight_key = f"{workflow_fingerprint(workflow)}:{int(include_base64)}"
+        flight, leader = single_flight.join(flight_key, job_id)
+        if not leader:
+            if reservation is not None:
+                reservation.release()
+            if ticket is not None:
+                # Followers never reach the GPU; they must not count as queued work.
+                admission.release(ticket)
+            stats = single_flight.stats()
+            timeline.mark(
+                f"Coalesced with in-flight job {flight.job_id or flight_key[:12]} "
+                f"({stats['coalesced']} executions saved of {stats['executions'] + stats['coalesced']} jobs)",
+                dedupe=False,
+            )
+            if not flight.done.wait(timeout):
+                timeline.mark("Timed out waiting for coalesced execution", dedupe=False)
+                return {"error": "Timed out waiting for workflow output"}
+            return copy.deepcopy(flight.result)
+
+        result: dict = {"error": "Workflow execution aborted"}
+        try:
+            result = execute()
+        finally:
+            single_flight.finish(flight_key, flight, result)
+        if flight.followers:
+            timeline.mark(f"Shared result with {flight.followers} coalesced job(s)", dedupe=False)
+        return result
     finally:
+        if reservation is not None:
+            reservation.release()
+        if ticket is not None:
+            admission.finish(ticket, workflow, timeline, prepare_s=prepare_s)
         for path in cleanup_paths:
             if path and path.exists():
                 path.unlink()
+        timeline.mark("Request completed")
+
+
+async def async_handler(job):
+    # RunPod cancels this task on job cancellation; the flag lets the worker thread roll back.
+    cancelled = threading.Event()
+    try:
+        return await asyncio.to_thread(handler, job, cancelled)
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
+
+
+def visible_devices() -> list[str]:
+    """GPU ids for multi-GPU mode, without initialising CUDA in the routing process."""
+    configured = GPU_DEVICES or os.environ.get("CUDA_VISIBLE_DEVICES", "")
+    if configured.strip():
+        return [item.strip() for item in configured.split(",") if item.strip()]
+    try:
+        listing = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, timeout=30, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return ["0"]
+    count = sum(1 for line in listing.stdout.splitlines() if line.startswith("GPU "))
+    return [str(index) for index in range(max(1, count))]
+
+
+def model_affinity_key(job_input) -> str:
+    """Identity of the weights a job needs resident; jobs sharing it avoid a model reload."""
+    parts = [
+        _clean_str(job_input.get("workflow")) or WORKFLOW_NAME,
+        job_input.get("model_name", DEFAULTS["model_name"]),
+        job_input.get("lora_name", DEFAULTS["lora_name"]),
+        float(job_input.get("lora_strength", DEFAULTS["lora_strength"])),
+        job_input.get("clip_name", DEFAULTS["clip_name"]),
+        job_input.get("vae_name", DEFAULTS["vae_name"]),
+    ]
+    return "|".join(str(part) for part in parts)
+
+
+def _device_worker_main(index: int, device: str, target, slots: int, requests, responses) -> None:
+    """Entry point of a device process: pin the GPU, give ComfyUI its own port/output dir, serve requests."""
+    global COMFY_OUTPUT, _model_index_follower
+    os.environ["CUDA_VISIBLE_DEVICES"] = device
+    # The router builds and persists the model index; this process only adopts its snapshots.
+    _model_index_follower = True
+    # Separate output directories keep SaveImage's filename counters from racing across processes.
+    COMFY_OUTPUT = Path(os.environ["COMFYUI_OUTPUT_PATH"]) / f"device{index}"
+    COMFY_OUTPUT.mkdir(parents=True, exist_ok=True)
+    sys.argv = [sys.argv[0], "--port", str(DEVICE_BASE_PORT + index), "--output-directory", str(COMFY_OUTPUT)]
+
+    # Cancel flags of the jobs this process has accepted, set by "cancel" messages from the router.
+    cancels: dict[int, threading.Event] = {}
+
+    def run(kind: str, request_id: int, payload) -> None:
+        try:
+            if kind == "job":
+                job_input, job_id, deadline = payload
+                timeline = TimelineLogger(job_id=f"{job_id or ''}@gpu{device}")
+                if time.time() >= deadline:
+                    timeline.mark("Deadline passed before a slot was free", dedupe=False)
+                    result = {"error": "Job deadline passed before the device could start it"}
+                else:
+                    result = target(
+                        job_input,
+                        job_id=job_id,
+                        timeline=timeline,
+                        cancelled=cancels[request_id],
+                        on_admitted=lambda estimate: responses.put((request_id, "eta", estimate)),
+                    )
+            else:
+                ensure_comfy_ready()
+                result = warmup_resolution_buckets(payload, timeline=TimelineLogger(job_id=f"warmup@gpu{device}"))
+        except Exception as exc:
+            result = {"error": f"An error occurred: {exc}"}
+        finally:
+            cancels.pop(request_id, None)
+        responses.put((request_id, "result", result))
+
+    executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix=f"gpu{device}")
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        kind, request_id, payload = message
+        if kind == "metrics":
+            responses.put((request_id, "result", collect_metrics()))
+        elif kind == "estimate":
+            admission = get_admission_controller()
+            estimate = admission.estimate(payload) if admission is not None else None
+            responses.put((request_id, "result", {"eta": estimate, "device": device}))
+        elif kind == "cancel":
+            flag = cancels.get(request_id)
+            if flag is not None:
+                flag.set()
+        elif kind == "model_index":
+            index = get_model_index()
+            if index is not None:
+                index.adopt(payload)
+        else:
+            if kind == "job":
+                cancels[request_id] = threading.Event()
+            executor.submit(run, kind, request_id, payload)
+    executor.shutdown(wait=True)
+
+
+class DeviceExecutor:
+    """Parent-side handle of one device process and its routing state."""
+
+    def __init__(self, index: int, device: str) -> None:
+        self.index = index
+        self.device = device
+        self.process = None
+        self.requests = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        self.affinity_hits = 0
+        # Most recent affinity keys routed here, newest last.
+        self.models: OrderedDict[str, None] = OrderedDict()
+        self.pending: dict[int, Future] = {}
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class DevicePool:
+    """Shards jobs across per-device executor processes.
+
+    Routing is least-loaded with model affinity: a job goes to a device that
+    recently ran the same model/LoRA/CLIP/VAE combination unless that device
+    carries more than `affinity_slack` extra in-flight jobs. A monitor thread
+    fails the requests of a crashed device process and restarts it. Caller
+    cancellation and the job deadline are forwarded to the device as "cancel"
+    messages, admission ETAs come back as "eta" messages, and model index
+    snapshots built here are pushed to every device.
+    """
+
+    AFFINITY_MODELS = 2
+
+    def __init__(self, devices: list[str], *, target=None, slots: int = 1, affinity_slack: int = 1) -> None:
+        self.target = target or generate
+        self.slots = slots
+        self.affinity_slack = affinity_slack
+        self.executors = [DeviceExecutor(index, device) for index, device in enumerate(devices)]
+        self._context = multiprocessing.get_context("spawn")
+        self._responses = self._context.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._owners: dict[int, DeviceExecutor] = {}
+        # Jobs whose caller timed out; the device still counts them in flight until it answers or dies.
+        self._abandoned: dict[int, DeviceExecutor] = {}
+        self._progress: dict[int, Callable[[dict], None]] = {}
+        self._index_dirs: Optional[dict] = None
+        self._closing = False
+        self.routed = 0
+
+    def start(self) -> "DevicePool":
+        for executor in self.executors:
+            self._spawn(executor)
+        threading.Thread(target=self._read_responses, name="DevicePool-Responses", daemon=True).start()
+        threading.Thread(target=self._monitor, name="DevicePool-Monitor", daemon=True).start()
+        return self
+
+    def _spawn(self, executor: DeviceExecutor) -> None:
+        executor.requests = self._context.Queue()
+        executor.process = self._context.Process(
+            target=_device_worker_main,
+            args=(executor.index, executor.device, self.target, self.slots, executor.requests, self._responses),
+            name=f"comfy-gpu{executor.device}",
+            daemon=True,
+        )
+        executor.process.start()
+        with self._lock:
+            dirs = self._index_dirs
+        if dirs is not None:
+            executor.requests.put(("model_index", 0, dirs))
+
+    def share_model_index(self, index: "ModelIndex") -> None:
+        """Push `index` to every device now and after each of its refreshes; devices never scan or persist it."""
+        index.on_refresh = self._publish_model_index
+        self._publish_model_index(index.snapshot())
+
+    def _publish_model_index(self, dirs: dict) -> None:
+        with self._lock:
+            self._index_dirs = dirs
+            targets = [executor for executor in self.executors if executor.alive()]
+        for executor in targets:
+            executor.requests.put(("model_index", 0, dirs))
+
+    def _read_responses(self) -> None:
+        while not self._closing:
+            try:
+                request_id, kind, payload = self._responses.get()
+            except (EOFError, OSError):
+                return
+            if kind == "eta":
+                with self._lock:
+                    callback = self._progress.get(request_id)
+                if callback is not None:
+                    try:
+                        callback(payload)
+                    except Exception as exc:
+                        print(f"Progress relay failed: {exc}", flush=True)
+                continue
+            with self._lock:
+                owner = self._owners.pop(request_id, None)
+                future = owner.pending.pop(request_id, None) if owner else None
+                self._progress.pop(request_id, None)
+                late = self._abandoned.pop(request_id, None)
+                if late is not None:
+                    late.in_flight = max(0, late.in_flight - 1)
+            if future is not None and not future.done():
+                future.set_result(payload)
+
+    def _monitor(self) -> None:
+        while not self._closing:
+            time.sleep(1.0)
+            for executor in self.executors:
+                if executor.alive() or self._closing:
+                    continue
+                code = executor.process.exitcode if executor.process else None
+                with self._lock:
+                    orphaned = list(executor.pending.items())
+                    executor.pending.clear()
+                    for request_id, _ in orphaned:
+                        self._owners.pop(request_id, None)
+                        self._progress.pop(request_id, None)
+                    for request_id in [key for key, owner in self._abandoned.items() if owner is executor]:
+                        del self._abandoned[request_id]
+                    executor.in_flight = 0
+                    executor.models.clear()
+                    executor.restarts += 1
+                for _, future in orphaned:
+                    if not future.done():
+                        future.set_result({"error": f"Device {executor.device} executor exited (code {code})"})
+                print(f"Restarting executor for device {executor.device} (exit code {code})", flush=True)
+                self._spawn(executor)
+
+    def route(self, affinity_key: str) -> Tuple[DeviceExecutor, bool]:
+        """Pick a device for a job (caller holds the lock) and whether it was an affinity hit."""
+        candidates = [executor for executor in self.executors if executor.alive()] or self.executors
+        least = min(executor.in_flight for executor in candidates)
+        warm = [
+            executor
+            for executor in candidates
+            if affinity_key in executor.models and executor.in_flight <= least + self.affinity_slack
+        ]
+        pool = warm or [executor for executor in candidates if executor.in_flight == least]
+        # Among cold devices prefer the one with the fewest warm models so existing affinity is kept.
+        chosen = min(pool, key=lambda executor: (executor.in_flight, len(executor.models), executor.completed))
+        return chosen, bool(warm)
+
+    def _request(
+        self,
+        executor: DeviceExecutor,
+        kind: str,
+        payload,
+        on_progress: Optional[Callable[[dict], None]] = None,
+    ) -> Tuple[int, Future]:
+        future: Future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            executor.pending[request_id] = future
+            self._owners[request_id] = executor
+            if on_progress is not None:
+                self._progress[request_id] = on_progress
+        executor.requests.put((kind, request_id, payload))
+        return request_id, future
+
+    def _abandon(self, executor: DeviceExecutor, request_id: int, *, job: bool = False) -> None:
+        """Stop waiting for a request; a late answer is then dropped by the response reader."""
+        with self._lock:
+            executor.pending.pop(request_id, None)
+            self._owners.pop(request_id, None)
+            self._progress.pop(request_id, None)
+            if job:
+                self._abandoned[request_id] = executor
+
+    def submit(
+        self,
+        job_input,
+        *,
+        job_id: Optional[str],
+        timeline: TimelineLogger,
+        cancelled: Optional[threading.Event] = None,
+        on_admitted: Optional[Callable[[dict], None]] = None,
+    ) -> dict:
+        key = model_affinity_key(job_input)
+        with self._lock:
+            executor, hit = self.route(key)
+            executor.in_flight += 1
+            executor.models.pop(key, None)
+            executor.models[key] = None
+            while len(executor.models) > self.AFFINITY_MODELS:
+                executor.models.popitem(last=False)
+            if hit:
+                executor.affinity_hits += 1
+            self.routed += 1
+            load = executor.in_flight
+        timeline.mark(
+            f"Routed to device {executor.device} ({load} in flight{', warm model' if hit else ''})", dedupe=False
+        )
+        deadline = time.time() + float(job_input.get("timeout", 120)) + 60
+        request_id, future = self._request(executor, "job", (job_input, job_id, deadline), on_admitted)
+        answered = True
+        cancel_sent = False
+        while True:
+            try:
+                result = future.result(timeout=max(0.0, min(0.25, deadline - time.time())))
+                break
+            except FutureTimeoutError:
+                pass
+            expired = time.time() >= deadline
+            if not cancel_sent and (expired or (cancelled is not None and cancelled.is_set())):
+                # The device drops the job if it has not reached the GPU yet.
+                executor.requests.put(("cancel", request_id, None))
+                cancel_sent = True
+                timeline.mark(f"Cancel sent to device {executor.device}", dedupe=False)
+            if expired:
+                # The device is still running the job: keep it in flight so routing sees the load.
+                self._abandon(executor, request_id, job=True)
+                answered = future.done()
+                result = future.result() if answered else {"error": f"Timed out waiting for device {executor.device}"}
+                break
+        with self._lock:
+            if answered:
+                executor.in_flight = max(0, executor.in_flight - 1)
+                self._abandoned.pop(request_id, None)
+            if "error" in result:
+                executor.failed += 1
+            else:
+                executor.completed += 1
+        timeline.mark(f"Device {executor.device} finished", dedupe=False)
+        return result
+
+    def estimate(self, job_input, timeout: float = 5.0) -> dict:
+        """ETA on the device the job would be routed to right now."""
+        with self._lock:
+            executor, _ = self.route(model_affinity_key(job_input))
+        request_id, future = self._request(executor, "estimate", job_input)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._abandon(executor, request_id)
+            return {"error": f"Device {executor.device} did not answer"}
+
+    def warmup(self, buckets, timeout: float = 3600.0) -> dict[str, dict]:
+        """Per-device warmup results; a device that fails or times out reports {"error": ...}."""
+        requests = {executor.device: (executor, *self._request(executor, "warmup", buckets)) for executor in self.executors}
+        deadline = time.monotonic() + timeout
+        results: dict[str, dict] = {}
+        for device, (executor, request_id, future) in requests.items():
+            try:
+                results[device] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                self._abandon(executor, request_id)
+                results[device] = {"error": f"Timed out warming device {device}"}
+        return results
+
+    def metrics(self, timeout: float = 5.0) -> dict:
+        futures = {
+            executor.device: (executor, *self._request(executor, "metrics", None))
+            for executor in self.executors
+            if executor.alive()
+        }
+        devices = {}
+        with self._lock:
+            for executor in self.executors:
+                devices[executor.device] = {
+                    "pid": executor.process.pid if executor.process else None,
+                    "alive": executor.alive(),
+                    "in_flight": executor.in_flight,
+                    "completed": executor.completed,
+                    "failed": executor.failed,
+                    "restarts": executor.restarts,
+                    "affinity_hits": executor.affinity_hits,
+                    "models": len(executor.models),
+                }
+            routed = self.routed
+        for device, (executor, request_id, future) in futures.items():
+            try:
+                devices[device]["worker"] = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                self._abandon(executor, request_id)
+                devices[device]["worker"] = None
+        hits = sum(entry["affinity_hits"] for entry in devices.values())
+        return {
+            "devices": devices,
+            "healthy": sum(1 for entry in devices.values() if entry["alive"]),
+            "routed": routed,
+            "in_flight": sum(entry["in_flight"] for entry in devices.values()),
+            "affinity_hit_rate": hits / routed if routed else None,
+        }
+
+    def close(self) -> None:
+        self._closing = True
+        for executor in self.executors:
+            if executor.alive():
+                executor.requests.put(None)
+        for executor in self.executors:
+            if executor.process is not None:
+                executor.process.join(timeout=10)
+
+
+device_pool: Optional[DevicePool] = None
+
+
+def main() -> None:
+    global device_pool
+    concurrency = MAX_CONCURRENCY
+    if _strtobool(MULTI_GPU, default=False):
+        devices = visible_devices()
+        device_pool = DevicePool(devices, slots=DEVICE_CONCURRENCY, affinity_slack=AFFINITY_SLACK).start()
+        # Keep every device busy: accept as many jobs as the device processes can run.
+        concurrency = max(concurrency, len(devices) * DEVICE_CONCURRENCY)
+        print(f"Multi-GPU mode: {len(devices)} device executor(s) on {', '.join(devices)}", flush=True)
+
+    def build_model_index() -> None:
+        index = get_model_index()
+        if index is not None and device_pool is not None:
+            device_pool.share_model_index(index)
+
+    # Index the model volumes while CUDA and ComfyUI boot; first jobs then validate from memory.
+    threading.Thread(target=build_model_index, name="ModelIndex-Build", daemon=True).start()
+    start_model_staging()
+    # A failed warmup only costs the first jobs their cold start; the worker must still come up.
+    if WARMUP_BUCKETS.strip():
+        try:
+            if device_pool is not None:
+                per_device = device_pool.warmup(WARMUP_BUCKETS.strip())
+            else:
+                ensure_comfy_ready()
+                per_device = {"local": warmup_resolution_buckets(WARMUP_BUCKETS.strip(), timeline=TimelineLogger(job_id="warmup"))}
+            failed = {}
+            for device, results in per_device.items():
+                if "error" in results:
+                    failed[device] = results["error"]
+                    continue
+                failed.update({f"{device}:{key}": value["error"] for key, value in results.items() if "error" in value})
+            if failed:
+                print(f"Boot warmup failed for {len(failed)} bucket(s)/device(s): {failed}", flush=True)
+        except Exception as exc:
+            print(f"Boot warmup failed: {exc}", flush=True)
+    if concurrency > 1:
+        runpod.serverless.start({"handler": async_handler, "concurrency_modifier": lambda current: concurrency})
+    else:
+        runpod.serverless.start({"handler": handler})
 
 
-runpod.serverless.start({"handler": handler})
+# Guarded so benchmark scripts can import the helpers without starting a worker.
+if __name__ == "__main__":
+    main()
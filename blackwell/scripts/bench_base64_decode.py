@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare peak memory of whole-string vs streaming base64 input decoding.
+
+Runs anywhere the handler's Python dependencies are installed (no GPU needed):
+
+    python blackwell/scripts/bench_base64_decode.py --sizes-mb 1 10 25
+
+For each payload size it traces (with `tracemalloc`) the previous
+`base64.b64decode(payload, validate=True)` + single write path against
+`handler.decode_base64_to_file`, then times both in separate untraced runs
+(tracing skews timings towards the path with fewer allocations). The base64
+string itself is allocated before tracing starts, as it is when RunPod hands
+the job to the handler, so the peaks are the extra memory the decode step
+costs.
+"""
+
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import handler  # noqa: E402
+
+
+def legacy_decode(payload: str, target: Path) -> None:
+    data = base64.b64decode(payload, validate=True)
+    with open(target, "wb") as handle:
+        handle.write(data)
+
+
+def streaming_decode(payload: str, target: Path) -> None:
+    handler.decode_base64_to_file(payload, target)
+
+
+def measure_peak(fn, payload: str, target: Path) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    fn(payload, target)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def measure_time(fn, payload: str, target: Path) -> float:
+    started = time.perf_counter()
+    fn(payload, target)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[1, 10, 25])
+    parser.add_argument("--repeats", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{'input_MB':>9} {'b64_MB':>8} {'legacy_peak_MB':>15} {'stream_peak_MB':>15} {'legacy_ms':>10} {'stream_ms':>10}")
+    with tempfile.TemporaryDirectory() as scratch:
+        target = Path(scratch) / "input.bin"
+        for size_mb in args.sizes_mb:
+            raw = os.urandom(int(size_mb * 1024 * 1024))
+            payload = base64.b64encode(raw).decode("ascii")
+            del raw
+            results = {}
+            for name, fn in (("legacy", legacy_decode), ("stream", streaming_decode)):
+                peak = measure_peak(fn, payload, target)
+                results[name] = (peak, min(measure_time(fn, payload, target) for _ in range(args.repeats)))
+            print(
+                f"{size_mb:>9.1f} {len(payload) / 2**20:>8.1f} "
+                f"{results['legacy'][0] / 2**20:>15.2f} {results['stream'][0] / 2**20:>15.2f} "
+                f"{results['legacy'][1] * 1000:>10.1f} {results['stream'][1] * 1000:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
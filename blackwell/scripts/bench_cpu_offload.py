@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Measure how much per-job CPU work stalls a GPU-driving thread, with and without the process pool.
+
+Runs anywhere the handler's Python dependencies are installed (no GPU needed):
+
+    python blackwell/scripts/bench_cpu_offload.py --jobs 8 --processes 2
+
+A stand-in for ComfyUI's executor thread wakes every `--tick-ms` to "launch a
+kernel" (a few microseconds of Python), the way the sampler loop drives the GPU.
+Meanwhile handler threads run a real job mix: decode a base64 JPEG reference,
+resize it with `normalize_input`, and base64-encode a PNG output with
+`encode_output_base64`. The mix runs first with `RUNPOD_CPU_PROCESSES=0`
+(everything on threads, contending for the GIL) and then with the process pool.
+Stall is how late each tick wakes past its deadline. The table shows total stall,
+p99/max tick lateness and the wall time of the job mix.
+"""
+
+import argparse
+import base64
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import handler  # noqa: E402
+
+
+def make_fixtures(scratch: Path, input_side: int, output_side: int):
+    from PIL import Image
+
+    noise = Image.frombytes("RGB", (input_side, input_side), os.urandom(input_side * input_side * 3))
+    buffer = io.BytesIO()
+    noise.save(buffer, format="JPEG", quality=92)
+    input_b64 = base64.b64encode(buffer.getvalue()).decode("ascii")
+    output = Image.frombytes("RGB", (output_side, output_side), os.urandom(output_side * output_side * 3))
+    output_path = scratch / "output.png"
+    output.save(output_path, format="PNG", compress_level=1)
+    return input_b64, output_path
+
+
+class Ticker(threading.Thread):
+    """Stand-in executor thread: fixed-cadence wakeups, recording how late each one is."""
+
+    def __init__(self, tick_s: float) -> None:
+        super().__init__(daemon=True)
+        self.tick_s = tick_s
+        self.lateness: list[float] = []
+        self.stop = threading.Event()
+
+    def run(self) -> None:
+        deadline = time.perf_counter() + self.tick_s
+        while not self.stop.is_set():
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.perf_counter()
+            self.lateness.append(max(0.0, now - deadline))
+            sum(range(200))  # the "kernel launch"
+            deadline = max(deadline + self.tick_s, now)
+
+
+def run_mix(jobs: int, scratch: Path, input_b64: str, output_path: Path, max_side: int) -> float:
+    def job(index: int) -> None:
+        target = scratch / f"input_{index}.jpg"
+        handler.decode_base64_input(input_b64, target)
+        resized = handler.normalize_input(target, max_side=max_side)
+        resized.unlink(missing_ok=True)
+        handler.encode_output_base64(output_path)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=handler.INPUT_WORKERS + handler.OUTPUT_WORKERS) as workers:
+        list(workers.map(job, range(jobs)))
+    return time.perf_counter() - started
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * q / 100)))] if ordered else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--input-side", type=int, default=3072, help="reference image side before resizing")
+    parser.add_argument("--output-side", type=int, default=1536, help="output PNG side")
+    parser.add_argument("--max-side", type=int, default=1024)
+    parser.add_argument("--tick-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        input_b64, output_path = make_fixtures(scratch, args.input_side, args.output_side)
+        print(
+            f"input base64 {len(input_b64) / 2**20:0.1f} MB, output PNG {output_path.stat().st_size / 2**20:0.1f} MB, "
+            f"{args.jobs} jobs",
+            flush=True,
+        )
+        rows = []
+        for processes in (0, args.processes):
+            handler.CPU_PROCESSES = processes
+            if processes:
+                # Start the workers before measuring; spawn start-up is a one-off boot cost.
+                handler.get_cpu_pool().submit(sum, ()).result()
+            ticker = Ticker(args.tick_ms / 1000)
+            ticker.start()
+            time.sleep(0.2)
+            baseline = len(ticker.lateness)
+            wall = run_mix(args.jobs, scratch, input_b64, output_path, args.max_side)
+            ticker.stop.set()
+            ticker.join()
+            lateness = ticker.lateness[baseline:]
+            rows.append(
+                (
+                    "threads" if not processes else f"{processes} processes",
+                    sum(lateness) * 1000,
+                    percentile(lateness, 99) * 1000,
+                    max(lateness) * 1000,
+                    wall,
+                )
+            )
+
+    print(f"{'mode':>12} {'stall_ms':>9} {'p99_late_ms':>12} {'max_late_ms':>12} {'mix_s':>7}")
+    for mode, stall, p99, worst, wall in rows:
+        print(f"{mode:>12} {stall:>9.0f} {p99:>12.2f} {worst:>12.1f} {wall:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Measure speed and fidelity of partial-denoise edit mode across `edit_strength` values.
+
+Run on a GPU pod with the worker's environment (models on the volume):
+
+    cd /opt/ComfyUI
+    python /workspace/rootale_img_test/blackwell/scripts/bench_edit_strength.py \
+        --image /workspace/rootale_img_test/blackwell/demo-image.png \
+        --prompt "change the jacket to red" --strengths 1 0.8 0.6 0.4 --steps 4
+
+Starts ComfyUI in-process through the handler and runs the same prompt, seed
+and reference once per strength (1 = the regular full generation from an
+empty latent), after one untimed warm-up job. For each strength it reports the
+sampler steps actually run, the GPU time from ComfyUI's execution timestamps,
+the speed-up over the full generation, and two fidelity scores of the output:
+PSNR/SSIM against the reference (how much of it survives) and against the
+full generation (how close the light edit gets to what a full edit would
+produce). `--outputs DIR` keeps the images for a visual check.
+"""
+
+import argparse
+import base64
+import io
+import json
+import statistics
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import handler  # noqa: E402
+
+
+def load_rgb(data: bytes, size=None):
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    if size is not None and image.size != size:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    return np.asarray(image, dtype=np.float64) / 255.0
+
+
+def psnr(a, b) -> float:
+    import numpy as np
+
+    mse = float(np.mean((a - b) ** 2))
+    return float("inf") if mse == 0 else 10 * np.log10(1.0 / mse)
+
+
+def ssim(a, b, window: int = 8) -> float:
+    """Mean SSIM over non-overlapping windows of the luma channel."""
+    import numpy as np
+
+    weights = np.array([0.299, 0.587, 0.114])
+    a, b = a @ weights, b @ weights
+    height, width = (a.shape[0] // window) * window, (a.shape[1] // window) * window
+    a = a[:height, :width].reshape(height // window, window, width // window, window)
+    b = b[:height, :width].reshape(height // window, window, width // window, window)
+    mean_a, mean_b = a.mean(axis=(1, 3)), b.mean(axis=(1, 3))
+    var_a, var_b = a.var(axis=(1, 3)), b.var(axis=(1, 3))
+    covariance = ((a - mean_a[:, None, :, None]) * (b - mean_b[:, None, :, None])).mean(axis=(1, 3))
+    c1, c2 = 0.01**2, 0.03**2
+    score = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / (
+        (mean_a**2 + mean_b**2 + c1) * (var_a + var_b + c2)
+    )
+    return float(score.mean())
+
+
+def run_job(args, image_base64: str, strength: float, repeat: int):
+    timeline = handler.TimelineLogger(job_id=f"bench-edit-{strength:g}-{repeat}")
+    job_input = {
+        "image_base64": image_base64,
+        "prompt": args.prompt,
+        "seed": args.seed,
+        "steps": args.steps,
+        "width": args.size,
+        "height": args.size,
+        "edit_strength": strength,
+        "coalesce": False,
+        "include_output_base64": True,
+        "admission": "off",
+    }
+    result = handler.generate(job_input, job_id=timeline.job_id, timeline=timeline)
+    if "error" in result:
+        raise SystemExit(f"Job failed at edit_strength {strength:g}: {result['error']}")
+    return timeline.execution_s, base64.b64decode(result["image_base64"]), handler.effective_steps(job_input)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image", type=Path, required=True, help="reference image to edit")
+    parser.add_argument("--prompt", default="change the outfit colour to deep red, keep everything else")
+    parser.add_argument("--strengths", type=float, nargs="+", default=[1.0, 0.8, 0.6, 0.4])
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--outputs", type=Path, help="directory to keep the generated images in")
+    parser.add_argument("--json", metavar="PATH", help="also write raw measurements as JSON")
+    args = parser.parse_args()
+
+    image_bytes = args.image.read_bytes()
+    image_base64 = base64.b64encode(image_bytes).decode("ascii")
+    strengths = sorted(set(args.strengths) | {1.0}, reverse=True)
+    handler.ensure_comfy_ready()
+    run_job(args, image_base64, 1.0, -1)
+    if args.outputs:
+        args.outputs.mkdir(parents=True, exist_ok=True)
+
+    rows = []
+    full_output = None
+    for strength in strengths:
+        timings = []
+        for repeat in range(args.repeats):
+            execution_s, output, steps = run_job(args, image_base64, strength, repeat)
+            timings.append(execution_s)
+        if args.outputs:
+            (args.outputs / f"edit-{strength:g}.png").write_bytes(output)
+        rendered = load_rgb(output)
+        size = (rendered.shape[1], rendered.shape[0])
+        reference = load_rgb(image_bytes, size)
+        if full_output is None:
+            full_output = rendered
+        rows.append(
+            {
+                "strength": strength,
+                "steps": steps,
+                "gpu_s": statistics.median(value for value in timings if value is not None),
+                "psnr_reference": psnr(rendered, reference),
+                "ssim_reference": ssim(rendered, reference),
+                "psnr_full": psnr(rendered, full_output),
+                "ssim_full": ssim(rendered, full_output),
+            }
+        )
+
+    baseline = rows[0]["gpu_s"]
+    print(
+        f"{'strength':>8} {'steps':>5} {'gpu_s':>7} {'speedup':>7} "
+        f"{'psnr_ref':>8} {'ssim_ref':>8} {'psnr_full':>9} {'ssim_full':>9}"
+    )
+    for row in rows:
+        row["speedup"] = baseline / row["gpu_s"] if row["gpu_s"] else float("nan")
+        print(
+            f"{row['strength']:>8g} {row['steps']:>5} {row['gpu_s']:>7.2f} {row['speedup']:>6.2f}x "
+            f"{row['psnr_reference']:>8.2f} {row['ssim_reference']:>8.3f} {row['psnr_full']:>9.2f} {row['ssim_full']:>9.3f}"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as handle:
+            json.dump({"steps": args.steps, "size": args.size, "rows": rows}, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Compare model load time and per-step time of the fused DiT+LoRA checkpoint against the LoRA node.
+
+Run on a GPU pod with the worker's environment (models on the volume):
+
+    cd /opt/ComfyUI
+    RUNPOD_FUSED_LORA=1 python /workspace/rootale_img_test/blackwell/scripts/bench_fused_lora.py \
+        --steps 2 8 --repeats 2
+
+Starts ComfyUI in-process through the handler and runs the default workflow
+with `fused_lora: false` until the LoRA-composed transformer is loaded, then
+captures the fused checkpoint with `FusedLoraCache.capture` (skipped when one
+already exists). For each path it unloads every model, runs one cold job and
+warm jobs at each `--steps` value. GPU time comes from ComfyUI's execution
+timestamps. Load time is the cold run minus the warm run at the same step
+count; per-step time is the slope between the smallest and largest step count.
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("RUNPOD_FUSED_LORA", "1")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import handler  # noqa: E402
+
+
+def run_job(args, *, fused: bool, steps: int, seed: int) -> float:
+    timeline = handler.TimelineLogger(job_id=f"bench-{'fused' if fused else 'lora'}-{steps}")
+    job_input = {
+        "width": args.size,
+        "height": args.size,
+        "steps": steps,
+        "seed": seed,
+        "fused_lora": fused,
+        "coalesce": False,
+        "include_output_base64": False,
+        "image_base64": handler.PLACEHOLDER_PIXEL_BASE64,
+        "admission": "off",
+    }
+    result = handler.generate(job_input, job_id=timeline.job_id, timeline=timeline)
+    if "error" in result:
+        raise SystemExit(f"Job failed: {result['error']}")
+    if timeline.execution_s is None:
+        raise SystemExit("ComfyUI reported no execution timestamps")
+    return timeline.execution_s
+
+
+def measure(args, *, fused: bool) -> dict:
+    handler.free_comfy_memory(handler.TimelineLogger(job_id="bench-free"))
+    low, high = min(args.steps), max(args.steps)
+    cold = run_job(args, fused=fused, steps=low, seed=1)
+    warm = {steps: [] for steps in args.steps}
+    for repeat in range(args.repeats):
+        for steps in args.steps:
+            warm[steps].append(run_job(args, fused=fused, steps=steps, seed=100 + repeat))
+    warm_s = {steps: min(values) for steps, values in warm.items()}
+    per_step = (warm_s[high] - warm_s[low]) / (high - low) if high > low else float("nan")
+    return {"cold_s": cold, "load_s": cold - warm_s[low], "per_step_s": per_step, "warm_s": warm_s}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, nargs="+", default=[2, 8])
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--json", metavar="PATH", help="also write raw measurements as JSON")
+    args = parser.parse_args()
+
+    handler.ensure_comfy_ready()
+    cache = handler.get_fused_lora_cache()
+    key = handler.fused_lora_key({})
+    if cache.lookup(key) is None:
+        run_job(args, fused=False, steps=min(args.steps), seed=0)
+        if cache.capture(key) is None:
+            raise SystemExit(f"Fusion failed: {cache.stats()['captures'][-1]}")
+
+    rows = {"lora_node": measure(args, fused=False), "fused": measure(args, fused=True)}
+    print(f"{'path':>10} {'cold_s':>8} {'load_s':>8} {'per_step_s':>11}")
+    for path, row in rows.items():
+        print(f"{path:>10} {row['cold_s']:>8.2f} {row['load_s']:>8.2f} {row['per_step_s']:>11.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as handle:
+            json.dump({"size": args.size, "key": list(key), "rows": rows}, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Measure peak VRAM of whole-frame vs tiled VAE decode/encode across resolutions.
+
+Run on a GPU pod from the ComfyUI checkout the handler uses, e.g.:
+
+    cd /opt/ComfyUI
+    python /workspace/rootale_img_test/blackwell/scripts/bench_vae_memory.py \
+        --sizes 1024 1536 2048 2560 --tile-size 512 --overlap 64
+
+Loads the same VAE as the workflow, decodes an empty latent and re-encodes the
+result with `VAEDecode`/`VAEEncode` and their `*Tiled` counterparts, and prints
+peak `torch.cuda.max_memory_allocated()` plus wall time per run. Use the table
+to pick `RUNPOD_TILED_VAE_THRESHOLD` for the GPU class you deploy on.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+COMFY_ROOT = os.path.abspath(os.environ.get("COMFYUI_ROOT", "/opt/ComfyUI"))
+for path in (f"{COMFY_ROOT}/app", COMFY_ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vae-name", default="qwen_image_vae.1.safetensors")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[768, 1024, 1536, 2048])
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--overlap", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--json", metavar="PATH", help="also write raw measurements as JSON")
+    return parser.parse_args()
+
+
+def measure(torch, fn):
+    torch.cuda.synchronize()
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+    baseline = torch.cuda.memory_allocated()
+    started = time.perf_counter()
+    try:
+        result = fn()
+        torch.cuda.synchronize()
+    except torch.cuda.OutOfMemoryError:
+        return None, None, float("nan")
+    elapsed = time.perf_counter() - started
+    peak = (torch.cuda.max_memory_allocated() - baseline) / (1024 * 1024)
+    return result, peak, elapsed
+
+
+def main():
+    args = parse_args()
+
+    import torch
+    import folder_paths
+    import nodes
+
+    extra = os.environ.get("COMFYUI_EXTRA_MODEL_PATHS", f"{COMFY_ROOT}/extra_model_paths.yaml")
+    if os.path.exists(extra):
+        import utils.extra_config
+
+        utils.extra_config.load_extra_path_config(extra)
+    if folder_paths.get_full_path("vae", args.vae_name) is None:
+        raise SystemExit(f"VAE {args.vae_name} not found in the configured model paths")
+
+    (vae,) = nodes.VAELoader().load_vae(args.vae_name)
+    rows = []
+    for size in args.sizes:
+        (latent,) = nodes.EmptySD3LatentImage().generate(size, size, 1)
+        for tiled in (False, True):
+            for _ in range(args.repeats):
+                if tiled:
+                    decode = lambda: nodes.VAEDecodeTiled().decode(  # noqa: E731
+                        vae, latent, args.tile_size, args.overlap, 64, 8
+                    )[0]
+                else:
+                    decode = lambda: nodes.VAEDecode().decode(vae, latent)[0]  # noqa: E731
+                pixels, decode_peak, decode_s = measure(torch, decode)
+                encode_peak = encode_s = float("nan")
+                if pixels is not None:
+                    if tiled:
+                        encode = lambda: nodes.VAEEncodeTiled().encode(  # noqa: E731
+                            vae, pixels, args.tile_size, args.overlap, 64, 8
+                        )[0]
+                    else:
+                        encode = lambda: nodes.VAEEncode().encode(vae, pixels)[0]  # noqa: E731
+                    _, encode_peak, encode_s = measure(torch, encode)
+                rows.append(
+                    {
+                        "size": size,
+                        "tiled": tiled,
+                        "decode_peak_mib": decode_peak,
+                        "decode_s": decode_s,
+                        "encode_peak_mib": encode_peak,
+                        "encode_s": encode_s,
+                    }
+                )
+                del pixels
+
+    print(f"{'size':>6} {'mode':>6} {'decode_MiB':>11} {'decode_s':>9} {'encode_MiB':>11} {'encode_s':>9}")
+    for row in rows:
+
+        def fmt(value, spec):
+            return "OOM" if value is None or value != value else format(value, spec)
+
+        print(
+            f"{row['size']:>6} {'tiled' if row['tiled'] else 'full':>6} "
+            f"{fmt(row['decode_peak_mib'], '11.0f')} {fmt(row['decode_s'], '9.3f')} "
+            f"{fmt(row['encode_peak_mib'], '11.0f')} {fmt(row['encode_s'], '9.3f')}"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as handle:
+            json.dump({"tile_size": args.tile_size, "overlap": args.overlap, "rows": rows}, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
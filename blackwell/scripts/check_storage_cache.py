@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Check the storage object cache against an in-memory S3 (moto), no bucket needed.
+
+Runs anywhere the handler's Python dependencies and moto are installed:
+
+    pip install "moto[s3]"
+    python blackwell/scripts/check_storage_cache.py
+
+Drives `handler.StorageObjectCache.fetch_to` through a moto-backed boto3
+client: a miss, a revalidated hit (304) served as a hardlink, an overwritten
+key, an object larger than the budget, LRU eviction, an index rebuilt after a
+restart, corrupt or foreign sidecars being dropped, and a hit whose recency
+touch fails. Each check prints `ok`; the first failing one raises with what
+it saw.
+"""
+
+import json
+import sys
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import handler  # noqa: E402
+
+BUCKET = "cache-check"
+
+
+class CountingClient:
+    """boto3 client proxy that counts `get_object` calls and 304 answers."""
+
+    def __init__(self, client) -> None:
+        self._client = client
+        self.gets = 0
+        self.not_modified = 0
+
+    def get_object(self, **kwargs):
+        self.gets += 1
+        try:
+            return self._client.get_object(**kwargs)
+        except handler.ClientError as exc:
+            if exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304:
+                self.not_modified += 1
+            raise
+
+
+class Inputs:
+    """Numbered target paths standing in for ComfyUI's input directory."""
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.directory.mkdir()
+        self.count = 0
+
+    def fetch(self, cache, client, key: str) -> Path:
+        self.count += 1
+        target = self.directory / f"{self.count}-{key}"
+        size = cache.fetch_to(client, BUCKET, key, target)
+        if size != target.stat().st_size:
+            raise AssertionError(f"fetch_to reported {size} bytes, wrote {target.stat().st_size}")
+        return target
+
+
+def check(name: str, condition: bool, detail) -> None:
+    if not condition:
+        raise AssertionError(f"{name}: {detail}")
+    print(f"ok  {name}")
+
+
+def main():
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp:
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=BUCKET)
+        client = CountingClient(s3)
+        directory = Path(tmp) / "cache"
+        cache = handler.StorageObjectCache(directory, max_bytes=10_000)
+        inputs = Inputs(Path(tmp) / "input")
+
+        s3.put_object(Bucket=BUCKET, Key="a.png", Body=b"a" * 4000)
+        check("miss downloads", inputs.fetch(cache, client, "a.png").read_bytes() == b"a" * 4000, cache.stats())
+        served = inputs.fetch(cache, client, "a.png")
+        check("hit revalidates with 304", served.read_bytes() == b"a" * 4000 and client.not_modified == 1,
+              (client.not_modified, cache.stats()))
+        check("hit counted", cache.stats()["hits"] == 1, cache.stats())
+        cached_path = cache._paths(BUCKET, "a.png")[0]
+        check("hit is a hardlink, not a copy", served.stat().st_ino == cached_path.stat().st_ino, served)
+        resized = served.with_suffix(".tmp")
+        resized.write_bytes(b"resized")
+        resized.replace(served)
+        check("replacing the input leaves the cache intact", cached_path.read_bytes() == b"a" * 4000, cached_path)
+
+        s3.put_object(Bucket=BUCKET, Key="a.png", Body=b"A" * 4000)
+        check("overwrite is never served stale", inputs.fetch(cache, client, "a.png").read_bytes() == b"A" * 4000,
+              cache.stats())
+
+        s3.put_object(Bucket=BUCKET, Key="huge.png", Body=b"h" * 20_000)
+        huge = inputs.fetch(cache, client, "huge.png")
+        check("over-budget object handed over uncached", huge.read_bytes() == b"h" * 20_000
+              and "cache-check/huge.png" not in cache._entries, cache.stats())
+
+        s3.put_object(Bucket=BUCKET, Key="b.png", Body=b"b" * 4000)
+        s3.put_object(Bucket=BUCKET, Key="c.png", Body=b"c" * 4000)
+        inputs.fetch(cache, client, "b.png")
+        inputs.fetch(cache, client, "a.png")  # a becomes most recent
+        inputs.fetch(cache, client, "c.png")  # over budget: b is least recent
+        stats = cache.stats()
+        check("LRU eviction keeps the budget", stats["bytes"] <= 10_000 and stats["entries"] == 2, stats)
+        check("least recent entry evicted", not cache._paths(BUCKET, "b.png")[0].exists(), sorted(cache._entries))
+
+        with mock.patch.object(handler.os, "link", side_effect=OSError(18, "Invalid cross-device link")):
+            copied = inputs.fetch(cache, client, "c.png")
+        check("cross-device hit falls back to a copy", copied.read_bytes() == b"c" * 4000
+              and copied.stat().st_ino != cache._paths(BUCKET, "c.png")[0].stat().st_ino, copied)
+
+        with mock.patch.object(handler.os, "utime", side_effect=PermissionError("read-only")):
+            check("failed recency touch still serves the hit",
+                  inputs.fetch(cache, client, "c.png").read_bytes() == b"c" * 4000, cache.stats())
+
+        (directory / "foreign.json").write_text(json.dumps({"etag": '"x"'}), encoding="utf-8")
+        (directory / "foreign.bin").write_bytes(b"x")
+        (directory / "broken.json").write_text("{", encoding="utf-8")
+        (directory / "listed.json").write_text(json.dumps(["bucket", "key"]), encoding="utf-8")
+        (directory / "listed.bin").write_bytes(b"x")
+        restarted = handler.StorageObjectCache(directory, max_bytes=10_000)
+        check("index survives a restart", sorted(restarted._entries) == sorted(cache._entries), sorted(restarted._entries))
+        leftovers = sorted(path.name for path in directory.iterdir() if path.stem in ("foreign", "broken", "listed"))
+        check("corrupt and foreign sidecars dropped", not leftovers, leftovers)
+        stray = [path.name for path in directory.iterdir() if path.suffix == ".tmp"]
+        check("no temp files left behind", not stray, stray)
+
+        gets = client.gets
+        check("restarted cache revalidates", inputs.fetch(restarted, client, "a.png").read_bytes() == b"A" * 4000
+              and client.gets == gets + 1 and restarted.stats()["hits"] == 1, restarted.stats())
+    print("All storage cache checks passed.")
+
+
+if __name__ == "__main__":
+    main()
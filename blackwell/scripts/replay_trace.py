@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Replay a handler trace against a local worker at original or scaled arrival rates.
+
+Record a trace by running the worker with `RUNPOD_TRACE_PATH=/workspace/trace.jsonl`,
+then start a local worker and replay it:
+
+    python blackwell/handler.py --rp_serve_api --rp_api_concurrency 4
+    python blackwell/scripts/replay_trace.py /workspace/trace.jsonl \
+        --endpoint http://localhost:8000 --speeds 0.5 1 2 4 --concurrency 4 \
+        --chart replay.png --results replay-results.jsonl
+
+Every trace record is re-issued to `<endpoint>/runsync` at its original offset
+divided by the speed factor. At most `--concurrency` requests are in flight, which
+should match the worker's concurrency. Each job's queueing delay is the time it
+waited past its scheduled arrival before being dispatched. Service time is the
+`/runsync` round trip. Redacted images are replaced with `--image` and redacted
+prompt text with filler of the same length.
+
+Per speed it prints offered load, throughput and p50/p95/p99 queueing delay and
+latency. `--results` writes one `plot_perf.py`-compatible record per job (one
+cohort per speed), so `plot_perf.py` and `compare_perf.py` work on replays too.
+`--chart` plots the latency and throughput curves against offered load.
+"""
+
+import argparse
+import base64
+import json
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib import error as urllib_error
+from urllib import request as urllib_request
+
+DEFAULT_IMAGE = Path(__file__).resolve().parents[1] / "demo-image.png"
+FILLER_WORD = "detailed "
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", type=Path, help="JSON-lines trace written via RUNPOD_TRACE_PATH")
+    parser.add_argument("--endpoint", default="http://localhost:8000", help="local worker API base URL")
+    parser.add_argument("--speeds", type=float, nargs="+", default=[1.0], help="arrival-rate multipliers")
+    parser.add_argument("--concurrency", type=int, default=1, help="max requests in flight")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N records")
+    parser.add_argument("--include-errors", action="store_true", help="also replay jobs that failed originally")
+    parser.add_argument("--image", type=Path, default=DEFAULT_IMAGE, help="image substituted for redacted payloads")
+    parser.add_argument(
+        "--local-images",
+        action="store_true",
+        help="also replace *_url / *_object_key inputs with --image (for replays away from the bucket)",
+    )
+    parser.add_argument("--timeout", type=float, default=600.0, help="per-request HTTP timeout in seconds")
+    parser.add_argument("--results", type=Path, help="write per-job records (plot_perf.py format)")
+    parser.add_argument("--report-json", type=Path, help="write the per-speed summary as JSON")
+    parser.add_argument("--chart", type=Path, help="write latency/throughput curves (needs matplotlib)")
+    return parser.parse_args()
+
+
+def load_trace(path: Path, *, include_errors: bool, limit: int) -> list[dict]:
+    records = []
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(record.get("input"), dict) or "ts" not in record:
+                continue
+            if record.get("status") == "error" and not include_errors:
+                continue
+            records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit > 0 else records
+
+
+def restore_input(value, *, image_base64: str, local_images: bool):
+    """Undo the trace sanitiser's redactions with stand-in payloads."""
+    if isinstance(value, dict):
+        redacted = value.get("_redacted")
+        if redacted == "base64":
+            return image_base64
+        if redacted == "text":
+            chars = int(value.get("chars", 0))
+            return (FILLER_WORD * (chars // len(FILLER_WORD) + 1))[:chars].strip()
+        restored = {}
+        for key, item in value.items():
+            if local_images and key.endswith(("_url", "_object_key")):
+                prefix = key[: -len("_object_key")] if key.endswith("_object_key") else key[: -len("_url")]
+                restored[f"{prefix}_base64"] = image_base64
+                continue
+            restored[key] = restore_input(item, image_base64=image_base64, local_images=local_images)
+        return restored
+    if isinstance(value, list):
+        return [restore_input(item, image_base64=image_base64, local_images=local_images) for item in value]
+    return value
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def send(endpoint: str, job_input: dict, timeout: float) -> dict:
+    body = json.dumps({"input": job_input}).encode("utf-8")
+    req = urllib_request.Request(
+        f"{endpoint.rstrip('/')}/runsync", data=body, headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib_request.urlopen(req, timeout=timeout) as response:
+            payload = json.loads(response.read())
+    except (urllib_error.URLError, TimeoutError, json.JSONDecodeError) as exc:
+        return {"error": str(exc)}
+    output = payload.get("output")
+    if payload.get("status") not in (None, "COMPLETED") or (isinstance(output, dict) and "error" in output):
+        detail = output.get("error") if isinstance(output, dict) else payload.get("error")
+        return {"error": str(detail or payload.get("status"))}
+    return {}
+
+
+def replay(records: list[dict], speed: float, args, image_base64: str) -> list[dict]:
+    origin = records[0]["ts"]
+    inputs = [
+        restore_input(record["input"], image_base64=image_base64, local_images=args.local_images)
+        for record in records
+    ]
+    results: list[dict] = [{} for _ in records]
+    lock = threading.Lock()
+
+    def run(index: int, scheduled: float) -> None:
+        dispatched = time.perf_counter()
+        outcome = send(args.endpoint, inputs[index], args.timeout)
+        finished = time.perf_counter()
+        with lock:
+            results[index] = {
+                "scheduled": scheduled,
+                "dispatched": dispatched,
+                "finished": finished,
+                "error": outcome.get("error"),
+            }
+
+    start = time.perf_counter()
+    epoch_offset_ms = time.time() * 1000 - start * 1000
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        for index, record in enumerate(records):
+            scheduled = start + (record["ts"] - origin) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, index, scheduled)
+    for result in results:
+        result["started_at"] = epoch_offset_ms + result["scheduled"] * 1000
+    return results
+
+
+def summarize(records: list[dict], results: list[dict], speed: float) -> dict:
+    span = (records[-1]["ts"] - records[0]["ts"]) / speed if len(records) > 1 else 0.0
+    ok = [result for result in results if not result["error"]]
+    queue_ms = [(result["dispatched"] - result["scheduled"]) * 1000 for result in results]
+    latency_ms = [(result["finished"] - result["scheduled"]) * 1000 for result in ok]
+    makespan = max(result["finished"] for result in results) - min(result["scheduled"] for result in results)
+    summary = {
+        "speed": speed,
+        "jobs": len(results),
+        "errors": len(results) - len(ok),
+        "offered_per_min": len(results) / span * 60 if span > 0 else float("nan"),
+        "throughput_per_min": len(ok) / makespan * 60 if makespan > 0 else float("nan"),
+    }
+    for q in (50, 95, 99):
+        summary[f"queue_p{q}_ms"] = percentile(queue_ms, q)
+        summary[f"latency_p{q}_ms"] = percentile(latency_ms, q)
+    return summary
+
+
+def print_table(summaries: list[dict]) -> None:
+    print(
+        f"{'speed':>6} {'jobs':>5} {'err':>4} {'offered/min':>11} {'done/min':>9} "
+        f"{'queue_p50':>10} {'queue_p95':>10} {'lat_p50':>9} {'lat_p95':>9} {'lat_p99':>9}"
+    )
+    for summary in summaries:
+        print(
+            f"{summary['speed']:>6g} {summary['jobs']:>5} {summary['errors']:>4} "
+            f"{summary['offered_per_min']:>11.1f} {summary['throughput_per_min']:>9.1f} "
+            f"{summary['queue_p50_ms']:>10.0f} {summary['queue_p95_ms']:>10.0f} "
+            f"{summary['latency_p50_ms']:>9.0f} {summary['latency_p95_ms']:>9.0f} {summary['latency_p99_ms']:>9.0f}"
+        )
+
+
+def write_chart(path: Path, summaries: list[dict]) -> None:
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    offered = [summary["offered_per_min"] for summary in summaries]
+    fig, (latency_ax, throughput_ax) = plt.subplots(1, 2, figsize=(12, 4.5))
+    for q, style in ((50, "-"), (95, "--"), (99, ":")):
+        latency_ax.plot(offered, [s[f"latency_p{q}_ms"] / 1000 for s in summaries], style, marker="o", label=f"latency p{q}")
+    latency_ax.plot(offered, [s["queue_p95_ms"] / 1000 for s in summaries], "-", marker="s", color="#f59e0b", label="queue p95")
+    latency_ax.set_xlabel("offered load (jobs/min)")
+    latency_ax.set_ylabel("seconds")
+    latency_ax.set_title("Tail latency vs offered load")
+    latency_ax.grid(alpha=0.3)
+    latency_ax.legend()
+    throughput_ax.plot(offered, [s["throughput_per_min"] for s in summaries], marker="o", color="#22c55e")
+    limit = max([value for value in offered if value == value] or [1])
+    throughput_ax.plot([0, limit], [0, limit], color="#94a3b8", linestyle="--", label="offered = served")
+    throughput_ax.set_xlabel("offered load (jobs/min)")
+    throughput_ax.set_ylabel("completed jobs/min")
+    throughput_ax.set_title("Throughput")
+    throughput_ax.grid(alpha=0.3)
+    throughput_ax.legend()
+    fig.tight_layout()
+    fig.savefig(path, dpi=150)
+    plt.close(fig)
+
+
+def main():
+    args = parse_args()
+    records = load_trace(args.trace, include_errors=args.include_errors, limit=args.limit)
+    if not records:
+        raise SystemExit(f"No replayable records in {args.trace}")
+    image_base64 = base64.b64encode(args.image.read_bytes()).decode("ascii")
+
+    summaries = []
+    results_handle = open(args.results, "w", encoding="utf-8") if args.results else None
+    try:
+        for speed in args.speeds:
+            if speed <= 0:
+                raise SystemExit("--speeds must be positive")
+            print(f"Replaying {len(records)} jobs at {speed:g}x ...", file=sys.stderr)
+            results = replay(records, speed, args, image_base64)
+            summaries.append(summarize(records, results, speed))
+            if results_handle:
+                for index, result in enumerate(results):
+                    record = {
+                        "cohortKey": f"replay-x{speed:g}",
+                        "cohortLabel": f"Replay x{speed:g}",
+                        "kind": "Input",
+                        "imageIndex": index,
+                        "startedAt": result["started_at"],
+                        "queueMs": (result["dispatched"] - result["scheduled"]) * 1000,
+                        "execMs": (result["finished"] - result["dispatched"]) * 1000,
+                        "totalMs": None if result["error"] else (result["finished"] - result["scheduled"]) * 1000,
+                        "error": result["error"],
+                    }
+                    results_handle.write(json.dumps(record) + "\n")
+    finally:
+        if results_handle:
+            results_handle.close()
+
+    print_table(summaries)
+    if args.report_json:
+        args.report_json.write_text(json.dumps(summaries, indent=2), encoding="utf-8")
+    if args.chart:
+        write_chart(args.chart, summaries)
+        print(f"Chart written to {args.chart}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Drive the multi-GPU router with CPU-only stand-in device executors.
+
+Runs anywhere the handler's Python dependencies are installed (no GPU needed):
+
+    python blackwell/scripts/simulate_multi_gpu.py --devices 4 --jobs 80 --models 3
+    python blackwell/scripts/simulate_multi_gpu.py --devices 4 --affinity-slack -1   # affinity off
+    python blackwell/scripts/simulate_multi_gpu.py --devices 2 --kill-after 10       # crash + restart
+
+Spawns one process per fake device through `handler.DevicePool`, exactly as
+`RUNPOD_MULTI_GPU=1` does. Instead of ComfyUI, each process runs `stand_in_job`,
+which sleeps for a per-step cost scaled by resolution plus a model-switch
+penalty whenever the job's model/LoRA combination differs from the one it ran
+last. Jobs go through `handler.handler`, so routing, timeline logging and
+metrics aggregation are the production code paths.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import handler  # noqa: E402
+
+_loaded_key = None
+_model_switches = 0
+
+
+def stand_in_job(job_input, *, job_id, timeline, cancelled=None, on_admitted=None):
+    """CPU stand-in for `handler.generate` running inside a device process."""
+    global _loaded_key, _model_switches
+    if cancelled is not None and cancelled.is_set():
+        return {"error": "Job cancelled"}
+    key = handler.model_affinity_key(job_input)
+    switched = key != _loaded_key
+    if switched:
+        _model_switches += 1
+        time.sleep(float(job_input["sim_switch_s"]))
+        _loaded_key = key
+    megapixels = int(job_input["width"]) * int(job_input["height"]) / (1024 * 1024)
+    time.sleep(float(job_input["sim_step_s"]) * int(job_input["steps"]) * megapixels)
+    timeline.mark("Stand-in job finished")
+    return {"device": os.environ.get("CUDA_VISIBLE_DEVICES"), "switched": switched, "switches": _model_switches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=60)
+    parser.add_argument("--models", type=int, default=3, help="distinct LoRAs in the job mix")
+    parser.add_argument("--arrival-ms", type=float, default=40, help="mean gap between job arrivals")
+    parser.add_argument("--step-s", type=float, default=0.1, help="stand-in seconds per step at 1 MP")
+    parser.add_argument("--switch-s", type=float, default=0.8, help="stand-in model reload penalty")
+    parser.add_argument("--affinity-slack", type=int, default=1, help="-1 disables model affinity")
+    parser.add_argument("--kill-after", type=int, default=0, help="terminate one device process after N jobs")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    devices = [str(index) for index in range(args.devices)]
+    pool = handler.DevicePool(devices, target=stand_in_job, affinity_slack=args.affinity_slack).start()
+    handler.device_pool = pool
+
+    results = []
+    lock = threading.Lock()
+
+    def submit(index: int, job_input: dict) -> None:
+        result = handler.handler({"id": f"sim-{index}", "input": job_input})
+        with lock:
+            results.append(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=64) as clients:
+        for index in range(args.jobs):
+            side = rng.choice([768, 1024, 1024, 1280])
+            job_input = {
+                "width": side,
+                "height": side,
+                "steps": 4,
+                "lora_name": f"style-{rng.randrange(args.models)}.safetensors",
+                "sim_step_s": args.step_s,
+                "sim_switch_s": args.switch_s,
+            }
+            clients.submit(submit, index, job_input)
+            if args.kill_after and index == args.kill_after:
+                victim = pool.executors[0]
+                print(f"Terminating device {victim.device} (pid {victim.process.pid})", flush=True)
+                victim.process.terminate()
+            time.sleep(rng.expovariate(1000 / args.arrival_ms))
+    makespan = time.perf_counter() - started
+
+    # Give the monitor a moment to notice and restart a killed process before reporting health.
+    time.sleep(1.5 if args.kill_after else 0)
+    metrics = pool.metrics()
+    pool.close()
+
+    errors = [result for result in results if "error" in result]
+    switches = sum(1 for result in results if result.get("switched"))
+    print()
+    print(f"jobs={len(results)} errors={len(errors)} makespan={makespan:0.2f}s model_switches={switches}")
+    rate = metrics["affinity_hit_rate"]
+    print(f"healthy={metrics['healthy']}/{len(devices)} affinity_hit_rate={rate if rate is None else round(rate, 3)}")
+    print(f"{'device':>6} {'pid':>8} {'alive':>6} {'done':>5} {'failed':>6} {'restarts':>8} {'hits':>5}")
+    for device, entry in metrics["devices"].items():
+        print(
+            f"{device:>6} {entry['pid'] or '-':>8} {str(entry['alive']):>6} {entry['completed']:>5} "
+            f"{entry['failed']:>6} {entry['restarts']:>8} {entry['affinity_hits']:>5}"
+        )
+    for error in errors[:3]:
+        print("error:", error["error"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Exercise the handler's out-of-memory fallback against a stub ComfyUI queue.
+
+Runs anywhere the handler's Python dependencies are installed (no GPU needed):
+
+    python blackwell/scripts/simulate_oom.py --vram-mib 16000 --sizes 1024 1536 2048 2048
+
+Each job is sent through `handler.handler`. The stub prompt queue estimates the
+VRAM a workflow would need from its DiT offload settings, latent size and VAE
+mode, and fails it with ComfyUI's `execution_error` OOM status when that exceeds
+`--vram-mib`. The table shows which memory profile every job finished on and how
+many attempts it took; repeated sizes should start directly on the remembered
+profile.
+"""
+
+import argparse
+import base64
+import sys
+import tempfile
+import threading
+import time
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import handler  # noqa: E402
+
+PNG_1X1 = base64.b64decode(handler.PLACEHOLDER_PIXEL_BASE64)
+
+
+def estimate_vram_mib(workflow) -> float:
+    """Very rough VRAM model: resident DiT blocks + sampling activations + VAE."""
+    need = 0.0
+    pixels = 0
+    for node in workflow.values():
+        inputs = node["inputs"]
+        if node["class_type"] == "NunchakuQwenImageDiTLoader":
+            blocks = 60 if inputs.get("cpu_offload") != "enable" else int(inputs.get("num_blocks_on_gpu", 60))
+            need += 2000 + blocks * 110
+        elif node["class_type"] == "EmptySD3LatentImage":
+            pixels = int(inputs["width"]) * int(inputs["height"]) * int(inputs.get("batch_size", 1))
+    need += pixels / (1024 * 1024) * 1500
+    tiled = any(node["class_type"] == "VAEDecodeTiled" for node in workflow.values())
+    need += 1200 if tiled else pixels / (1024 * 1024) * 2600
+    return need
+
+
+class StubPromptQueue:
+    def __init__(self, vram_mib: float, output_dir: Path) -> None:
+        self.vram_mib = vram_mib
+        self.output_dir = output_dir
+        self.history = {}
+        self.flags = {}
+        self.lock = threading.Lock()
+        self.attempts = []
+
+    def put(self, item) -> None:
+        _, prompt_id, workflow, _, outputs, _ = item
+        need = estimate_vram_mib(workflow)
+        self.attempts.append(need)
+        if need > self.vram_mib:
+            record = {
+                "status": {
+                    "completed": False,
+                    "status_str": "error",
+                    "messages": [
+                        (
+                            "execution_error",
+                            {
+                                "exception_type": "torch.OutOfMemoryError",
+                                "exception_message": f"CUDA out of memory. Tried to allocate {need:.0f} MiB",
+                            },
+                        )
+                    ],
+                },
+                "outputs": {},
+            }
+        else:
+            path = self.output_dir / f"{prompt_id}.png"
+            path.write_bytes(PNG_1X1)
+            record = {
+                "status": {"completed": True, "messages": []},
+                "outputs": {outputs[0]: {"images": [{"filename": path.name}]}},
+            }
+        with self.lock:
+            self.history[prompt_id] = record
+
+    def get_history(self, prompt_id=None):
+        with self.lock:
+            return {prompt_id: self.history[prompt_id]} if prompt_id in self.history else {}
+
+    def delete_history_item(self, prompt_id) -> None:
+        with self.lock:
+            self.history.pop(prompt_id, None)
+
+    def set_flag(self, name, data) -> None:
+        # The real prompt worker consumes flags between prompts; the stub has nothing to free.
+        pass
+
+    def get_tasks_remaining(self) -> int:
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vram-mib", type=float, default=16000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 1536, 2048, 2048, 1536])
+    parser.add_argument("--batch-size", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        handler.COMFY_INPUT = scratch
+        handler.COMFY_OUTPUT = scratch
+        handler.UPLOAD_OUTPUTS = "0"
+        handler.OOM_FREE_WAIT = 0
+        queue = StubPromptQueue(args.vram_mib, scratch)
+        handler.server = types.SimpleNamespace(prompt_queue=queue)
+        registry = handler.WorkflowRegistry(Path(handler.__file__).parent, default_name=handler.WORKFLOW_NAME)
+        registry.refresh(force=True)
+        handler.workflow_registry = registry
+
+        print(f"{'size':>6} {'batch':>5} {'attempts':>8} {'last_need_MiB':>13} {'result':>8} {'ms':>7}")
+        for size in args.sizes:
+            before = len(queue.attempts)
+            started = time.perf_counter()
+            result = handler.handler(
+                {
+                    "id": f"sim-{size}",
+                    "input": {
+                        "width": size,
+                        "height": size,
+                        "batch_size": args.batch_size,
+                        "image_name": handler.PLACEHOLDER_PIXEL_BASE64,
+                        "tiled_vae": False,
+                        "coalesce": False,
+                        "include_output_base64": False,
+                    },
+                }
+            )
+            elapsed = (time.perf_counter() - started) * 1000
+            attempts = queue.attempts[before:]
+            outcome = "error" if "error" in result else "ok"
+            print(
+                f"{size:>6} {args.batch_size:>5} {len(attempts):>8} {attempts[-1]:>13.0f} {outcome:>8} {elapsed:>7.0f}"
+            )
+        print("remembered profiles:", handler.oom_memory.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Measure GPU idle gaps between prompts with and without pipelined preparation.
+
+Runs anywhere the handler's Python dependencies are installed (no GPU needed):
+
+    python blackwell/scripts/simulate_pipeline.py --depths 0 1 --jobs 6 --exec-s 0.4 --reference-px 2500
+
+Each job goes through `handler.handler` with a random-noise JPEG reference of
+`--reference-px` squared, so decoding, validation and resizing cost real time.
+Depth 0 runs the jobs back to back, as a worker with `RUNPOD_MAX_CONCURRENCY=1`
+does; other depths submit them from concurrent threads, as RunPod does with
+look-ahead. The stub prompt queue runs one prompt at a time for `--exec-s`
+seconds and records the gap between one prompt finishing and the next one
+starting. Sequentially that gap includes the next job's preparation; with
+look-ahead it should shrink to the queue hand-off.
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import handler  # noqa: E402
+
+PNG_1X1 = base64.b64decode(handler.PLACEHOLDER_PIXEL_BASE64)
+
+
+class SerialPromptQueue:
+    """Executes prompts one at a time, like ComfyUI's prompt worker, with execution timestamps."""
+
+    def __init__(self, exec_s: float, output_dir: Path) -> None:
+        self.exec_s = exec_s
+        self.output_dir = output_dir
+        self.history = {}
+        self.gaps: list[float] = []
+        self.lock = threading.Lock()
+        self._pending: "queue.Queue" = queue.Queue()
+        threading.Thread(target=self._worker, name="stub-prompt-worker", daemon=True).start()
+
+    def put(self, item) -> None:
+        self._pending.put(item)
+
+    def _worker(self) -> None:
+        finished = None
+        while True:
+            _, prompt_id, _, _, outputs, _ = self._pending.get()
+            started = time.time()
+            if finished is not None:
+                self.gaps.append(started - finished)
+            time.sleep(self.exec_s)
+            path = self.output_dir / f"{prompt_id}.png"
+            path.write_bytes(PNG_1X1)
+            finished = time.time()
+            record = {
+                "status": {
+                    "completed": True,
+                    "messages": [
+                        ("execution_start", {"timestamp": started * 1000}),
+                        ("execution_success", {"timestamp": finished * 1000}),
+                    ],
+                },
+                "outputs": {outputs[0]: {"images": [{"filename": path.name}]}},
+            }
+            with self.lock:
+                self.history[prompt_id] = record
+
+    def get_history(self, prompt_id=None):
+        with self.lock:
+            return {prompt_id: self.history[prompt_id]} if prompt_id in self.history else {}
+
+    def delete_history_item(self, prompt_id) -> None:
+        with self.lock:
+            self.history.pop(prompt_id, None)
+
+
+def noise_jpeg_base64(side: int) -> str:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(buffer, "JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def run_depth(depth: int, args, reference: str, scratch: Path) -> dict:
+    handler.PIPELINE_DEPTH = depth
+    handler._pipeline = None
+    prompt_queue = SerialPromptQueue(args.exec_s, scratch)
+    handler.server = types.SimpleNamespace(prompt_queue=prompt_queue)
+    results = []
+
+    def submit(index: int) -> None:
+        job_input = {
+            "image_base64": reference,
+            "seed": index,
+            "coalesce": False,
+            "include_output_base64": False,
+            "admission": "off",
+        }
+        results.append(handler.handler({"id": f"sim-{depth}-{index}", "input": job_input}))
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(args.jobs)]
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+            if depth <= 0:
+                thread.join()
+            else:
+                time.sleep(args.arrival_s)
+        for thread in threads:
+            thread.join()
+    wall = time.perf_counter() - started
+    gaps_ms = [gap * 1000 for gap in prompt_queue.gaps]
+    return {
+        "depth": depth,
+        "wall_s": wall,
+        "errors": sum(1 for result in results if "error" in result),
+        "gap_p50_ms": statistics.median(gaps_ms) if gaps_ms else float("nan"),
+        "gap_max_ms": max(gaps_ms, default=float("nan")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 1], help="0 = sequential, no look-ahead")
+    parser.add_argument("--jobs", type=int, default=6)
+    parser.add_argument("--exec-s", type=float, default=0.4, help="stub GPU seconds per prompt")
+    parser.add_argument("--arrival-s", type=float, default=0.05, help="gap between job arrivals")
+    parser.add_argument("--reference-px", type=int, default=2500, help="side of the JPEG reference")
+    args = parser.parse_args()
+
+    reference = noise_jpeg_base64(args.reference_px)
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        handler.COMFY_INPUT = scratch
+        handler.COMFY_OUTPUT = scratch
+        handler.UPLOAD_OUTPUTS = "0"
+        registry = handler.WorkflowRegistry(Path(handler.__file__).parent, default_name=handler.WORKFLOW_NAME)
+        registry.refresh(force=True)
+        handler.workflow_registry = registry
+        handler.ensure_comfy_ready = lambda: None
+
+        print(f"{'depth':>5} {'wall_s':>7} {'errors':>6} {'gap_p50_ms':>10} {'gap_max_ms':>10}")
+        for depth in args.depths:
+            row = run_depth(depth, args, reference, scratch)
+            print(
+                f"{row['depth']:>5} {row['wall_s']:>7.2f} {row['errors']:>6} "
+                f"{row['gap_p50_ms']:>10.1f} {row['gap_max_ms']:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()